@@ -1,9 +1,12 @@
 
 import asyncio
+import collections
 import concurrent
 import requests
+import threading
+import weakref
 
-from .asyncio_utils import run_in_executor, run_iterator_in_executor
+from .core.utils import run_in_executor, run_iterator_in_executor
 
 
 def expose_property(func, member_name):
@@ -76,8 +79,21 @@ class Response:
   def history(self):
     return [Response(x, False) for x in self._request.history]
 
-  def iter_content(self, *args, **kwargs):
-    it = self._request.iter_content(*args, **kwargs)
+  def iter_content(self, chunk_size=1, decode_unicode=False, read_ahead=None, zero_copy=False):
+    """
+    Iterates over the response body in chunks of *chunk_size* bytes. If
+    *read_ahead* is a number of bytes, the body of a streamed response is
+    read on a background thread into a buffer of that size and handed over
+    in batches (see #ReadAhead). With *zero_copy*, the chunks are
+    #memoryview slices of the buffered data.
+    """
+
+    if read_ahead and self._stream:
+      assert not decode_unicode, 'read_ahead does not support decode_unicode'
+      return ReadAhead(self._request, chunk_size, read_ahead, zero_copy=zero_copy)
+    it = self._request.iter_content(chunk_size, decode_unicode)
+    if zero_copy:
+      it = map(memoryview, it)
     return run_iterator_in_executor(None, it, async_=self._stream)
 
   def iter_lines(self, *args, **kwargs):
@@ -92,6 +108,177 @@ class Response:
       return future()
 
 
+class _ReadAheadBuffer:
+  """
+  The state that #ReadAhead shares with its background thread. The thread
+  only references this object, so an abandoned #ReadAhead can be garbage
+  collected and close the buffer.
+  """
+
+  def __init__(self, response, buffer_size, read_size):
+    self.response = response
+    self.buffer_size = buffer_size
+    self.read_size = read_size
+    self.cond = threading.Condition()
+    self.blocks = collections.deque()
+    self.buffered = 0
+    self.done = False
+    self.closed = False
+    self.error = None
+    self.waiter = None
+    self.loop = None
+
+  def run(self):
+    try:
+      for block in self.response.iter_content(self.read_size):
+        with self.cond:
+          while self.buffered >= self.buffer_size and not self.closed:
+            self.cond.wait()
+          if self.closed:
+            break
+          self.blocks.append(block)
+          self.buffered += len(block)
+          wake = self.waiter is not None
+        if wake:
+          self.wake()
+    except Exception as exc:
+      self.error = exc
+    finally:
+      with self.cond:
+        self.done = True
+      self.wake()
+
+  def wake(self):
+    def wake():
+      if self.waiter is not None and not self.waiter.done():
+        self.waiter.set_result(None)
+    try:
+      self.loop.call_soon_threadsafe(wake)
+    except RuntimeError:
+      pass  # The event loop is closed.
+
+  def close(self):
+    with self.cond:
+      self.closed = True
+      self.blocks.clear()
+      self.buffered = 0
+      self.cond.notify()
+    self.response.close()
+
+
+class ReadAhead:
+  """
+  An asynchronous iterator over the body of a streamed #requests.Response.
+  A background thread reads blocks of *read_size* bytes while the consumer
+  processes the previous ones, until *buffer_size* bytes are buffered, then
+  it waits for the consumer to catch up. The consumer takes all buffered
+  blocks at once and only waits for the thread if the buffer is empty, so
+  a slow consumer causes no thread switches at all. At most about twice the
+  *buffer_size* is held in memory.
+
+  The blocks are split into chunks of *chunk_size* bytes, the last chunk of
+  a block can be shorter if the body is compressed. Use #batches() to
+  process all chunks that are available at once.
+
+  A consumer that stops early should use the iterator as an asynchronous
+  context manager or call #close(). Otherwise the thread and the response
+  are released when the iterator is garbage collected.
+  """
+
+  def __init__(self, response, chunk_size=1024, buffer_size=1024 * 1024,
+               read_size=64 * 1024, zero_copy=False):
+    self.chunk_size = chunk_size
+    self.buffer_size = max(buffer_size, chunk_size)
+    # Blocks that are a multiple of the chunk size split without a remainder.
+    self.read_size = max(1, -(-read_size // chunk_size)) * chunk_size
+    self.zero_copy = zero_copy
+    self.batch_count = 0
+    self._buffer = _ReadAheadBuffer(response, self.buffer_size, self.read_size)
+    self._finalizer = weakref.finalize(self, self._buffer.close)
+    self._chunks = collections.deque()
+    self._thread = None
+
+  def _split(self, block):
+    if len(block) <= self.chunk_size:
+      return [memoryview(block) if self.zero_copy else block]
+    data = memoryview(block) if self.zero_copy else block
+    return [data[i:i + self.chunk_size] for i in range(0, len(block), self.chunk_size)]
+
+  async def _take(self):
+    """
+    Returns all buffered blocks, waiting for the thread if there are none.
+    Returns an empty list at the end of the body.
+    """
+
+    buf = self._buffer
+    if self._thread is None:
+      if buf.closed:
+        return []
+      buf.loop = asyncio.get_event_loop()
+      self._thread = threading.Thread(target=buf.run, name='quel-read-ahead', daemon=True)
+      self._thread.start()
+    while True:
+      with buf.cond:
+        buf.waiter = None
+        if buf.blocks:
+          blocks = list(buf.blocks)
+          buf.blocks.clear()
+          buf.buffered = 0
+          buf.cond.notify()
+          self.batch_count += 1
+          return blocks
+        if buf.done or buf.closed:
+          if buf.error is not None and not buf.closed:
+            raise buf.error
+          return []
+        waiter = buf.waiter = buf.loop.create_future()
+      await waiter
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    while not self._chunks:
+      blocks = await self._take()
+      if not blocks:
+        raise StopAsyncIteration
+      for block in blocks:
+        self._chunks.extend(self._split(block))
+    return self._chunks.popleft()
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc_info):
+    await self.aclose()
+
+  async def batches(self):
+    """
+    Yields lists of all chunks that are available at once.
+    """
+
+    if self._chunks:
+      yield list(self._chunks)
+      self._chunks.clear()
+    while True:
+      blocks = await self._take()
+      if not blocks:
+        break
+      yield [chunk for block in blocks for chunk in self._split(block)]
+
+  def close(self):
+    """
+    Stops the background thread and closes the response. Does nothing if
+    it was already closed.
+    """
+
+    self._chunks.clear()
+    self._finalizer()
+
+  async def aclose(self):
+    self.close()
+
+
 async def request(*args, **kwargs):
   executor = kwargs.pop('executor', None)
   response = await run_in_executor(executor, requests.request, *args, **kwargs)
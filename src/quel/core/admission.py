@@ -0,0 +1,166 @@
+
+from quel.core.stats import stats
+from quel.core.utils import TTLCache
+
+import collections
+import time
+
+
+class TokenBucket:
+  """
+  Holds up to *capacity* tokens that refill at *rate* tokens per second.
+  """
+
+  __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+  def __init__(self, rate, capacity):
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = capacity
+    self.updated = time.monotonic()
+
+  def refill(self, now):
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def wait_time(self, cost):
+    """
+    Returns the number of seconds until *cost* tokens are available. Must be
+    called after #refill().
+    """
+
+    if cost <= self.tokens:
+      return 0.0
+    if cost > self.capacity or self.rate <= 0:
+      return float('inf')
+    return (cost - self.tokens) / self.rate
+
+
+class Rejection(Exception):
+  """
+  Raised by #Admission.admit() if a command is rejected. The *reason* is
+  "busy" if too many commands are in progress, "user", "guild" or "global"
+  if the budget of the user, the guild or the process is exhausted. For
+  the latter, *retry_after* is the number of seconds until the command would
+  be admitted, or infinite if its cost exceeds the burst size.
+  """
+
+  def __init__(self, reason, retry_after):
+    super().__init__(reason)
+    self.reason = reason
+    self.retry_after = retry_after
+
+
+class Ticket:
+  """
+  A context manager for an admitted command. Counts the command as pending
+  until it exits.
+  """
+
+  __slots__ = ('admission', 'guild_id', 'released')
+
+  def __init__(self, admission, guild_id):
+    self.admission = admission
+    self.guild_id = guild_id
+    self.released = False
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.release()
+
+  def release(self):
+    if not self.released:
+      self.released = True
+      self.admission._release(self.guild_id)
+
+
+class Admission:
+  """
+  Admission control for commands that cause expensive work, such as
+  resolving URLs or searching. Every user, every guild and the whole process
+  has a #TokenBucket, a command is admitted only if all of them hold enough
+  tokens for its cost. In addition, at most *max_pending* commands run at
+  the same time, of which at most *max_pending_per_guild* in the same guild.
+
+  The budgets are `(rate, burst)` tuples. The cost of a command is the
+  number of work units it reported (eg. the number of URLs) multiplied with
+  its entry in *costs*, which defaults to 1.
+  """
+
+  def __init__(self, costs=None, user_budget=(0.2, 20), guild_budget=(1.0, 50),
+               global_budget=(20.0, 500), max_pending=64, max_pending_per_guild=4):
+    self.costs = dict(costs or {})
+    self.user_budget = user_budget
+    self.guild_budget = guild_budget
+    self.global_budget = global_budget
+    self.max_pending = max_pending
+    self.max_pending_per_guild = max_pending_per_guild
+    self.pending = 0
+    self._guild_pending = collections.Counter()
+    self._global = TokenBucket(*global_budget)
+    self._users = TTLCache(3600, maxsize=100000)
+    self._guilds = TTLCache(3600, maxsize=100000)
+
+  def cost(self, name, units=1):
+    return self.costs.get(name, 1.0) * units
+
+  def _bucket(self, cache, key, budget):
+    bucket = cache.get(key)
+    if bucket is None:
+      bucket = TokenBucket(*budget)
+    cache.set(key, bucket)
+    return bucket
+
+  def admit(self, name, units, user_id, guild_id):
+    """
+    Admits the command *name* with the specified number of work *units* for
+    the user and guild. Returns a #Ticket that must be released when the
+    command is done, or raises a #Rejection without consuming any tokens.
+    """
+
+    cost = self.cost(name, units)
+    if self.pending >= self.max_pending or \
+        self._guild_pending[guild_id] >= self.max_pending_per_guild:
+      stats.incr('admission.rejected.busy')
+      stats.incr('admission.rejected_cost', cost)
+      raise Rejection('busy', None)
+    self._take(cost, user_id, guild_id)
+    self.pending += 1
+    self._guild_pending[guild_id] += 1
+    stats.incr('admission.admitted')
+    return Ticket(self, guild_id)
+
+  def charge(self, name, units, user_id, guild_id):
+    """
+    Takes the cost of more work *units* of a command that is already
+    admitted, eg. the entries of a playlist that it discovered. Raises a
+    #Rejection like #admit() if the budgets do not suffice, but never
+    because too many commands are pending.
+    """
+
+    self._take(self.cost(name, units), user_id, guild_id)
+    stats.incr('admission.charged')
+
+  def _take(self, cost, user_id, guild_id):
+    now = time.monotonic()
+    buckets = [
+      ('user', self._bucket(self._users, user_id, self.user_budget)),
+      ('guild', self._bucket(self._guilds, guild_id, self.guild_budget)),
+      ('global', self._global)]
+    for reason, bucket in buckets:
+      bucket.refill(now)
+      wait_time = bucket.wait_time(cost)
+      if wait_time:
+        stats.incr('admission.rejected.' + reason)
+        stats.incr('admission.rejected_cost', cost)
+        raise Rejection(reason, wait_time)
+    for reason, bucket in buckets:
+      bucket.tokens -= cost
+
+  def _release(self, guild_id):
+    self.pending -= 1
+    self._guild_pending[guild_id] -= 1
+    if self._guild_pending[guild_id] <= 0:
+      del self._guild_pending[guild_id]
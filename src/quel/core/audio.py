@@ -0,0 +1,50 @@
+
+import discord
+
+
+class TrackedVolumeTransformer(discord.PCMVolumeTransformer):
+  """
+  A #discord.PCMVolumeTransformer that counts the audio frames that have been
+  read from it, allowing to compute the current playback position. Frames
+  are only read while the voice client is playing, so pausing does not
+  advance the position.
+
+  The *gain* is a fixed loudness normalization factor that is applied on
+  top of the #volume.
+  """
+
+  frame_length = discord.opus.Encoder.FRAME_LENGTH / 1000
+
+  def __init__(self, original, volume=1.0, offset=0.0, gain=1.0):
+    self.gain = gain
+    super().__init__(original, volume)
+    self.offset = offset
+    self.frames = 0
+    self.eof = False
+
+  @property
+  def volume(self):
+    return self._level
+
+  @volume.setter
+  def volume(self, value):
+    self._level = max(value, 0.0)
+    self._volume = self._level * self.gain
+
+  @property
+  def position(self):
+    """
+    The playback position in seconds, including the *offset* at which the
+    stream was started.
+    """
+
+    return self.offset + self.frames * self.frame_length
+
+  def read(self):
+    data = super().read()
+    if data:
+      self.frames += 1
+    else:
+      # The source ended on its own rather than being stopped.
+      self.eof = True
+    return data
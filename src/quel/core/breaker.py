@@ -0,0 +1,91 @@
+
+import enum
+import time
+
+
+class BreakerState(enum.Enum):
+  closed = 0
+  open = 1
+  half_open = 2
+
+
+class CircuitOpen(Exception):
+  """
+  Raised by #CircuitBreaker.acquire() while calls are not allowed.
+  *retry_after* is the number of seconds until the next probing call is
+  allowed.
+  """
+
+  def __init__(self, retry_after):
+    super().__init__('circuit open')
+    self.retry_after = retry_after
+
+
+class CircuitBreaker:
+  """
+  Stops calls to a service after *failure_threshold* consecutive failures.
+  While the breaker is open, #acquire() raises #CircuitOpen. After
+  *reset_timeout* seconds, the breaker is half-open and lets a single call
+  through to probe the service: if it succeeds, the breaker closes, if it
+  fails, the breaker opens again.
+
+  Every call that was allowed by #acquire() must be finished with one of
+  #success(), #failure() or #abort().
+  """
+
+  def __init__(self, failure_threshold=5, reset_timeout=30.0):
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self.failures = 0
+    self.opened = None
+    self._probing = False
+
+  @property
+  def state(self):
+    if self.opened is None:
+      return BreakerState.closed
+    if self._probing or time.monotonic() >= self.opened + self.reset_timeout:
+      return BreakerState.half_open
+    return BreakerState.open
+
+  def retry_after(self):
+    if self.opened is None:
+      return 0.0
+    return max(0.0, self.opened + self.reset_timeout - time.monotonic())
+
+  def acquire(self):
+    """
+    Returns `True` if the call is the probing call of a half-open breaker,
+    `False` for a normal call. Raises #CircuitOpen if no call is allowed.
+    """
+
+    state = self.state
+    if state == BreakerState.closed:
+      return False
+    if state == BreakerState.half_open and not self._probing:
+      self._probing = True
+      return True
+    raise CircuitOpen(self.retry_after() or self.reset_timeout)
+
+  def success(self, probe=False):
+    if probe or self.opened is None:
+      self._probing = False
+      self.failures = 0
+      self.opened = None
+
+  def failure(self, probe=False):
+    self.failures += 1
+    if probe:
+      self._probing = False
+      self.opened = time.monotonic()
+    elif self.opened is None and self.failures >= self.failure_threshold:
+      self.opened = time.monotonic()
+
+  def abort(self, probe=False):
+    """
+    Finishes a call that neither succeeded nor failed, eg. because it was
+    cancelled.
+    """
+
+    if probe:
+      self._probing = False
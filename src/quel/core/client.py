@@ -1,8 +1,11 @@
 
 
+from .replies import ReplyAggregator
+from .stats import stats
 from .utils import async_partial, async_local_proxy
 
 import asyncio
+import contextlib
 import discord
 import enum
 import functools
@@ -16,6 +19,12 @@ class EventType(enum.Enum):
   message = 1
   error = 2
   guild_join = 3
+  voice_state_update = 4
+  guild_channel_create = 5
+  guild_channel_update = 6
+  guild_channel_delete = 7
+  reaction_add = 8
+  reaction_remove = 9
 
 
 class Event:
@@ -32,7 +41,13 @@ class MessageEvent(Event):
     super().__init__(EventType.message, client, message=message, text=message.content)
 
   async def reply(self, *args, **kwargs):
-    return await self.message.channel.send(*args, **kwargs)
+    """
+    Sends a reply to the channel of the message. Replies are buffered and
+    merged by the channel's #ReplyAggregator, pass `immediate=True` if you
+    need the #discord.Message object or want to handle errors.
+    """
+
+    return await self.client.get_replies(self.message.channel).send(*args, **kwargs)
 
 
 def propagate_event(func):
@@ -63,6 +78,30 @@ def prepare_guild_join(client, guild):
   return Event(EventType.guild_join, client, guild=guild)
 
 
+def prepare_voice_state_update(client, member, before, after):
+  return Event(EventType.voice_state_update, client, member=member, before=before, after=after)
+
+
+def prepare_guild_channel_create(client, channel):
+  return Event(EventType.guild_channel_create, client, channel=channel)
+
+
+def prepare_guild_channel_update(client, before, after):
+  return Event(EventType.guild_channel_update, client, channel=after, before=before, after=after)
+
+
+def prepare_guild_channel_delete(client, channel):
+  return Event(EventType.guild_channel_delete, client, channel=channel)
+
+
+def prepare_reaction_add(client, reaction, user):
+  return Event(EventType.reaction_add, client, reaction=reaction, user=user, message=reaction.message)
+
+
+def prepare_reaction_remove(client, reaction, user):
+  return Event(EventType.reaction_remove, client, reaction=reaction, user=user, message=reaction.message)
+
+
 #def prepare_error(event_method, *args, **kwargs):
 #  return Event(EventType.error, event_method=event_method, args=args, kwargs=kwargs)
 
@@ -78,6 +117,14 @@ class EventHandler:
   def added_to_client(self, client):
     self._client = weakref.ref(client)
 
+  def prefilter(self, event):
+    """
+    Called with every #MessageEvent before it is dispatched. Messages that
+    no handler accepts are dropped right away, so this must be cheap.
+    """
+
+    return True
+
   async def handle_event(self):
     return False
 
@@ -95,6 +142,15 @@ class EventMultiplexer(EventHandler):
         return True
     return False
 
+  async def admit(self, name, units):
+    """
+    Called before the command *name* that has a cost runs (see #Command).
+    Returns a context manager that is entered while the command runs, or
+    `None` if the command is rejected.
+    """
+
+    return contextlib.nullcontext()
+
 
 class MemberEventHandler:
 
@@ -134,6 +190,7 @@ class Client:
   def __init__(self):
     self.__client = None
     self.__handlers = []
+    self.__replies = {}
 
   def run(self, *args, **kwargs):
     self.__client = discord.Client()
@@ -151,11 +208,31 @@ class Client:
     handler.added_to_client(self)
     self.__handlers.append(handler)
 
+  def get_replies(self, channel):
+    """
+    Returns the #ReplyAggregator for the specified *channel*.
+    """
+
+    try:
+      return self.__replies[channel.id]
+    except KeyError:
+      replies = self.__replies[channel.id] = ReplyAggregator(channel)
+      return replies
+
   async def dispatch_event(self, event):
+    if isinstance(event, MessageEvent):
+      if not any(handler.prefilter(event) for handler in self.__handlers):
+        stats.incr('messages.filtered')
+        return
+      stats.incr('messages.dispatched')
     with set_event(event):
-      for handler in self.__handlers:
-        if await handler.handle_event():
-          return
+      try:
+        for handler in self.__handlers:
+          if await handler.handle_event():
+            return
+      finally:
+        if isinstance(event, MessageEvent):
+          await self.get_replies(event.message.channel).flush()
 
   def __getattr__(self, name):
     return getattr(self.__client, name)
@@ -5,11 +5,20 @@ import re
 
 
 class Command(MemberEventHandler):
-
-  def __init__(self, func, regex, preconditions=None, case_sensitive=False, flags=0):
+  """
+  Calls the decorated function for messages that match *regex*, with the
+  groups of the match. Commands that cause expensive work specify a *cost*,
+  either a number or a function that is called with the groups of the match
+  and returns the number of work units (eg. the number of URLs). They are
+  only called if #EventMultiplexer.admit() admits them.
+  """
+
+  def __init__(self, func, regex, preconditions=None, case_sensitive=False, flags=0, cost=None):
     super().__init__(func)
+    self.name = func.__name__
     self.regex = re.compile(regex, flags | (0 if case_sensitive else re.I))
     self.preconditions = preconditions or []
+    self.cost = cost
 
   async def handle_event(self, instance):
     if event.type == EventType.message and event.message.author != event.client.user:
@@ -18,22 +27,28 @@ class Command(MemberEventHandler):
           return False
       match = self.regex.match(event.text)
       if match is not None:
-        await self.func(instance, *match.groups())
+        if self.cost is None:
+          await self.func(instance, *match.groups())
+          return True
+        units = self.cost(*match.groups()) if callable(self.cost) else self.cost
+        ticket = await instance.admit(self.name, units)
+        if ticket is not None:
+          with ticket:
+            await self.func(instance, *match.groups())
         return True
     return False
 
 
 class On(MemberEventHandler):
 
-  def __init__(self, func, event_type):
+  def __init__(self, func, *event_types):
     super().__init__(func)
-    if isinstance(event_type, str):
-      event_type = getattr(EventType, event_type)
-    assert isinstance(event_type, EventType)
-    self.event_type = event_type
+    event_types = [getattr(EventType, x) if isinstance(x, str) else x for x in event_types]
+    assert event_types and all(isinstance(x, EventType) for x in event_types)
+    self.event_types = frozenset(event_types)
 
   async def handle_event(self, instance):
-    if event.type == self.event_type:
+    if event.type in self.event_types:
       result = await self.func(instance)
       if result is None:
         result = True
@@ -0,0 +1,86 @@
+
+from quel.core.stats import stats
+
+import collections
+
+
+def page_count(total, page_size):
+  """
+  Returns the number of pages for *total* items, at least one.
+  """
+
+  return max(1, -(-total // page_size))
+
+
+def format_duration(seconds):
+  """
+  Formats a number of *seconds* as `m:ss`, or `h:mm:ss` if it is an hour or
+  longer.
+  """
+
+  minutes, seconds = divmod(int(seconds), 60)
+  hours, minutes = divmod(minutes, 60)
+  if hours:
+    return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+  return '{}:{:02}'.format(minutes, seconds)
+
+
+def shorten(text, width):
+  """
+  Shortens *text* to at most *width* characters, with an ellipsis at the end
+  if it was cut off.
+  """
+
+  text = str(text or '')
+  if len(text) <= width:
+    return text
+  return text[:width - 1].rstrip() + '\N{HORIZONTAL ELLIPSIS}'
+
+
+class PageCache:
+  """
+  Caches the rendered pages of a sequence per key. The pages of a key are
+  dropped as soon as they are requested with a different *version* than the
+  one they were rendered for, so the version must change whenever the
+  sequence changes (see #SongQueue.version).
+
+  At most *maxsize* keys and *max_pages* pages per key are kept, the least
+  recently used ones are evicted first.
+  """
+
+  def __init__(self, maxsize=1000, max_pages=16):
+    self.maxsize = maxsize
+    self.max_pages = max_pages
+    self._entries = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key, version, page, render):
+    """
+    Returns the rendered *page* for *key*. If it is not cached for the
+    *version*, it is rendered with `render(page)`.
+    """
+
+    entry = self._entries.get(key)
+    if entry is None or entry[0] != version:
+      entry = self._entries[key] = (version, collections.OrderedDict())
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+    self._entries.move_to_end(key)
+    pages = entry[1]
+    try:
+      value = pages[page]
+    except KeyError:
+      stats.incr('pages.rendered')
+      value = pages[page] = render(page)
+      while len(pages) > self.max_pages:
+        pages.popitem(last=False)
+    else:
+      stats.incr('pages.cached')
+      pages.move_to_end(page)
+    return value
+
+  def invalidate(self, key):
+    self._entries.pop(key, None)
+
@@ -0,0 +1,172 @@
+
+import collections
+import itertools
+import random
+
+
+class SongQueue:
+  """
+  A double-ended queue of songs that stays efficient for queues with tens of
+  thousands of entries. Pushing and popping at both ends is O(1), removing,
+  inserting and moving entries by index is O(min(i, n-i)) and shuffling is
+  O(n). Songs are identified by their URL, which allows rejecting duplicates
+  on insert in O(1). The total duration of all songs is maintained
+  incrementally.
+
+  The #version is incremented with every modification and can be used to
+  invalidate data derived from the queue.
+  """
+
+  def __init__(self, songs=()):
+    self._items = collections.deque()
+    self._keys = collections.Counter()
+    self._duration = 0
+    self.version = 0
+    self.extend(songs, dedup=False)
+
+  @staticmethod
+  def key(song):
+    return song.url
+
+  @staticmethod
+  def duration_of(song):
+    try:
+      return int(song.duration or 0)
+    except (TypeError, ValueError):
+      return 0
+
+  def _added(self, song):
+    self._keys[self.key(song)] += 1
+    self._duration += self.duration_of(song)
+    self.version += 1
+
+  def _removed(self, song):
+    key = self.key(song)
+    self._keys[key] -= 1
+    if self._keys[key] <= 0:
+      del self._keys[key]
+    self._duration -= self.duration_of(song)
+    self.version += 1
+
+  def __len__(self):
+    return len(self._items)
+
+  def __bool__(self):
+    return bool(self._items)
+
+  def __iter__(self):
+    return iter(self._items)
+
+  def __contains__(self, song):
+    return self.key(song) in self._keys
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      start, stop, step = index.indices(len(self._items))
+      return list(itertools.islice(self._items, start, stop, step))
+    return self._items[index]
+
+  @property
+  def total_duration(self):
+    """
+    The sum of the durations of all songs in the queue in seconds. Songs with
+    an unknown duration count as zero.
+    """
+
+    return self._duration
+
+  def append(self, song, dedup=True):
+    """
+    Adds a song to the end of the queue. If *dedup* is enabled and a song
+    with the same URL is already queued, the song is not added and `False`
+    is returned.
+    """
+
+    if dedup and song in self:
+      return False
+    self._items.append(song)
+    self._added(song)
+    return True
+
+  def appendleft(self, song):
+    self._items.appendleft(song)
+    self._added(song)
+
+  def extend(self, songs, dedup=True):
+    return sum(1 for song in songs if self.append(song, dedup))
+
+  def insert(self, index, song):
+    self._items.insert(index, song)
+    self._added(song)
+
+  def popleft(self):
+    song = self._items.popleft()
+    self._removed(song)
+    return song
+
+  def pop(self):
+    song = self._items.pop()
+    self._removed(song)
+    return song
+
+  def remove(self, index):
+    """
+    Removes and returns the song at the specified *index*.
+    """
+
+    song = self._items[index]
+    del self._items[index]
+    self._removed(song)
+    return song
+
+  def update(self, song, fields):
+    """
+    Updates the attributes of *song* from the *fields* dictionary, keeping the
+    aggregates in sync if the song is queued. The URL of a song is never
+    changed as it identifies the song in the queue.
+    """
+
+    queued = song in self
+    if queued:
+      self._duration -= self.duration_of(song)
+    for key, value in fields.items():
+      if key != 'url':
+        setattr(song, key, value)
+    if queued:
+      self._duration += self.duration_of(song)
+      self.version += 1
+
+  def move(self, src, dst):
+    """
+    Moves the song at index *src* to index *dst*. Returns the moved song.
+    """
+
+    song = self._items[src]
+    if dst < 0:
+      dst += len(self._items)
+    if not 0 <= dst < len(self._items):
+      raise IndexError('queue index out of range')
+    del self._items[src]
+    self._items.insert(dst, song)
+    self.version += 1
+    return song
+
+  def skip(self, count):
+    """
+    Removes the first *count* songs from the queue.
+    """
+
+    for _ in range(min(count, len(self._items))):
+      self.popleft()
+
+  def shuffle(self, rng=random):
+    items = list(self._items)
+    rng.shuffle(items)
+    self._items = collections.deque(items)
+    self.version += 1
+
+  def clear(self):
+    self._items.clear()
+    self._keys.clear()
+    self._duration = 0
+    self.version += 1
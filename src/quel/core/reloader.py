@@ -1,9 +1,52 @@
 
+import json
+import logging
 import os
 import socket
 import socketserver
 import subprocess
 import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class LineChannel:
+  """
+  A thin wrapper around a socket that exchanges newline terminated messages.
+  A message consists of a command word optionally followed by a JSON payload.
+  """
+
+  def __init__(self, sock):
+    self.sock = sock
+    self._fp = sock.makefile('rb')
+
+  def send(self, command, payload=None):
+    line = command
+    if payload is not None:
+      line += ' ' + json.dumps(payload)
+    self.sock.sendall(line.encode('utf8') + b'\n')
+
+  def receive(self, timeout=None):
+    """
+    Receives the next message and returns a tuple of the command word and
+    the payload (or `None`). Returns `(None, None)` if the connection was
+    closed or the *timeout* expired.
+    """
+
+    self.sock.settimeout(timeout)
+    try:
+      line = self._fp.readline()
+    except (socket.timeout, OSError):
+      return None, None
+    if not line:
+      return None, None
+    command, _, payload = line.decode('utf8').strip().partition(' ')
+    return command, (json.loads(payload) if payload else None)
+
+  def close(self):
+    self._fp.close()
+    self.sock.close()
 
 
 class ReloaderRequestHandler(socketserver.BaseRequestHandler):
@@ -13,53 +56,190 @@ class ReloaderRequestHandler(socketserver.BaseRequestHandler):
     super().__init__(*args, **kwargs)
 
   def handle(self):
-    data = self.request.recv(7)
-    if data == b'reload\n':
-      self.reloader.reload()
+    channel = LineChannel(self.request)
+    command, _ = channel.receive(timeout=10)
+    if command == 'reload':
+      self.reloader.reload(channel)
+    elif command == 'ready':
+      self.reloader.standby_ready(channel)
     else:
-      logging.warn('Reloader: Unexpected data received.')
+      logger.warning('Reloader: Unexpected data received.')
       self.request.close()
 
 
+class ReloaderServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+
+  daemon_threads = True
+
+
 class Reloader:
+  """
+  Runs the bot in a child process and restarts it when the child asks for it.
+
+  In the default mode, the running child is terminated before the new one is
+  started. With *blue_green* enabled, the new child is started as a standby
+  process next to the running one. It logs in and warms up, then reports
+  `ready` to the reloader which asks the old child to hand over its state.
+  The state is forwarded to the standby process which takes over, and the
+  old child exits only after that.
+  """
 
-  def __init__(self, envvar='RELOADER_TCP_PORT'):
+  def __init__(self, envvar='RELOADER_TCP_PORT', standby_envvar='RELOADER_STANDBY'):
     self.server = None
     self._process = None
+    self._standby = None
+    self._lock = threading.Lock()
+    self._reload_lock = threading.Lock()
+    self._ready = threading.Event()
+    self._state_ready = threading.Event()
+    self._state = None
     self.envvar = envvar
+    self.standby_envvar = standby_envvar
+    self.blue_green = False
+    self.standby_timeout = 120.0
+    self.handoff_timeout = 30.0
+    self._is_standby = os.getenv(standby_envvar, '') != ''
 
   def is_inner(self):
     return os.getenv(self.envvar, '') != ''
 
-  def send_reload(self):
+  def is_standby(self):
+    """
+    Returns `True` if this is a child process that was started as a standby
+    process and has not yet taken over.
+    """
+
+    return self.is_inner() and self._is_standby
+
+  def _connect(self):
     assert self.is_inner()
     port = int(os.getenv(self.envvar))
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.connect(('localhost', port))
-    sock.send(b'reload\n')
-    sock.close()
+    return LineChannel(sock)
 
-  def reload(self):
-    assert not self.is_inner()
-    if self._process:
-      self._process.terminate()
-      self._process.wait()
+  def send_reload(self):
+    channel = self._connect()
+    channel.send('reload')
+    channel.close()
+
+  def request_handoff(self):
+    """
+    Called in the running child in blue/green mode. Asks the reloader to
+    start a standby process and blocks until it is ready. Returns the
+    #LineChannel on which the state must be sent with #send_state(), or
+    `None` if the reload was aborted.
+    """
+
+    channel = self._connect()
+    channel.send('reload')
+    command, _ = channel.receive(timeout=self.standby_timeout + 10)
+    if command != 'handoff':
+      channel.close()
+      return None
+    return channel
+
+  def send_state(self, channel, state):
+    try:
+      channel.send('state', state)
+    finally:
+      channel.close()
+
+  def send_ready(self):
+    """
+    Called in the standby child once it is fully started. Blocks until the
+    running child handed over its state and returns it. The process is no
+    longer considered a standby process afterwards.
+    """
+
+    channel = self._connect()
+    try:
+      channel.send('ready')
+      command, state = channel.receive(timeout=self.standby_timeout + self.handoff_timeout)
+    finally:
+      channel.close()
+    self._is_standby = False
+    if command != 'takeover':
+      logger.error('Reloader: Did not receive state from the previous process.')
+    return state or {}
+
+  def _spawn(self, standby=False):
     env = os.environ.copy()
     env[self.envvar] = str(self.server.socket.getsockname()[1])
-    self._process = subprocess.Popen(self._reload_args, env=env)
+    if standby:
+      env[self.standby_envvar] = '1'
+    else:
+      env.pop(self.standby_envvar, None)
+    return subprocess.Popen(self._reload_args, env=env)
+
+  def reload(self, channel=None):
+    assert not self.is_inner()
+    if self.blue_green and channel and self._process:
+      return self._reload_blue_green(channel)
+    with self._lock:
+      if self._process:
+        self._process.terminate()
+        self._process.wait()
+      self._process = self._spawn()
+
+  def _reload_blue_green(self, channel):
+    if not self._reload_lock.acquire(blocking=False):
+      logger.warning('Reloader: Reload already in progress.')
+      channel.send('abort')
+      return
+    try:
+      self._ready.clear()
+      self._state_ready.clear()
+      self._state = None
+      self._standby = self._spawn(standby=True)
+      logger.info('Reloader: Started standby process (pid {}).'.format(self._standby.pid))
+      if not self._ready.wait(self.standby_timeout) or self._standby.poll() is not None:
+        logger.error('Reloader: Standby process did not become ready, aborting.')
+        self._standby.terminate()
+        self._standby.wait()
+        channel.send('abort')
+        return
+      with self._lock:
+        old, self._process = self._process, self._standby
+      channel.send('handoff')
+      command, state = channel.receive(timeout=self.handoff_timeout)
+      if command != 'state':
+        logger.error('Reloader: Previous process did not hand over its state.')
+      self._state = state or {}
+      self._state_ready.set()
+      try:
+        old.wait(self.handoff_timeout)
+      except subprocess.TimeoutExpired:
+        logger.warning('Reloader: Previous process did not exit, terminating.')
+        old.terminate()
+        old.wait()
+    finally:
+      self._standby = None
+      self._state_ready.set()
+      self._reload_lock.release()
+
+  def standby_ready(self, channel):
+    self._ready.set()
+    if self._state_ready.wait(self.standby_timeout + self.handoff_timeout):
+      channel.send('takeover', self._state or {})
+    channel.close()
 
   def request_handler(self, *args, **kwargs):
     return ReloaderRequestHandler(self, *args, **kwargs)
 
+  def _running(self):
+    with self._lock:
+      return self._process.poll() is None
+
   def run_forever(self, reload_args=None):
     if reload_args is None:
       reload_args = [sys.executable] + getattr(sys, '__argv__', sys.argv)
-    self.server = socketserver.TCPServer(('localhost', 0), self.request_handler)
+    self.server = ReloaderServer(('localhost', 0), self.request_handler)
     self.server.timeout = 1.0
     self._reload_args = reload_args
     self.reload()
     try:
-      while self._process.poll() is None:
+      while self._running():
         self.server.handle_request()
     finally:
       self._process.terminate()
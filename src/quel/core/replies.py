@@ -0,0 +1,103 @@
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ReplyAggregator:
+  """
+  Buffers the replies that are sent to a channel and merges them into as few
+  messages as possible. Buffered replies are sent when #flush() is called
+  (the #Client does that after every event it dispatched) or after *delay*
+  seconds, whichever comes first.
+
+  Consecutive text replies are joined into one message. An embed is sent
+  together with the text that precedes it. If the last message that was sent
+  by the aggregator is still the latest message in the channel and younger
+  than *edit_window* seconds, text is appended to it by editing the message
+  instead of sending a new one.
+  """
+
+  max_length = 2000
+
+  def __init__(self, channel, delay=0.5, edit_window=10.0):
+    self.channel = channel
+    self.delay = delay
+    self.edit_window = edit_window
+    self._pending = []
+    self._handle = None
+    self._lock = asyncio.Lock()
+    self._last = None
+
+  async def send(self, content=None, *, embed=None, immediate=False, **kwargs):
+    """
+    Queues a reply. If *immediate* is `True` or any other arguments than
+    *content* and *embed* are specified, pending replies are flushed and the
+    message is sent right away. The sent message is returned in that case,
+    otherwise `None` is returned.
+    """
+
+    if immediate or kwargs:
+      async with self._lock:
+        await self._flush()
+        return await self.channel.send(content, embed=embed, **kwargs)
+    self._pending.append((None if content is None else str(content), embed))
+    if self._handle is None:
+      loop = asyncio.get_event_loop()
+      self._handle = loop.call_later(self.delay, self._flush_later)
+    return None
+
+  def _flush_later(self):
+    self._handle = None
+    def done(task):
+      if not task.cancelled() and task.exception():
+        logger.error('Unable to send replies', exc_info=task.exception())
+    asyncio.ensure_future(self.flush()).add_done_callback(done)
+
+  async def flush(self):
+    async with self._lock:
+      await self._flush()
+
+  async def _flush(self):
+    if self._handle is not None:
+      self._handle.cancel()
+      self._handle = None
+    pending, self._pending = self._pending, []
+    for content, embed in self._merge(pending):
+      if embed is None and content and await self._append_to_last(content):
+        continue
+      message = await self.channel.send(content, embed=embed)
+      self._last = (message, content, time.monotonic()) if embed is None else None
+
+  def _merge(self, pending):
+    lines = []
+    length = 0
+    for content, embed in pending:
+      if content is not None:
+        if lines and length + len(content) + 1 > self.max_length:
+          yield '\n'.join(lines), None
+          lines, length = [], 0
+        lines.append(content)
+        length += len(content) + 1
+      if embed is not None:
+        yield ('\n'.join(lines) if lines else None), embed
+        lines, length = [], 0
+    if lines:
+      yield '\n'.join(lines), None
+
+  async def _append_to_last(self, content):
+    if self._last is None:
+      return False
+    message, last_content, timestamp = self._last
+    if time.monotonic() - timestamp > self.edit_window:
+      return False
+    if getattr(self.channel, 'last_message_id', None) != message.id:
+      return False
+    new_content = last_content + '\n' + content
+    if len(new_content) > self.max_length:
+      return False
+    await message.edit(content=new_content)
+    self._last = (message, new_content, timestamp)
+    return True
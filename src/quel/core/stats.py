@@ -0,0 +1,23 @@
+
+import collections
+
+
+class Stats:
+  """
+  A collection of named counters that are exposed with the `stats` command.
+  """
+
+  def __init__(self):
+    self.counters = collections.Counter()
+
+  def incr(self, name, value=1):
+    self.counters[name] += value
+
+  def get(self, name):
+    return self.counters[name]
+
+  def items(self):
+    return sorted(self.counters.items())
+
+
+stats = Stats()
@@ -1,7 +1,9 @@
 
 import asyncio
+import collections
 import contextlib
 import functools
+import time
 import werkzeug.local
 
 
@@ -163,3 +165,76 @@ def run_iterator_in_executor(executor, iterator, async_=True):
 
   loop = asyncio.get_running_loop()
   return _async_iterator_wrapper(iterator, loop, executor, async_)
+
+
+class SingleFlight:
+  """
+  Deduplicates concurrent calls. While a call for a key is in flight, further
+  calls for the same key wait for its result instead of doing the work again.
+  The shared work is shielded, so a cancelled caller does not cancel it for
+  the others.
+  """
+
+  def __init__(self):
+    self._flights = {}
+
+  def __len__(self):
+    return len(self._flights)
+
+  async def do(self, key, func, *args, **kwargs):
+    """
+    Calls the coroutine function *func* unless a call for *key* is already
+    in flight, and returns its result.
+    """
+
+    future = self._flights.get(key)
+    if future is None:
+      future = asyncio.ensure_future(func(*args, **kwargs))
+      self._flights[key] = future
+      def done(f):
+        if self._flights.get(key) is f:
+          del self._flights[key]
+        if not f.cancelled():
+          f.exception()  # Don't warn about unretrieved exceptions.
+      future.add_done_callback(done)
+    return await asyncio.shield(future)
+
+
+class TTLCache:
+  """
+  A cache whose entries expire *ttl* seconds after they were set. At most
+  *maxsize* entries are kept, the least recently set entries are evicted
+  first.
+  """
+
+  def __init__(self, ttl, maxsize=1024):
+    self.ttl = ttl
+    self.maxsize = maxsize
+    self._data = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self._data)
+
+  def get(self, key, default=None):
+    try:
+      expires, value = self._data[key]
+    except KeyError:
+      return default
+    if expires < time.monotonic():
+      del self._data[key]
+      return default
+    return value
+
+  def set(self, key, value):
+    self._data.pop(key, None)
+    self._data[key] = (time.monotonic() + self.ttl, value)
+    while len(self._data) > self.maxsize:
+      self._data.popitem(last=False)
+
+  def pop(self, key, default=None):
+    value = self.get(key, default)
+    self._data.pop(key, None)
+    return value
+
+  def clear(self):
+    self._data.clear()
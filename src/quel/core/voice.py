@@ -0,0 +1,110 @@
+
+from quel.core.stats import stats
+
+import asyncio
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def wait_ready(voice_client, timeout=10.0, settle_delay=1.0, interval=0.05):
+  """
+  Waits until *voice_client* completed the handshake with the voice server
+  and can send audio. Returns `False` if it is not ready after *timeout*
+  seconds.
+
+  discord.py only returns a voice client from `connect()` once it is
+  connected, but audio that is sent right after that plays sped up. So
+  after the connection is ready, this waits another *settle_delay*
+  seconds.
+  """
+
+  loop = asyncio.get_event_loop()
+  deadline = loop.time() + timeout
+  while not voice_client.is_connected():
+    if loop.time() >= deadline:
+      return False
+    await asyncio.sleep(interval)
+  await asyncio.sleep(settle_delay)
+  return voice_client.is_connected()
+
+
+class IdleConnections:
+  """
+  Keeps voice connections that have nothing to play connected for *timeout*
+  seconds, so that the next song starts without connecting again. At most
+  *max_idle* connections are kept, if more become idle, the connection that
+  has been idle the longest is released first.
+
+  The *release* coroutine function is called with the key and the voice
+  client when a connection is released and must disconnect it.
+  """
+
+  def __init__(self, release, timeout=120.0, max_idle=50):
+    self.release = release
+    self.timeout = timeout
+    self.max_idle = max_idle
+    self._idle = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self._idle)
+
+  def __contains__(self, key):
+    return key in self._idle
+
+  def park(self, key, voice_client):
+    """
+    Keeps *voice_client* connected until it is taken back with #take(),
+    expires or is evicted. Releases it right away if idle connections are
+    disabled.
+    """
+
+    self.discard(key)
+    if self.timeout <= 0 or self.max_idle <= 0:
+      self._release(key, voice_client)
+      return
+    handle = asyncio.get_event_loop().call_later(self.timeout, self._expire, key)
+    self._idle[key] = (voice_client, handle)
+    while len(self._idle) > self.max_idle:
+      old_key, (old_client, old_handle) = self._idle.popitem(last=False)
+      old_handle.cancel()
+      stats.incr('voice.evicted')
+      self._release(old_key, old_client)
+
+  def take(self, key):
+    """
+    Returns the idle voice client for *key* if it is still connected, or
+    `None`.
+    """
+
+    voice_client = self.discard(key)
+    if voice_client is not None and not voice_client.is_connected():
+      return None
+    return voice_client
+
+  def discard(self, key):
+    """
+    Forgets the idle voice client for *key* without releasing it and returns
+    it.
+    """
+
+    entry = self._idle.pop(key, None)
+    if entry is None:
+      return None
+    entry[1].cancel()
+    return entry[0]
+
+  def _expire(self, key):
+    entry = self._idle.pop(key, None)
+    if entry is not None:
+      stats.incr('voice.expired')
+      self._release(key, entry[0])
+
+  def _release(self, key, voice_client):
+    async def release():
+      try:
+        await self.release(key, voice_client)
+      except Exception:
+        logger.exception('Unable to release the voice connection of {!r}'.format(key))
+    asyncio.ensure_future(release())
@@ -0,0 +1,57 @@
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedWorkers:
+  """
+  Runs jobs in one worker task per key. Jobs for the same key are processed
+  one after another, jobs for different keys run concurrently but at most
+  *max_concurrent* at the same time. A worker exits after it has been idle
+  for *idle_timeout* seconds and is started again by the next #put().
+
+  The *handler* is a coroutine function that is called with the key and the
+  job.
+  """
+
+  def __init__(self, handler, max_concurrent=8, idle_timeout=60.0):
+    self.handler = handler
+    self.max_concurrent = max_concurrent
+    self.idle_timeout = idle_timeout
+    self._queues = {}
+    self._tasks = {}
+    self._semaphore = None
+
+  def __len__(self):
+    return len(self._tasks)
+
+  def put(self, key, job):
+    queue = self._queues.get(key)
+    if queue is None:
+      queue = self._queues[key] = asyncio.Queue()
+    queue.put_nowait(job)
+    if key not in self._tasks:
+      self._tasks[key] = asyncio.ensure_future(self._run(key, queue))
+
+  async def _run(self, key, queue):
+    if self._semaphore is None:
+      self._semaphore = asyncio.Semaphore(self.max_concurrent)
+    try:
+      while True:
+        try:
+          job = await asyncio.wait_for(queue.get(), self.idle_timeout)
+        except asyncio.TimeoutError:
+          if queue.empty():
+            break
+          continue
+        async with self._semaphore:
+          try:
+            await self.handler(key, job)
+          except Exception:
+            logger.exception('Exception in worker for {!r}'.format(key))
+    finally:
+      del self._tasks[key]
+      if queue.empty():
+        del self._queues[key]
@@ -4,3 +4,11 @@ from pony import orm
 db = orm.Database()
 
 from .models import *
+from .cluster import Cluster
+from .index import TrackIndex
+from .loudness import LoudnessAnalyzer
+from .worker import DatabaseWorker, configure_sqlite
+
+worker = DatabaseWorker()
+track_index = TrackIndex(db, worker)
+loudness = LoudnessAnalyzer(worker)
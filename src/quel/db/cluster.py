@@ -0,0 +1,198 @@
+
+from .models import Lease
+from pony import orm
+
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def default_node_id():
+  return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class Cluster:
+  """
+  Coordinates several processes (nodes) that run with the same bot token.
+  Every node receives the events of all guilds, but only handles those of
+  the guilds it holds a #Lease for. Leases are renewed every
+  *heartbeat_interval* seconds and expire after *lease_ttl* seconds, after
+  which another node takes them over. A node takes at most *acquire_batch*
+  new guilds per heartbeat and no more than its share of the guilds among
+  the nodes that currently hold leases, so that nodes started at the same
+  time share the guilds. It never takes more than *max_guilds*.
+
+  #start() calls the following methods of its *handler*:
+
+  * `cluster_guild_ids()`: the IDs of the guilds the node can serve
+  * `cluster_snapshot(guild_id)`: the JSON serializable state of an owned
+    guild, which is stored with its lease
+  * `guild_acquired(guild_id, state)`: a coroutine, called when the node
+    took over a guild, with the state stored by the previous owner or `None`
+  * `guild_lost(guild_id)`: a coroutine, called when another node took over
+    a guild that this node owned
+  """
+
+  def __init__(self, worker, node_id=None, lease_ttl=30.0, heartbeat_interval=10.0,
+               max_guilds=None, acquire_batch=50):
+    assert heartbeat_interval < lease_ttl
+    self.worker = worker
+    self.node_id = node_id or default_node_id()
+    self.lease_ttl = lease_ttl
+    self.heartbeat_interval = heartbeat_interval
+    self.max_guilds = max_guilds
+    self.acquire_batch = acquire_batch
+    self.owned = set()
+    self._snapshots = {}
+    self._task = None
+
+  # The number of guild IDs per query, below the limit of SQLite for the
+  # number of variables in a statement.
+  query_chunk_size = 500
+
+  def owns(self, guild_id):
+    return guild_id in self.owned
+
+  def _collect_snapshots(self, handler):
+    # Only snapshots that changed since they were last stored.
+    snapshots = {}
+    for guild_id in self.owned:
+      state = handler.cluster_snapshot(guild_id)
+      encoded = json.dumps(state, sort_keys=True)
+      if self._snapshots.get(guild_id) != encoded:
+        snapshots[guild_id] = (state, encoded)
+    return snapshots
+
+  def _heartbeat(self, owned, guild_ids, snapshots, now):
+    expires = now + self.lease_ttl
+    candidates = list(guild_ids - owned)
+    random.shuffle(candidates)
+    ids = list(owned) + candidates
+    node_id = self.node_id
+    leases = {}
+    for i in range(0, len(ids), self.query_chunk_size):
+      chunk = ids[i:i + self.query_chunk_size]
+      leases.update((x.guild_id, x) for x in Lease.select(lambda x: x.guild_id in chunk))
+
+    kept = set()
+    for guild_id in owned:
+      lease = leases.get(guild_id)
+      if lease and lease.node_id == node_id:
+        lease.expires = expires
+        if guild_id in snapshots:
+          lease.state = snapshots[guild_id][0]
+        kept.add(guild_id)
+
+    nodes = set(orm.select(x.node_id for x in Lease if x.expires >= now)) | {node_id}
+    share = -(-len(guild_ids) // len(nodes))
+    capacity = min(self.acquire_batch, share - len(kept))
+    if self.max_guilds is not None:
+      capacity = min(capacity, self.max_guilds - len(kept))
+    acquired = {}
+    for guild_id in candidates:
+      if len(acquired) >= capacity:
+        break
+      lease = leases.get(guild_id)
+      if lease is None:
+        Lease(guild_id=guild_id, node_id=node_id, expires=expires)
+        acquired[guild_id] = None
+      elif lease.node_id == node_id or lease.expires < now:
+        acquired[guild_id] = lease.state
+        lease.node_id = node_id
+        lease.expires = expires
+    return kept, acquired
+
+  async def heartbeat(self, handler):
+    """
+    Renews the leases of the owned guilds, stores their snapshots and
+    acquires free leases.
+    """
+
+    snapshots = self._collect_snapshots(handler)
+    guild_ids = set(handler.cluster_guild_ids())
+    kept, acquired = await self.worker.run(
+      self._heartbeat, frozenset(self.owned), guild_ids, snapshots, time.time())
+    for guild_id, (state, encoded) in snapshots.items():
+      self._snapshots[guild_id] = encoded
+
+    lost = self.owned - kept
+    self.owned = kept | set(acquired)
+    for guild_id in lost:
+      logger.warning('Lost the lease of guild {}'.format(guild_id))
+      self._snapshots.pop(guild_id, None)
+      await handler.guild_lost(guild_id)
+    for guild_id, state in acquired.items():
+      logger.info('Node {} acquired guild {}{}'.format(
+        self.node_id, guild_id, ' (failover)' if state else ''))
+      self._snapshots.pop(guild_id, None)
+      try:
+        await handler.guild_acquired(guild_id, state)
+      except Exception:
+        logger.exception('Unable to take over guild {}'.format(guild_id))
+
+  def start(self, handler):
+    """
+    Starts sending heartbeats in the background until #stop() is called.
+    """
+
+    if self._task is None:
+      self._task = asyncio.ensure_future(self._run(handler))
+
+  async def _run(self, handler):
+    while True:
+      delay = self.heartbeat_interval
+      try:
+        await self.heartbeat(handler)
+      except asyncio.CancelledError:
+        raise
+      except orm.TransactionError as exc:
+        # Another node changed the same leases, try again soon.
+        logger.warning('Cluster heartbeat conflicted with another node: {}'.format(exc))
+        delay = random.uniform(0, self.heartbeat_interval / 2)
+      except Exception:
+        logger.exception('Cluster heartbeat failed')
+      await asyncio.sleep(delay)
+
+  def stop(self):
+    if self._task:
+      self._task.cancel()
+      self._task = None
+
+  def _release(self, owned, snapshots):
+    node_id = self.node_id
+    owned = set(owned)
+    for lease in Lease.select(lambda x: x.node_id == node_id):
+      if lease.guild_id not in owned:
+        continue
+      if lease.guild_id in snapshots:
+        lease.state = snapshots[lease.guild_id][0]
+      lease.expires = 0.0
+
+  async def release(self, handler):
+    """
+    Stops the heartbeats and releases all leases after storing the current
+    snapshots, so that other nodes can take over the guilds right away.
+    """
+
+    self.stop()
+    owned = list(self.owned)
+    snapshots = self._collect_snapshots(handler)
+    self.owned = set()
+    await self.worker.run(self._release, owned, snapshots)
+
+  def close(self):
+    """
+    Releases all leases without updating the snapshots. Can be called after
+    the event loop was closed.
+    """
+
+    self.stop()
+    owned, self.owned = list(self.owned), set()
+    with orm.db_session:
+      self._release(owned, {})
@@ -0,0 +1,169 @@
+
+from pony import orm
+from quel.providers import Song
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TrackIndex:
+  """
+  A full-text index of played songs, stored in the #Track table and an
+  SQLite FTS5 table that is kept in sync with triggers. Songs are buffered
+  by #add() and written in batches. At most *max_tracks* tracks are kept,
+  the least recently played ones are evicted first.
+
+  The index is only available with the SQLite provider and if the SQLite
+  library supports FTS5, otherwise #available is `False` and the index does
+  nothing. Reads and writes are executed by the #DatabaseWorker *worker*.
+  """
+
+  fields = ['url', 'provider_id', 'title', 'artist', 'album', 'genre',
+            'image_url', 'stream_url', 'duration']
+  text_fields = ['title', 'artist', 'album', 'genre', 'provider_id']
+
+  def __init__(self, db, worker, max_tracks=100000, batch_size=200, flush_interval=5.0):
+    self.db = db
+    self.worker = worker
+    self.max_tracks = max_tracks
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.available = False
+    self._pending = {}
+    self._handle = None
+
+  @orm.db_session
+  def setup(self):
+    """
+    Creates the FTS table and the triggers that keep it in sync with the
+    #Track table. Must be called after the mapping was generated.
+    """
+
+    if self.db.provider_name != 'sqlite':
+      return
+    text_fields = ', '.join(self.text_fields)
+    new_fields = ', '.join('new.' + x for x in self.text_fields)
+    old_fields = ', '.join('old.' + x for x in self.text_fields)
+    con = self.db.get_connection()
+    try:
+      con.execute('CREATE VIRTUAL TABLE IF NOT EXISTS "Track_fts" USING fts5('
+        '{}, content="Track", content_rowid="id")'.format(text_fields))
+    except Exception as exc:
+      logger.warning('Local track index not available: {}'.format(exc))
+      return
+    con.executescript('''
+      CREATE TRIGGER IF NOT EXISTS "Track_ai" AFTER INSERT ON "Track" BEGIN
+        INSERT INTO "Track_fts"(rowid, {fields}) VALUES (new.id, {new});
+      END;
+      CREATE TRIGGER IF NOT EXISTS "Track_ad" AFTER DELETE ON "Track" BEGIN
+        INSERT INTO "Track_fts"("Track_fts", rowid, {fields}) VALUES ('delete', old.id, {old});
+      END;
+      CREATE TRIGGER IF NOT EXISTS "Track_au" AFTER UPDATE OF {fields} ON "Track" BEGIN
+        INSERT INTO "Track_fts"("Track_fts", rowid, {fields}) VALUES ('delete', old.id, {old});
+        INSERT INTO "Track_fts"(rowid, {fields}) VALUES (new.id, {new});
+      END;
+    '''.format(fields=text_fields, new=new_fields, old=old_fields))
+    self.available = True
+
+  def add(self, song, provider_id):
+    """
+    Records that *song* has been played. The song is written with the next
+    batch, which is written when *batch_size* songs are pending or after
+    *flush_interval* seconds.
+    """
+
+    if not self.available:
+      return
+    row = {k: getattr(song, k, None) for k in self.fields}
+    row['provider_id'] = provider_id
+    self._pending[song.url] = row
+    if len(self._pending) >= self.batch_size:
+      self.flush()
+    elif self._handle is None:
+      loop = asyncio.get_event_loop()
+      self._handle = loop.call_later(self.flush_interval, self.flush)
+
+  def flush(self):
+    if self._handle is not None:
+      self._handle.cancel()
+      self._handle = None
+    pending, self._pending = self._pending, {}
+    if pending:
+      future = self.worker.run(self._write, list(pending.values()))
+      future.add_done_callback(self._written)
+
+  @staticmethod
+  def _written(future):
+    if not future.cancelled() and future.exception():
+      logger.error('Unable to write tracks to the index', exc_info=future.exception())
+
+  @orm.db_session
+  def _write(self, rows):
+    now = time.time()
+    params = []
+    for row in rows:
+      values = [row[k] or '' for k in self.fields]
+      values[self.fields.index('duration')] = self._int_or_none(row['duration'])
+      params.append(values + [now])
+    columns = ', '.join(self.fields)
+    updates = ', '.join('{0}=excluded.{0}'.format(k) for k in self.fields if k != 'url')
+    con = self.db.get_connection()
+    con.executemany(
+      'INSERT INTO "Track"({columns}, last_played, play_count) VALUES ({marks}, ?, 1) '
+      'ON CONFLICT(url) DO UPDATE SET {updates}, last_played=excluded.last_played, '
+      'play_count=play_count+1'.format(
+        columns=columns, marks=', '.join('?' * len(self.fields)), updates=updates),
+      params)
+    count = con.execute('SELECT COUNT(*) FROM "Track"').fetchone()[0]
+    if count > self.max_tracks:
+      con.execute('DELETE FROM "Track" WHERE id IN (SELECT id FROM "Track" '
+        'ORDER BY last_played LIMIT ?)', (count - self.max_tracks,))
+
+  @staticmethod
+  def _int_or_none(value):
+    try:
+      return int(value)
+    except (TypeError, ValueError):
+      return None
+
+  @staticmethod
+  def _match_expression(term):
+    # Every word must match as a prefix. Quoting the words escapes FTS
+    # syntax in the search term.
+    words = ['"{}"*'.format(x.replace('"', '""')) for x in term.split()]
+    return ' '.join(words)
+
+  async def search(self, term, max_results):
+    """
+    Returns a list of `(provider_id, song)` tuples for the tracks that match
+    *term*, best matches first. The songs are partial, so their provider
+    resolves them again before they are played.
+    """
+
+    expression = self._match_expression(term)
+    if not self.available or not expression:
+      return []
+    # Pending tracks are written before the search as the worker executes
+    # operations in order.
+    self.flush()
+    return await self.worker.run(self._search, expression, max_results)
+
+  @orm.db_session
+  def _search(self, expression, max_results):
+    con = self.db.get_connection()
+    rows = con.execute(
+      'SELECT {} FROM "Track_fts" JOIN "Track" ON "Track".id = "Track_fts".rowid '
+      'WHERE "Track_fts" MATCH ? ORDER BY rank LIMIT ?'.format(
+        ', '.join('"Track".' + k for k in self.fields)),
+      (expression, max_results)).fetchall()
+    results = []
+    for row in rows:
+      data = dict(zip(self.fields, row))
+      provider_id = data.pop('provider_id')
+      if data['duration'] is None:
+        data['duration'] = ''
+      results.append((provider_id, Song(partial=True, **data)))
+    return results
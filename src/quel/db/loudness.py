@@ -0,0 +1,136 @@
+
+from .models import Loudness
+from quel.core.stats import stats
+from quel.core.utils import SingleFlight, TTLCache
+from urllib.parse import urlparse
+
+import asyncio
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LoudnessAnalyzer:
+  """
+  Measures the integrated loudness (EBU R128) of tracks with FFmpeg and
+  stores it in the #Loudness table, so that every track is analyzed only
+  once. The gain that brings a track to *target* LUFS is applied as a fixed
+  factor when the track is played (see #TrackedVolumeTransformer).
+
+  At most *max_concurrent* analyses run at the same time and only the first
+  *max_seconds* of a track are analyzed. If #enabled is `False`, no gain is
+  returned at all.
+  """
+
+  # discord.py clamps the volume to 2.0, which includes the gain (see
+  # #TrackedVolumeTransformer), so a larger gain would have no effect.
+  min_gain = 0.25
+  max_gain = 2.0
+
+  # Matches the integrated loudness in the output of the ebur128 filter.
+  _integrated = re.compile(r'I:\s+(-?[\d.]+) LUFS')
+
+  def __init__(self, worker, target=-16.0, max_concurrent=2, max_seconds=600,
+               ffmpeg='ffmpeg'):
+    self.worker = worker
+    self.target = target
+    self.max_concurrent = max_concurrent
+    self.max_seconds = max_seconds
+    self.ffmpeg = ffmpeg
+    self.enabled = True
+    self.available = True
+    self._cache = TTLCache(ttl=24 * 3600, maxsize=10000)
+    self._flights = SingleFlight()
+    self._semaphore = None
+
+  def gain_for(self, loudness):
+    gain = 10 ** ((self.target - loudness) / 20)
+    return max(self.min_gain, min(self.max_gain, gain))
+
+  @staticmethod
+  def _load(url):
+    entry = Loudness.get(url=url)
+    return entry.loudness if entry else None
+
+  @staticmethod
+  def _store(url, loudness):
+    entry = Loudness.get(url=url)
+    if entry:
+      entry.loudness = loudness
+      entry.analyzed = time.time()
+    else:
+      Loudness(url=url, loudness=loudness, analyzed=time.time())
+
+  async def cached_gain(self, url):
+    """
+    Returns the gain for the track at *url* if it has been analyzed before,
+    otherwise `None`.
+    """
+
+    if not self.enabled:
+      return None
+    loudness = self._cache.get(url)
+    if loudness is None:
+      loudness = await self.worker.run(self._load, url)
+      if loudness is None:
+        return None
+      self._cache.set(url, loudness)
+    return self.gain_for(loudness)
+
+  async def analyze(self, url, stream_url):
+    """
+    Returns the gain for the track at *url*, analyzing its *stream_url* if
+    it has not been analyzed before. Concurrent calls for the same track
+    share one analysis.
+    """
+
+    gain = await self.cached_gain(url)
+    if gain is not None or not self.enabled or not self.available:
+      return gain
+    loudness = await self._flights.do(url, self._analyze, url, stream_url)
+    return self.gain_for(loudness)
+
+  async def _analyze(self, url, stream_url):
+    if self._semaphore is None:
+      self._semaphore = asyncio.Semaphore(self.max_concurrent)
+    async with self._semaphore:
+      started = time.perf_counter()
+      loudness = await self.measure(stream_url)
+      stats.incr('loudness.analyzed')
+      logger.info('Loudness of {}: {:.1f} LUFS ({:.1f}s)'.format(
+        url, loudness, time.perf_counter() - started))
+    self._cache.set(url, loudness)
+    await self.worker.run(self._store, url, loudness)
+    return loudness
+
+  async def measure(self, stream_url):
+    """
+    Runs FFmpeg's ebur128 filter over *stream_url* and returns the
+    integrated loudness in LUFS.
+    """
+
+    command = [self.ffmpeg, '-nostdin', '-hide_banner', '-nostats']
+    if urlparse(stream_url).scheme in ('http', 'https'):
+      command += ['-reconnect', '1', '-reconnect_streamed', '1']
+    command += ['-t', str(self.max_seconds), '-i', stream_url, '-vn',
+                '-af', 'ebur128', '-f', 'null', '-']
+    try:
+      proc = await asyncio.create_subprocess_exec(*command,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    except FileNotFoundError:
+      self.available = False
+      raise RuntimeError('FFmpeg not found, loudness analysis disabled')
+    # The filter logs a line for every 100ms frame, the integrated loudness
+    # of the summary at the end is the last value. The lines are not
+    # buffered, so the output of a long track does not pile up.
+    loudness = None
+    async for line in proc.stderr:
+      match = self._integrated.search(line.decode('utf8', 'replace'))
+      if match:
+        loudness = float(match.group(1))
+    await proc.wait()
+    if proc.returncode != 0 or loudness is None:
+      raise RuntimeError('FFmpeg could not measure the loudness (exit code {})'.format(proc.returncode))
+    return loudness
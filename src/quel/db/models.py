@@ -1,18 +1,155 @@
 
 from . import db
 from .utils import durable_member
-from quel.providers import ErrorProviderInstance, Song as _Song
+from quel.core.audio import TrackedVolumeTransformer
+from quel.core.queue import SongQueue
+from quel.providers import ErrorProviderInstance
+from quel.providers.pool import pool
 from pony import orm
+from urllib.parse import urlparse
 
 import asyncio
 import datetime
 import discord
+import enum
+import sys
+import time
 
 
-class QueuedSong(_Song):
-  user_id: str
-  provider_id: str
-  date_queued: str = lambda: str(datetime.datetime.now())
+def _intern(value):
+  return sys.intern(value) if isinstance(value, str) else value
+
+
+def _duration(value):
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    return ''
+
+
+def _timestamp(value):
+  # Queues exported by older versions store the date as a string.
+  if isinstance(value, str):
+    try:
+      return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f').timestamp()
+    except ValueError:
+      return time.time()
+  return time.time() if value is None else float(value)
+
+
+class QueuedSong:
+  """
+  A song in the queue of a guild. Queues can hold many thousands of songs,
+  so this is a compact, slotted version of #Song. Strings that repeat across
+  songs (artist, album, genre and provider ID) are interned, the user ID is
+  an integer and the date is a timestamp.
+  """
+
+  __slots__ = ('url', 'stream_url', 'title', '_artist', '_album', '_genre',
+               'image_url', 'duration', 'purchase_url', 'partial', 'user_id',
+               '_provider_id', 'date_queued', 'position', 'retries', 'gain')
+
+  fields = ('url', 'stream_url', 'title', 'artist', 'genre', 'album',
+            'image_url', 'duration', 'purchase_url', 'partial', 'user_id',
+            'provider_id', 'date_queued', 'position', 'retries', 'gain')
+
+  def __init__(self, url, title, *, user_id, provider_id, stream_url='',
+               artist='', genre='', album='', image_url='', duration='',
+               purchase_url='', partial=False, date_queued=None, position=0.0,
+               retries=0, gain=None):
+    self.url = url
+    self.stream_url = stream_url
+    self.title = title
+    self.artist = artist
+    self.album = album
+    self.genre = genre
+    self.image_url = image_url
+    self.duration = _duration(duration)
+    self.purchase_url = purchase_url
+    self.partial = partial
+    self.user_id = int(user_id)
+    self.provider_id = provider_id
+    self.date_queued = _timestamp(date_queued)
+    self.position = position
+    self.retries = retries
+    #: The loudness normalization factor, `None` if not yet known.
+    self.gain = gain
+
+  def __repr__(self):
+    return 'QueuedSong(url={!r}, title={!r}, provider_id={!r})'.format(
+      self.url, self.title, self.provider_id)
+
+  def _interned(name):
+    def getter(self):
+      return getattr(self, name)
+    def setter(self, value):
+      setattr(self, name, _intern(value))
+    return property(getter, setter)
+
+  artist = _interned('_artist')
+  album = _interned('_album')
+  genre = _interned('_genre')
+  provider_id = _interned('_provider_id')
+  del _interned
+
+  def asdict(self):
+    return {k: getattr(self, k) for k in self.fields}
+
+
+class Track(db.Entity):
+  """
+  A song that has been played. Tracks are indexed for full-text search by the
+  #TrackIndex, which also inserts and evicts them.
+  """
+
+  url = orm.Required(str, unique=True)
+  provider_id = orm.Required(str)
+  title = orm.Required(str)
+  artist = orm.Optional(str)
+  album = orm.Optional(str)
+  genre = orm.Optional(str)
+  image_url = orm.Optional(str)
+  stream_url = orm.Optional(str)
+  duration = orm.Optional(int)
+  last_played = orm.Required(float, index=True)
+  play_count = orm.Required(int, default=1)
+
+
+class Loudness(db.Entity):
+  """
+  The integrated loudness of a track in LUFS, measured by the
+  #LoudnessAnalyzer.
+  """
+
+  url = orm.PrimaryKey(str)
+  loudness = orm.Required(float)
+  analyzed = orm.Required(float)
+
+
+class Lease(db.Entity):
+  """
+  The ownership of a guild by one node of a cluster (see #Cluster). The
+  owner renews the lease before it expires and stores the playback state of
+  the guild with it, so that another node can continue when the owner
+  fails.
+  """
+
+  guild_id = orm.PrimaryKey(int, size=64)
+  node_id = orm.Required(str)
+  expires = orm.Required(float, index=True)
+  state = orm.Optional(orm.Json, lazy=True, nullable=True)
+
+
+class PlaybackState(enum.Enum):
+  """
+  The states of the voice/playback lifecycle of a #Guild.
+  """
+
+  idle = 0
+  connecting = 1
+  resolving = 2
+  playing = 3
+  paused = 4
 
 
 class Guild(db.Entity):
@@ -21,27 +158,123 @@ class Guild(db.Entity):
   volume = orm.Required(float)
   initialized = durable_member(bool)
   providers = durable_member(list)
-  queue = durable_member(list)
+  provider_options = durable_member(dict)
+  queue = durable_member(SongQueue)
   voice_client = durable_member(lambda: None)
-  lock = durable_member(asyncio.Lock)
+  current_song = durable_member(lambda: None)
+  last_event = durable_member(lambda: None)
+  state = durable_member(lambda: PlaybackState.idle)
+  generation = durable_member(int)
 
   def __init__(self, id, config=None):
     super().__init__(id=id, config=config or {}, volume=0.5)
 
+  def get_provider_options(self, provider):
+    return {k: self.config.get(provider.id + '.' + k)
+            for k in provider.get_option_names()}
+
+  def _instantiate_provider(self, logger, provider, options):
+    """
+    Returns the instance of *provider* for *options* from the shared #pool.
+    If the provider can not be instantiated, an #ErrorProviderInstance that
+    is specific to this guild is returned.
+    """
+
+    try:
+      return pool.acquire(provider, options)
+    except BaseException as exc:
+      logger.exception('Exception instantiating provider "{}"'.format(provider.name))
+      return ErrorProviderInstance(provider, '{}: {}'.format(type(exc).__name__, str(exc)))
+
+  def _rebuild_provider(self, logger, provider, options, replaced):
+    try:
+      old, instance = pool.rebuild(provider, options)
+    except BaseException as exc:
+      logger.exception('Exception instantiating provider "{}"'.format(provider.name))
+      return ErrorProviderInstance(provider, '{}: {}'.format(type(exc).__name__, str(exc)))
+    if old is not None:
+      replaced[old] = instance
+      if not any(x is old for x in self.providers):
+        pool.acquire(provider, options)  # The references of the others moved.
+    return instance
+
   def init_providers(self, logger, providers, force=False):
+    """
+    Instantiates the providers once. With *force*, the shared instances are
+    rebuilt for all guilds that use them. Returns a dictionary that maps the
+    replaced instances to the new ones, which must be passed to
+    #replace_providers() of all other guilds.
+    """
+
     if self.initialized and not force:
-      return
-    self.providers = []
+      return {}
+    instances = []
+    options = {}
+    replaced = {}
     for provider in providers:
-      options = {k: self.config.get(provider.id + '.' + k)
-                 for k in provider.get_option_names()}
-      try:
-        instance = provider.instantiate(options)
-      except BaseException as exc:
-        logger.exception('Exception instantiating provider "{}"'.format(provider.name))
-        instance = ErrorProviderInstance(provider, '{}: {}'.format(type(exc).__name__, str(exc)))
-      self.providers.append(instance)
+      options[provider.id] = self.get_provider_options(provider)
+      if force:
+        instances.append(self._rebuild_provider(logger, provider, options[provider.id], replaced))
+      else:
+        instances.append(self._instantiate_provider(logger, provider, options[provider.id]))
+    for instance in self.providers:
+      pool.release(instance)  # Ignores the replaced instances.
+    self.providers = instances
+    self.provider_options = options
     self.initialized = True
+    return replaced
+
+  def replace_providers(self, replaced):
+    """
+    Switches to the new instances of shared providers that were rebuilt by
+    #init_providers() of another guild.
+    """
+
+    if any(x in replaced for x in self.providers):
+      self.providers = [replaced.get(x, x) for x in self.providers]
+
+  def update_providers(self, logger, providers, key=None):
+    """
+    Re-instantiates only the providers whose options changed since they were
+    instantiated. If a config *key* is specified, only the provider with the
+    matching prefix is checked. The new list of instances replaces the old
+    one at once, calls that are in progress on the old instances can finish.
+    Returns the providers that were re-instantiated.
+    """
+
+    if not self.initialized:
+      self.init_providers(logger, providers)
+      return list(providers)
+    prefix = key.partition('.')[0] if key else None
+    instances = list(self.providers)
+    options = dict(self.provider_options)
+    changed = []
+    for index, provider in enumerate(providers):
+      if prefix is not None and provider.id != prefix:
+        continue
+      new_options = self.get_provider_options(provider)
+      if new_options == options.get(provider.id):
+        continue
+      options[provider.id] = new_options
+      instances[index] = self._instantiate_provider(logger, provider, new_options)
+      changed.append(provider)
+    released = [x for x in self.providers if x not in instances]
+    self.providers = instances
+    self.provider_options = options
+    for instance in released:
+      pool.release(instance)
+    return changed
+
+  def transition_to(self, state):
+    """
+    Starts a new transition of the playback that enters *state* and returns
+    its generation. Operations of older generations that are still in
+    progress must not change the playback anymore.
+    """
+
+    self.generation += 1
+    self.state = state
+    return self.generation
 
   def find_provider(self, provider_id):
     for provider in self.providers:
@@ -49,19 +282,82 @@ class Guild(db.Entity):
         return provider
     return None
 
-  def queue_song(self, song):
+  def queue_song(self, song, dedup=True):
+    """
+    Appends *song* to the queue. Returns `False` if the song is already
+    queued and *dedup* is enabled.
+    """
+
     assert isinstance(song, QueuedSong)
-    self.queue.append(song)
+    return self.queue.append(song, dedup)
+
+  @property
+  def position(self):
+    """
+    The playback position of the current song in seconds.
+    """
+
+    source = self.voice_client.source if self.voice_client else None
+    if isinstance(source, TrackedVolumeTransformer):
+      return source.position
+    return 0.0
+
+  async def complete_song(self, song):
+    """
+    Completes a partial *song* in place using the provider that it was
+    queued with.
+    """
+
+    if not song.partial:
+      return
+    provider = self.find_provider(song.provider_id)
+    if not provider:
+      return
+    resolved = await provider.complete_song(song)
+    fields = resolved.asdict()
+    fields['partial'] = False
+    self.queue.update(song, fields)
+
+  async def start_stream(self, stream_url, after=None, position=0.0, gain=1.0):
+    """
+    Starts playing *stream_url* at *position* seconds, with the loudness
+    normalization factor *gain*. Remote streams are opened with FFmpeg's
+    reconnect options so short network interruptions do not end the stream.
+    Returns the #TrackedVolumeTransformer.
+    """
 
-  async def start_stream(self, stream_url, after=None):
     assert self.voice_client
-    loop = asyncio.get_running_loop()
-    source = discord.FFmpegPCMAudio(stream_url, options='-bufsize 1024k')
-    source = discord.PCMVolumeTransformer(source, self.volume)
+    before_options = []
+    if urlparse(stream_url).scheme in ('http', 'https'):
+      before_options.append('-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5')
+    if position:
+      before_options.append('-ss {:.2f}'.format(position))
+    source = discord.FFmpegPCMAudio(stream_url,
+      before_options=' '.join(before_options) or None,
+      options='-bufsize 1024k')
+    source = TrackedVolumeTransformer(source, self.volume, offset=position, gain=gain)
     self.voice_client.play(source, after=after)
+    return source
 
   def set_volume(self, volume):
-    volume = max(0.0, min(1.0, float(volume)))
-    self.volume = volume
+    """
+    Stores the volume. Must be called in a database session, the stream is
+    updated with #apply_volume().
+    """
+
+    self.volume = max(0.0, min(1.0, float(volume)))
+
+  def apply_volume(self):
     if self.voice_client and self.voice_client.source:
-      self.voice_client.source.volume = volume
+      self.voice_client.source.volume = self.volume
+
+  def update_config(self, key, value=None):
+    """
+    Sets the config *key* to *value*, or removes it if *value* is `None`.
+    Must be called in a database session.
+    """
+
+    if value is None:
+      self.config.pop(key, None)
+    else:
+      self.config[key] = value
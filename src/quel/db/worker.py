@@ -0,0 +1,164 @@
+
+from pony import orm
+
+import asyncio
+import collections
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+#: Pragmas that are applied to every SQLite connection. WAL mode lets reads
+#: proceed while a write is in progress and with `synchronous=NORMAL` a
+#: commit only needs an fsync on checkpoints. They can be overwritten with
+#: "pragmas" in the "dbConfig".
+SQLITE_PRAGMAS = collections.OrderedDict([
+  ('journal_mode', 'wal'),
+  ('synchronous', 'normal'),
+  ('busy_timeout', 5000),
+  ('cache_size', -16000),
+  ('temp_store', 'memory'),
+])
+
+
+def configure_sqlite(db, pragmas=None):
+  """
+  Applies #SQLITE_PRAGMAS, updated with *pragmas*, to every SQLite connection
+  of *db*. Must be called before the database is bound.
+  """
+
+  values = collections.OrderedDict(SQLITE_PRAGMAS)
+  values.update(pragmas or {})
+
+  @db.on_connect(provider='sqlite')
+  def apply_pragmas(db, connection):
+    cursor = connection.cursor()
+    for key, value in values.items():
+      cursor.execute('PRAGMA {}={}'.format(key, value))
+
+
+class _Job:
+
+  __slots__ = ('func', 'args', 'kwargs', 'future', 'loop', 'queued')
+
+  def __init__(self, func, args, kwargs, future, loop):
+    self.func = func
+    self.args = args
+    self.kwargs = kwargs
+    self.future = future
+    self.loop = loop
+    self.queued = time.perf_counter()
+
+
+class DatabaseWorker:
+  """
+  Runs database operations on a dedicated thread so that the event loop is
+  never blocked by a slow query or fsync. Operations that are queued while
+  the thread is busy are executed together in a single #orm.db_session and
+  thus committed in one transaction. If one of them fails, the batch is
+  rolled back and the operations are repeated one at a time.
+
+  The time from queueing an operation until its result is available is
+  recorded for the last *latency_samples* operations (see #latencies()).
+  """
+
+  def __init__(self, batch_size=64, latency_samples=2048):
+    self.batch_size = batch_size
+    self.batches = 0
+    self.operations = 0
+    self._latencies = collections.deque(maxlen=latency_samples)
+    self._lock = threading.Lock()
+    self._queue = queue.Queue()
+    self._thread = None
+
+  def start(self):
+    if self._thread is None:
+      self._thread = threading.Thread(target=self._run, name='quel-db', daemon=True)
+      self._thread.start()
+
+  def stop(self):
+    """
+    Executes the remaining operations and stops the thread.
+    """
+
+    if self._thread is not None:
+      self._queue.put(None)
+      self._thread.join()
+      self._thread = None
+
+  def run(self, func, *args, **kwargs):
+    """
+    Queues a call to *func* with the specified arguments and returns a future
+    for its result. The function is called in a database session on the
+    worker thread. Entities that it returns can still be read, but no longer
+    be modified.
+    """
+
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    self.start()
+    self._queue.put(_Job(func, args, kwargs, future, loop))
+    return future
+
+  def latencies(self, percentiles=(50, 95, 99)):
+    """
+    Returns a list of the latencies in milliseconds at the specified
+    *percentiles* of the recently executed operations.
+    """
+
+    with self._lock:
+      samples = sorted(self._latencies)
+    if not samples:
+      return [0.0 for _ in percentiles]
+    return [samples[min(len(samples) - 1, int(len(samples) * p / 100))] * 1000
+            for p in percentiles]
+
+  def _run(self):
+    stop = False
+    while not stop:
+      jobs = [self._queue.get()]
+      while len(jobs) < self.batch_size:
+        try:
+          jobs.append(self._queue.get_nowait())
+        except queue.Empty:
+          break
+      if None in jobs:
+        stop = True
+        jobs = [x for x in jobs if x is not None]
+      if jobs:
+        self.batches += 1
+        self._execute(jobs)
+
+  def _execute(self, jobs):
+    try:
+      with orm.db_session:
+        results = [job.func(*job.args, **job.kwargs) for job in jobs]
+    except Exception as exc:
+      if len(jobs) == 1:
+        self._resolve(jobs[0], None, exc)
+      else:
+        logger.warning('Database batch of {} operations failed, retrying them '
+          'one at a time: {}'.format(len(jobs), exc))
+        for job in jobs:
+          self._execute([job])
+      return
+    for job, result in zip(jobs, results):
+      self._resolve(job, result, None)
+
+  def _resolve(self, job, result, exc):
+    with self._lock:
+      self.operations += 1
+      self._latencies.append(time.perf_counter() - job.queued)
+    def callback():
+      if job.future.cancelled():
+        return
+      if exc is not None:
+        job.future.set_exception(exc)
+      else:
+        job.future.set_result(result)
+    try:
+      job.loop.call_soon_threadsafe(callback)
+    except RuntimeError:
+      pass  # The event loop is closed.
@@ -0,0 +1,8 @@
+
+"""
+An offline load test for Quel. It runs #QuelBehavior against fake Discord
+objects and a local HTTP server with generated audio files, so that many
+guilds can be simulated on a single machine. Run it with
+
+    $ python -m quel.loadtest --guilds 200 --duration 120
+"""
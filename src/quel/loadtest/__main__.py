@@ -0,0 +1,32 @@
+
+from .harness import run
+
+import argparse
+import asyncio
+import logging
+
+
+def main():
+  parser = argparse.ArgumentParser(prog='python -m quel.loadtest',
+    description='Runs the bot against local Discord and media stand-ins.')
+  parser.add_argument('--guilds', type=int, default=100)
+  parser.add_argument('--duration', type=float, default=60.0)
+  parser.add_argument('--songs', type=int, default=5, help='Number of distinct media files.')
+  parser.add_argument('--song-length', type=int, default=20, help='Length of the media files in seconds.')
+  parser.add_argument('--songs-per-guild', type=int, default=3)
+  parser.add_argument('--ramp', type=float, default=5.0, help='Seconds over which the guilds start playing.')
+  parser.add_argument('--connect-latency', type=float, default=0.05)
+  parser.add_argument('--seed', type=int)
+  parser.add_argument('-v', '--verbose', action='store_true')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+  report = asyncio.get_event_loop().run_until_complete(run(
+    guilds=args.guilds, duration=args.duration, songs=args.songs,
+    song_length=args.song_length, songs_per_guild=args.songs_per_guild,
+    ramp=args.ramp, connect_latency=args.connect_latency, seed=args.seed))
+  print(report)
+
+
+if __name__ == '__main__':
+  main()
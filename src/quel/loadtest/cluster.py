@@ -0,0 +1,170 @@
+
+"""
+Runs several cluster nodes as separate processes that share one SQLite
+database, kills one of them and checks that its guilds fail over to the
+other nodes with their stored state.
+
+    $ python -m quel.loadtest.cluster --nodes 3 --guilds 60
+
+The nodes do not connect to Discord. Every guild has a counter that its
+owner increments on every heartbeat and stores with the lease, a new owner
+continues from the stored value. Every third guild is idle and stores no
+state.
+"""
+
+from quel import db
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+def is_idle(guild_id):
+  return guild_id % 3 == 0
+
+
+class CounterNode:
+  """
+  The handler of a #db.Cluster in a node process. Prints the ownership
+  changes as JSON lines.
+  """
+
+  def __init__(self, node_id, guilds):
+    self.node_id = node_id
+    self.guilds = guilds
+    self.counters = {}
+
+  def emit(self, event, guild_id, **kwargs):
+    kwargs.update(event=event, node=self.node_id, guild=guild_id, time=time.time())
+    print(json.dumps(kwargs), flush=True)
+
+  def cluster_guild_ids(self):
+    return range(1, self.guilds + 1)
+
+  def cluster_snapshot(self, guild_id):
+    # Like #QuelBehavior.cluster_snapshot(), there is no state for idle
+    # guilds (every third guild).
+    if is_idle(guild_id):
+      return None
+    self.counters[guild_id] += 1
+    return {'counter': self.counters[guild_id]}
+
+  async def guild_acquired(self, guild_id, state):
+    self.counters[guild_id] = state['counter'] if state else 0
+    self.emit('acquired', guild_id, counter=self.counters[guild_id])
+
+  async def guild_lost(self, guild_id):
+    self.counters.pop(guild_id, None)
+    self.emit('lost', guild_id)
+
+
+def run_node(args):
+  db.configure_sqlite(db.db)
+  db.db.bind(provider='sqlite', filename=args.db, create_db=True)
+  db.db.generate_mapping(create_tables=True)
+  cluster = db.Cluster(db.worker, args.node, lease_ttl=args.lease_ttl,
+    heartbeat_interval=args.heartbeat, acquire_batch=max(1, args.guilds // args.nodes))
+  node = CounterNode(args.node, args.guilds)
+  loop = asyncio.get_event_loop()
+  cluster.start(node)
+  try:
+    loop.run_forever()
+  except KeyboardInterrupt:
+    cluster.close()
+
+
+def run_test(args):
+  directory = tempfile.mkdtemp(prefix='quel-cluster-')
+  database = os.path.join(directory, 'db.sqlite')
+  events = []
+  lock = threading.Lock()
+
+  def read(proc):
+    for line in proc.stdout:
+      with lock:
+        events.append(json.loads(line))
+
+  procs = {}
+  for i in range(args.nodes):
+    node_id = 'node{}'.format(i)
+    command = [sys.executable, '-m', 'quel.loadtest.cluster', '--node', node_id,
+      '--db', database, '--nodes', str(args.nodes), '--guilds', str(args.guilds),
+      '--lease-ttl', str(args.lease_ttl), '--heartbeat', str(args.heartbeat)]
+    procs[node_id] = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    threading.Thread(target=read, args=(procs[node_id],), daemon=True).start()
+
+  def owners():
+    result = {}
+    with lock:
+      for ev in events:
+        if ev['event'] == 'acquired':
+          result[ev['guild']] = ev['node']
+        elif result.get(ev['guild']) == ev['node']:
+          del result[ev['guild']]
+    return result
+
+  try:
+    time.sleep(args.kill_after)
+    before = owners()
+    victim = 'node0'
+    orphaned = {k for k, v in before.items() if v == victim}
+    print('Guilds per node: {}'.format(
+      {k: list(before.values()).count(k) for k in sorted(procs)}))
+    print('Killing {} with {} guilds ...'.format(victim, len(orphaned)))
+    killed = time.time()
+    procs[victim].kill()
+    procs[victim].wait()
+    with lock:
+      for guild_id in orphaned:
+        events.append({'event': 'lost', 'node': victim, 'guild': guild_id, 'time': killed})
+
+    deadline = killed + args.lease_ttl + args.heartbeat * 3
+    while time.time() < deadline and len(owners()) < args.guilds:
+      time.sleep(0.5)
+  finally:
+    for proc in procs.values():
+      if proc.poll() is None:
+        proc.terminate()
+        proc.wait()
+
+  after = owners()
+  with lock:
+    failovers = [ev for ev in events if ev['event'] == 'acquired'
+                 and ev['guild'] in orphaned and ev['time'] > killed]
+  print('Guilds owned after failover: {} of {}'.format(len(after), args.guilds))
+  print('Guilds still owned by {}: {}'.format(victim, sum(1 for v in after.values() if v == victim)))
+  if failovers:
+    print('Failover time: {:.1f}s to {:.1f}s'.format(
+      min(x['time'] for x in failovers) - killed, max(x['time'] for x in failovers) - killed))
+    print('Guilds that continued from their stored state: {} of {}'.format(
+      sum(1 for x in failovers if x['counter'] > 0),
+      sum(1 for x in orphaned if not is_idle(x))))
+  ok = len(after) == args.guilds and victim not in after.values()
+  print('OK' if ok else 'FAILED')
+  return 0 if ok else 1
+
+
+def main():
+  parser = argparse.ArgumentParser(prog='python -m quel.loadtest.cluster')
+  parser.add_argument('--nodes', type=int, default=3)
+  parser.add_argument('--guilds', type=int, default=60)
+  parser.add_argument('--lease-ttl', type=float, default=6.0)
+  parser.add_argument('--heartbeat', type=float, default=2.0)
+  parser.add_argument('--kill-after', type=float, default=10.0)
+  parser.add_argument('--node', help=argparse.SUPPRESS)
+  parser.add_argument('--db', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+  if args.node:
+    run_node(args)
+  else:
+    sys.exit(run_test(args))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,242 @@
+
+"""
+Local stand-ins for the parts of Discord that #QuelBehavior talks to. They
+implement just enough of the discord.py interface for the bot to run against
+them without a network connection.
+"""
+
+from quel.core.client import Client
+
+import asyncio
+import itertools
+import threading
+import time
+
+_ids = itertools.count(100000)
+
+
+class FakeUser:
+
+  def __init__(self, name, bot=False):
+    self.id = next(_ids)
+    self.name = name
+    self.bot = bot
+    self.voice = None
+    self.mention = '<@{}>'.format(self.id)
+
+
+class FakeVoiceState:
+
+  def __init__(self, channel):
+    self.channel = channel
+
+
+class FakeMessage:
+
+  def __init__(self, channel, author, content, metrics=None):
+    self.id = next(_ids)
+    self.channel = channel
+    self.guild = channel.guild
+    self.author = author
+    self.content = content
+    self.attachments = []
+    self.embed = None
+    self._metrics = metrics
+
+  async def edit(self, content=None, embed=None):
+    if self._metrics:
+      self._metrics.api_calls += 1
+    self.content = content
+    self.embed = embed
+
+
+class FakeTextChannel:
+
+  def __init__(self, guild, name, metrics):
+    self.id = next(_ids)
+    self.guild = guild
+    self.name = name
+    self.topic = None
+    self.last_message_id = None
+    self.messages = []
+    self._metrics = metrics
+
+  async def send(self, content=None, embed=None, **kwargs):
+    self._metrics.api_calls += 1
+    message = FakeMessage(self, self.guild.me, content, self._metrics)
+    message.embed = embed
+    self.messages.append(message)
+    self.last_message_id = message.id
+    return message
+
+  async def get_message(self, message_id):
+    for message in self.messages:
+      if message.id == message_id:
+        return message
+    raise KeyError(message_id)
+
+
+class FakeVoiceChannel:
+
+  def __init__(self, guild, name, metrics):
+    self.id = next(_ids)
+    self.guild = guild
+    self.name = name
+    self.members = []
+    self._metrics = metrics
+
+  async def connect(self):
+    await asyncio.sleep(self._metrics.connect_latency)
+    self.members.append(self.guild.me)
+    return FakeVoiceClient(self, self._metrics)
+
+
+class FakeGuild:
+
+  def __init__(self, name, bot_user, metrics):
+    self.id = next(_ids)
+    self.name = name
+    self.me = FakeMember(bot_user, self)
+    self.text_channel = FakeTextChannel(self, 'music', metrics)
+    self.voice_channel = FakeVoiceChannel(self, 'Music', metrics)
+    self.channels = [self.text_channel, self.voice_channel]
+    self.voice_client = None
+
+
+class FakeMember(FakeUser):
+
+  def __init__(self, user, guild):
+    vars(self).update(vars(user))
+    self.guild = guild
+    self.nick = None
+
+  async def edit(self, nick=None):
+    self.nick = nick
+
+
+class FakeVoiceClient:
+  """
+  Plays audio sources like discord.py's #VoiceClient, but instead of sending
+  the encoded frames to Discord, it only reads them at real-time rate and
+  records the delivery timing in the #Metrics.
+  """
+
+  frame_length = 0.02
+
+  def __init__(self, channel, metrics):
+    self.channel = channel
+    self.guild = channel.guild
+    self.source = None
+    self._metrics = metrics
+    self._player = None
+    self._connected = True
+
+  def is_connected(self):
+    return self._connected
+
+  def is_playing(self):
+    return self._player is not None and self._player.is_alive() and not self._paused.is_set()
+
+  def is_paused(self):
+    return self._player is not None and self._paused.is_set()
+
+  def play(self, source, after=None):
+    self.source = source
+    self._end = threading.Event()
+    self._paused = threading.Event()
+    self._player = threading.Thread(target=self._run, args=(source, after), daemon=True)
+    self._player.start()
+
+  def _run(self, source, after):
+    error = None
+    stream = self._metrics.stream_started(self)
+    try:
+      next_time = time.perf_counter()
+      while not self._end.is_set():
+        if self._paused.is_set():
+          time.sleep(self.frame_length)
+          next_time = time.perf_counter()
+          continue
+        data = source.read()
+        if not data:
+          break
+        stream.frame(time.perf_counter())
+        next_time += self.frame_length
+        delay = next_time - time.perf_counter()
+        if delay > 0:
+          time.sleep(delay)
+    except Exception as exc:
+      error = exc
+    finally:
+      source.cleanup()
+      stream.finished()
+      if after:
+        after(error)
+
+  def pause(self):
+    if self._player:
+      self._paused.set()
+
+  def resume(self):
+    if self._player:
+      self._paused.clear()
+
+  def stop(self):
+    if self._player:
+      self._end.set()
+      self._paused.clear()
+
+  async def move_to(self, channel):
+    if self.guild.me in self.channel.members:
+      self.channel.members.remove(self.guild.me)
+    self.channel = channel
+    channel.members.append(self.guild.me)
+
+  async def disconnect(self, force=False):
+    self.stop()
+    self._connected = False
+    if self.guild.me in self.channel.members:
+      self.channel.members.remove(self.guild.me)
+
+
+class FakeApplicationInfo:
+
+  def __init__(self, id):
+    self.id = id
+
+
+class FakeDiscordClient:
+  """
+  Replaces the #discord.Client that the #Client wrapper delegates to.
+  """
+
+  def __init__(self, user, guilds):
+    self.user = user
+    self.guilds = guilds
+    self._channels = {}
+    for guild in guilds:
+      for channel in guild.channels:
+        self._channels[channel.id] = channel
+
+  async def application_info(self):
+    return FakeApplicationInfo(self.user.id)
+
+  def get_guild(self, guild_id):
+    return next((x for x in self.guilds if x.id == guild_id), None)
+
+  def get_channel(self, channel_id):
+    return self._channels.get(channel_id)
+
+  async def logout(self):
+    pass
+
+
+class FakeClient(Client):
+  """
+  A #Client that dispatches events to its handlers without connecting to
+  Discord.
+  """
+
+  def __init__(self, user, guilds):
+    super().__init__()
+    self._Client__client = FakeDiscordClient(user, guilds)
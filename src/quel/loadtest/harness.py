@@ -0,0 +1,195 @@
+
+from .fakes import FakeClient, FakeGuild, FakeMessage, FakeUser, FakeVoiceState
+from .media import MediaServer
+from quel import db
+from quel.core.client import prepare_message, prepare_ready
+
+import array
+import asyncio
+import logging
+import os
+import random
+import resource
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, p):
+  if not values:
+    return 0.0
+  values = sorted(values)
+  index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+  return values[index]
+
+
+def get_rss():
+  """
+  Returns the resident set size of the process in bytes.
+  """
+
+  try:
+    with open('/proc/self/statm') as fp:
+      return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (OSError, ValueError):
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StreamMetrics:
+
+  def __init__(self, metrics, guild_id):
+    self.metrics = metrics
+    self.guild_id = guild_id
+    self.last = None
+
+  def frame(self, now):
+    if self.last is None:
+      self.metrics.first_frame(self.guild_id, now)
+    else:
+      self.metrics.intervals.append(now - self.last)
+    self.metrics.frames += 1
+    self.last = now
+
+  def finished(self):
+    self.metrics.stream_finished(self.guild_id, self.last)
+
+
+class Metrics:
+  """
+  Collects the measurements of a load test run. Frame timings are recorded
+  from the player threads of the fake voice clients.
+  """
+
+  frame_length = 0.02
+
+  def __init__(self, connect_latency=0.05):
+    self.connect_latency = connect_latency
+    self.api_calls = 0
+    self.frames = 0
+    self.streams = 0
+    self.intervals = array.array('d')
+    self.gaps = array.array('d')
+    self.memory = []
+    self._last_frames = {}
+    self._lock = threading.Lock()
+
+  def stream_started(self, voice_client):
+    with self._lock:
+      self.streams += 1
+    return StreamMetrics(self, voice_client.guild.id)
+
+  def first_frame(self, guild_id, now):
+    with self._lock:
+      last = self._last_frames.pop(guild_id, None)
+      if last is not None:
+        self.gaps.append(now - last)
+
+  def stream_finished(self, guild_id, last):
+    if last is not None:
+      with self._lock:
+        self._last_frames[guild_id] = last
+
+  def sample_memory(self, elapsed):
+    self.memory.append((elapsed, get_rss()))
+
+  def report(self, cpu_seconds, wall_seconds, db_latencies=None):
+    stream_seconds = self.frames * self.frame_length
+    jitter = [abs(x - self.frame_length) * 1000 for x in self.intervals]
+    gaps = [x * 1000 for x in self.gaps]
+    lines = [
+      'Wall time:           {:.1f}s'.format(wall_seconds),
+      'Streams started:     {}'.format(self.streams),
+      'Audio delivered:     {:.1f}s ({} frames)'.format(stream_seconds, self.frames),
+      'Discord API calls:   {}'.format(self.api_calls),
+      'CPU time:            {:.2f}s'.format(cpu_seconds),
+    ]
+    if stream_seconds:
+      lines.append('CPU per stream:      {:.2f}% of a core'.format(cpu_seconds / stream_seconds * 100))
+    lines += [
+      'Frame jitter (ms):   mean {:.2f}, p50 {:.2f}, p99 {:.2f}, max {:.2f}'.format(
+        sum(jitter) / len(jitter) if jitter else 0.0,
+        percentile(jitter, 50), percentile(jitter, 99), max(jitter, default=0.0)),
+      'Transition gaps (ms): n={}, p50 {:.0f}, p99 {:.0f}, max {:.0f}'.format(
+        len(gaps), percentile(gaps, 50), percentile(gaps, 99), max(gaps, default=0.0)),
+    ]
+    if db_latencies:
+      lines.append('DB latency (ms):     p50 {:.1f}, p95 {:.1f}, p99 {:.1f}'.format(*db_latencies))
+    if self.memory:
+      (t0, m0), (t1, m1) = self.memory[0], self.memory[-1]
+      peak = max(m for _, m in self.memory)
+      growth = (m1 - m0) / (t1 - t0) if t1 > t0 else 0.0
+      lines.append('Memory (MiB):        start {:.1f}, end {:.1f}, peak {:.1f}, growth {:.2f} MiB/min'.format(
+        m0 / 2**20, m1 / 2**20, peak / 2**20, growth * 60 / 2**20))
+    return '\n'.join(lines)
+
+
+def cpu_time():
+  times = os.times()
+  return times.user + times.system + times.children_user + times.children_system
+
+
+async def run(guilds=100, duration=60.0, songs=5, song_length=20, songs_per_guild=3,
+              ramp=5.0, sample_interval=5.0, connect_latency=0.05, seed=None):
+  """
+  Runs #QuelBehavior against fake Discord objects. Every guild gets a
+  listener in a voice channel that plays *songs_per_guild* random songs from
+  the local #MediaServer. Guilds start over *ramp* seconds, the run ends
+  after *duration* seconds. Returns the report as a string.
+  """
+
+  from quel.main import QuelBehavior, get_guild
+  from quel.providers.rawfile import RawFileProvider
+
+  rng = random.Random(seed)
+  metrics = Metrics(connect_latency)
+  media = MediaServer(songs=songs, seconds=song_length)
+  media.start()
+  try:
+    # Not in memory, every thread would get its own database.
+    db.configure_sqlite(db.db)
+    db.db.bind(provider='sqlite', filename=os.path.join(media.directory, 'db.sqlite'), create_db=True)
+    db.db.generate_mapping(create_tables=True)
+    db.track_index.setup()
+    # The media server runs on localhost.
+    RawFileProvider.allow_private_hosts = True
+
+    bot = FakeUser('Quel', bot=True)
+    fake_guilds = [FakeGuild('Guild {}'.format(i), bot, metrics) for i in range(guilds)]
+    client = FakeClient(bot, fake_guilds)
+    # The process-wide command budget would otherwise throttle the ramp.
+    quel = QuelBehavior({'botConfig': {'inviteUrl': '{CLIENT_ID}',
+      'globalCommandBudget': [guilds * songs_per_guild, guilds * songs_per_guild]}})
+    client.add_handler(quel)
+    await client.dispatch_event(prepare_ready(client))
+
+    start = time.monotonic()
+    cpu_start = cpu_time()
+    metrics.sample_memory(0.0)
+    next_sample = sample_interval
+    tasks = []
+    for guild in fake_guilds:
+      listener = FakeUser('Listener')
+      listener.voice = FakeVoiceState(guild.voice_channel)
+      guild.voice_channel.members.append(listener)
+      urls = [rng.choice(media.urls) for _ in range(songs_per_guild)]
+      content = '{} play {}'.format(bot.mention, '; '.join(urls))
+      message = FakeMessage(guild.text_channel, listener, content, metrics)
+      tasks.append(asyncio.ensure_future(client.dispatch_event(prepare_message(client, message))))
+      await asyncio.sleep(ramp / guilds)
+
+    while time.monotonic() - start < duration:
+      await asyncio.sleep(min(1.0, duration))
+      elapsed = time.monotonic() - start
+      if elapsed >= next_sample:
+        metrics.sample_memory(elapsed)
+        next_sample += sample_interval
+
+    for guild in fake_guilds:
+      await quel.stop_playback(get_guild(guild.id))
+    await asyncio.gather(*tasks, return_exceptions=True)
+    metrics.sample_memory(time.monotonic() - start)
+    return metrics.report(cpu_time() - cpu_start, time.monotonic() - start, db.worker.latencies())
+  finally:
+    db.worker.stop()
+    media.stop()
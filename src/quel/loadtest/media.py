@@ -0,0 +1,96 @@
+
+"""
+A local HTTP server that serves generated audio files for the
+#RawFileProvider.
+"""
+
+import functools
+import http.server
+import math
+import os
+import shutil
+import socketserver
+import struct
+import subprocess
+import tempfile
+import threading
+import wave
+
+
+def write_wav(filename, seconds, frequency=440.0, rate=48000):
+  """
+  Writes a stereo 16-bit sine wave of *seconds* length to *filename*.
+  """
+
+  period = [int(12000 * math.sin(2 * math.pi * frequency * i / rate)) for i in range(rate)]
+  second = b''.join(struct.pack('<hh', x, x) for x in period)
+  with wave.open(filename, 'wb') as fp:
+    fp.setnchannels(2)
+    fp.setsampwidth(2)
+    fp.setframerate(rate)
+    for _ in range(int(seconds)):
+      fp.writeframes(second)
+
+
+def write_mp3(filename, source):
+  """
+  Encodes the audio file *source* to an MP3 file with FFmpeg. Returns
+  `False` if FFmpeg is not available.
+  """
+
+  if not shutil.which('ffmpeg'):
+    return False
+  subprocess.check_call(['ffmpeg', '-loglevel', 'error', '-y', '-i', source, filename])
+  return True
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+  daemon_threads = True
+
+
+class MediaServer:
+  """
+  Serves a directory of generated audio files on a local port. Every file is
+  available as `song<n>.wav` and, if FFmpeg is installed, as `song<n>.mp3`.
+  """
+
+  def __init__(self, songs=5, seconds=20):
+    self.directory = tempfile.mkdtemp(prefix='quel-loadtest-')
+    self.urls = []
+    self._server = None
+    self._thread = None
+    self._songs = songs
+    self._seconds = seconds
+
+  def start(self):
+    for i in range(self._songs):
+      wav = os.path.join(self.directory, 'song{}.wav'.format(i))
+      write_wav(wav, self._seconds, frequency=220.0 * (i + 1))
+      self.urls.append('song{}.wav'.format(i))
+      if write_mp3(os.path.join(self.directory, 'song{}.mp3'.format(i)), wav):
+        self.urls.append('song{}.mp3'.format(i))
+    handler = functools.partial(_QuietHandler, directory=self.directory)
+    self._server = _ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+    self._thread.start()
+    port = self._server.server_address[1]
+    self.urls = ['http://127.0.0.1:{}/{}'.format(port, x) for x in self.urls]
+
+  def stop(self):
+    if self._server:
+      self._server.shutdown()
+      self._server.server_close()
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+
+  def log_message(self, format, *args):
+    pass
+
+  def copyfile(self, source, outputfile):
+    try:
+      super().copyfile(source, outputfile)
+    except ConnectionError:
+      pass  # The client only read the head of the file.
@@ -0,0 +1,89 @@
+
+"""
+Measures the memory used by a queue of many songs, for the #QueuedSong
+representation and the #Song based one that it replaced.
+
+    $ python -m quel.loadtest.memory --songs 100000
+"""
+
+from quel.core.queue import SongQueue
+from quel.db.models import QueuedSong
+from quel.providers import Song
+
+import argparse
+import datetime
+import gc
+import random
+import tracemalloc
+
+
+class LegacyQueuedSong(Song):
+  user_id: str
+  provider_id: str
+  date_queued: str = lambda: str(datetime.datetime.now())
+  position: float = 0.0
+  retries: int = 0
+
+
+def generate(count, artists=500, users=20, seed=0):
+  """
+  Generates the keyword arguments for *count* songs. Artist names, albums,
+  genres, provider and user IDs repeat across songs like they do in real
+  queues, but are separate string objects as if they had been parsed from
+  separate API responses.
+  """
+
+  rng = random.Random(seed)
+  genres = ['Rock', 'Pop', 'Electronic', 'Hip-Hop', 'Jazz', 'Classical']
+  providers = ['youtube-dl', 'soundcloud', 'rawfile']
+  for i in range(count):
+    artist = rng.randrange(artists)
+    video_id = '{:011x}'.format(rng.getrandbits(44))
+    yield {
+      'url': 'https://www.youtube.com/watch?v=' + video_id,
+      'stream_url': 'https://r4---sn-4g5e6nz7.googlevideo.com/videoplayback?id=' + video_id + '&expire=1540000000&' + 'x' * 300,
+      'title': 'Song number {} by artist {}'.format(i, artist),
+      'artist': ''.join(['Artist ', str(artist)]),
+      'album': ''.join(['Album ', str(artist % 50)]),
+      'genre': ''.join([rng.choice(genres)]),
+      'image_url': 'https://i.ytimg.com/vi/' + video_id + '/hqdefault.jpg',
+      'duration': rng.randrange(120, 600),
+      'provider_id': ''.join([rng.choice(providers)]),
+      'user_id': str(200000000000000000 + rng.randrange(users)),
+    }
+
+
+def measure(factory, count):
+  """
+  Returns the number of bytes allocated by a #SongQueue of *count* songs
+  created with *factory*, and the queue itself to keep it alive.
+  """
+
+  gc.collect()
+  tracemalloc.start()
+  try:
+    before = tracemalloc.get_traced_memory()[0]
+    queue = SongQueue(factory(**kwargs) for kwargs in generate(count))
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0] - before, queue
+  finally:
+    tracemalloc.stop()
+
+
+def main():
+  parser = argparse.ArgumentParser(prog='python -m quel.loadtest.memory')
+  parser.add_argument('--songs', type=int, default=100000)
+  args = parser.parse_args()
+
+  results = []
+  for name, factory in [('Song (Named)', LegacyQueuedSong), ('QueuedSong', QueuedSong)]:
+    size, queue = measure(factory, args.songs)
+    results.append(size)
+    print('{:<14} {:>8.1f} MiB  {:>5} bytes/song'.format(
+      name, size / 2**20, size // args.songs))
+    del queue
+  print('Saved {:.0%}.'.format(1 - results[1] / results[0]))
+
+
+if __name__ == '__main__':
+  main()
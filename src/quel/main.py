@@ -1,11 +1,17 @@
 # coding: utf8
 
-from pony import orm
 from quel import db
+from quel.db import PlaybackState
 from quel.db.utils import create_or_update
-from quel.core.client import Client, EventMultiplexer, EventType, event, get_event, set_event, propagate_event
+from quel.core.admission import Admission, Rejection
+from quel.core.client import Client, EventMultiplexer, EventType, MessageEvent, event, get_event, set_event, propagate_event
 from quel.core.handlers import on, command
+from quel.core.pages import PageCache, format_duration, page_count, shorten
 from quel.core.reloader import Reloader
+from quel.core.stats import stats
+from quel.core.utils import TTLCache, run_in_executor
+from quel.core.voice import IdleConnections, wait_ready
+from quel.core.workers import KeyedWorkers
 from quel.providers import ResolveError
 from quel.providers.rawfile import RawFileProvider
 from quel.providers.soundcloud import SoundCloudProvider
@@ -21,6 +27,7 @@ import os
 import random
 import re
 import sys
+import time
 
 
 providers = [
@@ -34,34 +41,38 @@ logger = logging.getLogger(__name__)
 reloader = Reloader()
 
 
-@orm.db_session
-def get_guild(guild_id=None):
-  guild_id = guild_id or event.message.guild.id
-  return create_or_update(db.Guild, {'id': guild_id})
+#: The #db.Guild entities of the guilds served by this process, see
+#: #load_guild(). They are read-only outside of the database worker.
+guilds = {}
 
 
-class GuildSongResumer:
+def _load_guild(guild_id, func=None, *args):
+  guild = create_or_update(db.Guild, {'id': guild_id})
+  if func:
+    func(guild, *args)
+  guild.config  # Lazy, but must be readable after the session.
+  return guild
 
-  def __init__(self, quel):
-    self.queue = asyncio.Queue()
-    self.quel = quel
-    self.task = None
 
-  def start(self):
-    self.task = asyncio.create_task(self.run())
+async def load_guild(guild_id, func=None, *args):
+  """
+  Loads the #db.Guild with *guild_id* on the database worker and caches it
+  for #get_guild(). If *func* is specified, it is called with the guild and
+  *args* to modify it before it is cached.
+  """
 
-  async def run(self):
-    while True:
-      guild, ev = await self.queue.get()
-      try:
-        with set_event(ev):
-          await self.quel.resume(force=True)
-      except:
-        logger.exception('Exception in GuildSongResumer.run()')
+  guild = await db.worker.run(_load_guild, guild_id, func, *args)
+  guilds[guild_id] = guild
+  return guild
+
+
+def get_guild(guild_id=None):
+  guild_id = guild_id or event.message.guild.id
+  return guilds[guild_id]
 
-  async def put(self, guild):
-    await self.queue.put((guild, get_event()))
 
+def count_urls(arg):
+  return max(1, sum(1 for x in arg.split(';') if x.strip()))
 
 
 class QuelBehavior(EventMultiplexer):
@@ -79,14 +90,137 @@ class QuelBehavior(EventMultiplexer):
     '〆(・∀・＠)',
   ]
 
-  def __init__(self, config):
+  # The maximum number of entries imported from a single playlist. Can be
+  # overwritten with "maxPlaylistEntries" in the "botConfig".
+  max_playlist_entries = 500
+
+  # Minimum number of seconds between updates of the playlist import
+  # progress message.
+  progress_interval = 2.0
+
+  # The number of times that a broken stream is resumed before continuing
+  # with the next song. Can be overwritten with "streamRetries" in the
+  # "botConfig".
+  max_stream_retries = 3
+
+  # The number of seconds that search results can be played by their number.
+  search_results_ttl = 3600
+
+  # The maximum number of guilds that can start their next song at the same
+  # time, and the number of seconds after which an idle playback worker of a
+  # guild exits. Can be overwritten with "maxConcurrentTransitions" and
+  # "transitionWorkerTimeout" in the "botConfig".
+  max_concurrent_transitions = 8
+  transition_worker_timeout = 60.0
+
+  # A stream that ends more than this many seconds before the end of the
+  # song is considered broken.
+  stream_end_tolerance = 5
+
+  # The number of seconds that the bot stays in the voice channel after the
+  # queue ran empty, and the maximum number of such idle connections of this
+  # process. Can be overwritten with "voiceIdleTimeout" and
+  # "maxIdleVoiceConnections" in the "botConfig".
+  voice_idle_timeout = 120.0
+  max_idle_voice_connections = 50
+
+  # The maximum number of seconds to wait for a new voice connection to
+  # become ready, and the number of seconds to wait after that before audio
+  # is sent, as it plays sped up otherwise. The latter can be overwritten
+  # with "voiceSettleDelay" in the "botConfig".
+  voice_ready_timeout = 10.0
+  voice_settle_delay = 1.0
+
+  # The number of seconds that the playback stays paused after the last
+  # listener left the voice channel, before the stream is closed. Can be
+  # overwritten with "emptyChannelTimeout" in the "botConfig".
+  empty_channel_timeout = 60.0
+
+  # Admission control for commands that cause expensive work (see
+  # #Admission). The budgets are `[rate, burst]` in cost units per second,
+  # the cost of "play" is the number of URLs. The entries of a playlist
+  # cost "playlist_entry" each, taken in batches while it is imported; the
+  # import waits up to #max_playlist_wait seconds per batch for the budgets
+  # to refill. Can be overwritten with "commandCosts", "userCommandBudget",
+  # "guildCommandBudget", "globalCommandBudget", "maxPendingCommands" and
+  # "maxPendingCommandsPerGuild" in the "botConfig".
+  command_costs = {'play': 1, 'search': 3, 'provider_reload': 5, 'config_set': 2, 'config_del': 2,
+                   'playlist_entry': 0.1}
+  user_command_budget = (0.2, 20)
+  guild_command_budget = (1.0, 50)
+  global_command_budget = (20.0, 500)
+  max_pending_commands = 64
+  max_pending_commands_per_guild = 4
+  playlist_charge_batch = 25
+  max_playlist_wait = 60.0
+
+  # The number of songs on a page of the "queue" command, and the number of
+  # seconds that a queue message can be paged with the #queue_reactions. Can
+  # be overwritten with "queuePageSize" in the "botConfig".
+  queue_page_size = 10
+  queue_view_ttl = 3600
+  queue_reactions = ('\N{BLACK LEFT-POINTING TRIANGLE}', '\N{BLACK RIGHT-POINTING TRIANGLE}')
+
+  def __init__(self, config, cluster=None):
     super().__init__()
     self.config = config
-    self.song_resumer = GuildSongResumer(self)
+    # With a #db.Cluster, only the events of the guilds that this node holds
+    # the lease for are handled.
+    self.cluster = cluster
+    # The results of the last search in every channel, for "play <number>".
+    self.search_results = TTLCache(self.search_results_ttl, maxsize=10000)
+    # Track transitions are processed by one worker per guild, so a slow
+    # transition in one guild does not delay the others.
+    self.transitions = KeyedWorkers(self.transition,
+      max_concurrent=self.option('maxConcurrentTransitions', self.max_concurrent_transitions),
+      idle_timeout=self.option('transitionWorkerTimeout', self.transition_worker_timeout))
+    # Voice connections are kept for a while after the queue ran empty.
+    self.idle_voice = IdleConnections(self.release_voice,
+      timeout=self.option('voiceIdleTimeout', self.voice_idle_timeout),
+      max_idle=self.option('maxIdleVoiceConnections', self.max_idle_voice_connections))
+    costs = dict(self.command_costs)
+    costs.update(self.option('commandCosts', {}))
+    self.admission = Admission(costs,
+      user_budget=tuple(self.option('userCommandBudget', self.user_command_budget)),
+      guild_budget=tuple(self.option('guildCommandBudget', self.guild_command_budget)),
+      global_budget=tuple(self.option('globalCommandBudget', self.global_command_budget)),
+      max_pending=self.option('maxPendingCommands', self.max_pending_commands),
+      max_pending_per_guild=self.option('maxPendingCommandsPerGuild', self.max_pending_commands_per_guild))
+    # The IDs of the channels that Quel listens to in every guild, see
+    # #quel_channel_ids().
+    self.quel_channels = {}
+    self._mention = None
+    # The rendered pages of the queues (see #queue_message()), and the queue
+    # messages that can be paged with reactions, with the guild and the page
+    # that they show.
+    self.queue_pages = PageCache(maxsize=10000)
+    self.queue_views = TTLCache(self.queue_view_ttl, maxsize=10000)
+    # The guilds whose playback was paused because nobody was listening, with
+    # the generation of the playback, the timer that closes the stream (or
+    # `None` if it was closed) and the voice channel. A suspended playback
+    # that continues after its idle connection was closed connects to the
+    # channel in #resume_channels again.
+    self.auto_paused = {}
+    self.resume_channels = {}
+    # A standby process (see #Reloader) does not handle messages until it
+    # received the state of the previous process.
+    self.active = not reloader.is_standby()
+
+  def option(self, name, default=None):
+    """
+    Returns the value of the option *name* from the "botConfig".
+    """
+
+    return self.config.get('botConfig', {}).get(name, default)
+
+  def mention_regex(self):
+    if self._mention is None:
+      self._mention = re.compile(r'\s*<@!?{}>\s*'.format(self.client.user.id))
+    return self._mention
 
   def check_mention(self):
-    match = re.match('^\s*<@!?(\d+)>\s*', event.text)
-    if match and match.group(1) == str(self.client.user.id):
+    match = self.mention_regex().match(event.text)
+    if match:
       event.text = event.text[match.end():]
       return True
     return False
@@ -96,14 +230,81 @@ class QuelBehavior(EventMultiplexer):
       return 'quel' in channel.topic.lower()
     return False
 
+  def quel_channel_ids(self, discord_guild):
+    """
+    Returns the IDs of the channels of *discord_guild* that Quel listens to
+    (see #check_channel()). They are cached until a channel of the guild is
+    created, changed or deleted.
+    """
+
+    ids = self.quel_channels.get(discord_guild.id)
+    if ids is None:
+      ids = frozenset(x.id for x in discord_guild.channels if self.check_channel(x))
+      self.quel_channels[discord_guild.id] = ids
+    return ids
+
+  def prefilter(self, ev):
+    message = ev.message
+    if message.author == self.client.user:
+      return False
+    if message.guild and message.channel.id in self.quel_channel_ids(message.guild):
+      return True
+    return self.mention_regex().match(ev.text) is not None
+
+  @on('guild_channel_create', 'guild_channel_update', 'guild_channel_delete')
+  async def guild_channel_changed(self):
+    self.quel_channels.pop(event.channel.guild.id, None)
+    return False
+
   async def handle_event(self):
+    if event.type == EventType.guild_join and self.cluster:
+      return False  # Set up when the lease is acquired.
+    if event.type == EventType.voice_state_update:
+      if not self.active:
+        return False
+      if self.cluster and not self.cluster.owns(event.member.guild.id):
+        return False
+    if event.type in (EventType.reaction_add, EventType.reaction_remove):
+      if not self.active or event.user == self.client.user:
+        return False
+      if self.queue_views.get(event.message.id) is None:
+        return False
+      if self.cluster and not self.cluster.owns(event.message.guild.id):
+        return False
     if event.type == EventType.message:
+      if not self.active:
+        return False
+      if self.cluster and event.message.guild and not self.cluster.owns(event.message.guild.id):
+        return False
       if event.message.author == self.client.user:
         return False
-      if not (self.check_mention() or self.check_channel(event.message.channel)):
+      in_channel = event.message.guild and \
+        event.message.channel.id in self.quel_channel_ids(event.message.guild)
+      if not (self.check_mention() or in_channel):
         return False
+      if event.message.guild and event.message.guild.id not in guilds:
+        await load_guild(event.message.guild.id)
     return await super().handle_event()
 
+  async def admit(self, name, units):
+    """
+    Admits the command *name* with the #Admission control, or replies why it
+    was rejected.
+    """
+
+    guild_id = event.message.guild.id if event.message.guild else None
+    try:
+      return self.admission.admit(name, units, event.message.author.id, guild_id)
+    except Rejection as exc:
+      mention = event.message.author.mention
+      if exc.retry_after is None:
+        await event.reply("I'm busy right now, please try again in a moment {}.".format(mention))
+      elif exc.retry_after == float('inf'):
+        await event.reply('That is too much at once {}, please split it up.'.format(mention))
+      else:
+        await event.reply('Slow down {}, try again in {} seconds.'.format(mention, int(exc.retry_after) + 1))
+      return None
+
   async def update_nick(self, guild):
     if not guild.me.nick:
       try:
@@ -116,21 +317,137 @@ class QuelBehavior(EventMultiplexer):
     client_id = (await self.client.application_info()).id
     invite_url = self.config['botConfig']['inviteUrl'].format(CLIENT_ID=client_id)
     logger.info('Invite URL: {}'.format(invite_url))
-    logger.info('Loading providers for all servers.')
-    for guild in self.client.guilds:
-      await self.update_nick(guild)
-      await self.provider_reload(guild)
-
-      # Say hello in Quel's main channel.
-      for channel in guild.channels:
-        if self.check_channel(channel):
-          await channel.send("I'm b{}ck! {}".format('a' * random.randint(1, 15), random.choice(self.welcome_smileys)))
-          break
-
-    self.song_resumer.start()
+    if not self.cluster:
+      logger.info('Loading providers for all servers.')
+      await asyncio.gather(*(load_guild(x.id) for x in self.client.guilds))
+      for guild in self.client.guilds:
+        await self.setup_guild(guild)
+
+    if reloader.is_standby():
+      logger.info('Standby process is ready, waiting for state handoff.')
+      state = await run_in_executor(None, reloader.send_ready)
+      await self.import_state(state)
+      self.active = True
+      logger.info('Took over from the previous process.')
+
+    # A standby process joins the cluster only after the handoff, when the
+    # previous process released its leases.
+    if self.cluster:
+      logger.info('Joining the cluster as node "{}".'.format(self.cluster.node_id))
+      self.cluster.start(self)
+
+  async def setup_guild(self, discord_guild, greet=True):
+    await load_guild(discord_guild.id)
+    await self.update_nick(discord_guild)
+    await self.provider_reload(discord_guild)
+
+    # Say hello in Quel's main channel, unless we are taking over from
+    # a previous process.
+    if not greet or reloader.is_standby():
+      return
+    for channel in discord_guild.channels:
+      if self.check_channel(channel):
+        await channel.send("I'm b{}ck! {}".format('a' * random.randint(1, 15), random.choice(self.welcome_smileys)))
+        break
+
+  def cluster_guild_ids(self):
+    return [x.id for x in self.client.guilds]
+
+  def cluster_snapshot(self, guild_id):
+    return self.export_guild(guilds[guild_id]) if guild_id in guilds else None
+
+  async def guild_acquired(self, guild_id, state):
+    discord_guild = self.client.get_guild(guild_id)
+    if not discord_guild:
+      return
+    await self.setup_guild(discord_guild, greet=state is None)
+    if state:
+      await self.import_guild(state)
+
+  async def guild_lost(self, guild_id):
+    guild = guilds.get(guild_id)
+    if guild:
+      await self.stop_playback(guild)
+      guild.queue.clear()
+    self.queue_pages.invalidate(guild_id)
+
+  def export_state(self):
+    """
+    Collects the playback state of all guilds into a JSON serializable
+    object that can be passed to #import_state() in another process.
+    """
+
+    states = []
+    for discord_guild in self.client.guilds:
+      if discord_guild.id in guilds:
+        data = self.export_guild(get_guild(discord_guild.id))
+        if data:
+          states.append(data)
+    return {'guilds': states}
+
+  def export_guild(self, guild):
+    """
+    Returns the playback state of *guild*, or `None` if nothing is queued or
+    playing.
+    """
+
+    if not guild.queue and not guild.current_song:
+      return None
+    data = {
+      'guild_id': guild.id,
+      'volume': guild.volume,
+      'queue': [song.asdict() for song in guild.queue],
+      'current': None,
+      'voice_channel_id': None,
+      'channel_id': None,
+      'message_id': None
+    }
+    if guild.voice_client and guild.current_song:
+      data['current'] = guild.current_song.asdict()
+      data['current']['position'] = guild.position
+      data['voice_channel_id'] = guild.voice_client.channel.id
+    if guild.last_event:
+      data['channel_id'] = guild.last_event.message.channel.id
+      data['message_id'] = guild.last_event.message.id
+    return data
+
+  async def import_state(self, state):
+    """
+    Restores the state exported with #export_state(). Queues and volumes are
+    restored and playback of the current songs continues at the position
+    where the previous process stopped.
+    """
+
+    for data in state.get('guilds', []):
+      await self.import_guild(data)
+
+  async def import_guild(self, data):
+    """
+    Restores the state of a guild exported with #export_guild().
+    """
+
+    guild = await load_guild(data['guild_id'], db.Guild.set_volume, data['volume'])
+    guild.queue.clear()
+    guild.queue.extend((db.QueuedSong(**x) for x in data['queue']), dedup=False)
+    if data['current']:
+      guild.queue.appendleft(db.QueuedSong(**data['current']))
+
+    channel = self.client.get_channel(data['channel_id']) if data['channel_id'] else None
+    voice_channel = self.client.get_channel(data['voice_channel_id']) if data['voice_channel_id'] else None
+    if not channel or not voice_channel:
+      return
+    try:
+      message = await channel.get_message(data['message_id'])
+      guild.voice_client = await voice_channel.connect()
+    except discord.DiscordException:
+      logger.exception('Unable to continue playback in guild {}'.format(guild.id))
+      return
+    with set_event(MessageEvent(self.client, message)):
+      self.next_song(guild)
 
   @on('guild_join')
   async def guild_join(self):
+    await load_guild(event.guild.id)
     await self.update_nick(event.guild)
 
   @on('message')
@@ -141,52 +458,67 @@ class QuelBehavior(EventMultiplexer):
     song_urls = []
     for attachment in event.message.attachments:
       url = attachment.url
-      if RawFileProvider().match_url(url, urlparse(url)):
+      if RawFileProvider().match_url(url, urlparse(url))[0]:
         song_urls.append(url)
 
     if song_urls:
-      await self.play('play', ';'.join(song_urls))
+      ticket = await self.admit('play', len(song_urls))
+      if ticket is not None:
+        with ticket:
+          await self.play('play', ';'.join(song_urls))
     return True
 
-  @command(regex='config\s+set\s+([\w\d\.]+)\s+(.*)')
+  @command(regex='config\s+set\s+([\w\d\.]+)\s+(.*)', cost=1)
   async def config_set(self, key, value):
-    with orm.db_session:
-      guild = get_guild()
-      guild.config[key] = value
-      await self.provider_reload()
+    await load_guild(event.message.guild.id, db.Guild.update_config, key, value)
+    await self.provider_update(key)
 
-  @command(regex='config\s+del\s+([\w\d.]+)')
+  @command(regex='config\s+del\s+([\w\d.]+)', cost=1)
   async def config_del(self, key):
-    with orm.db_session:
-      guild = get_guild()
-      guild.config.pop(key, None)
-      await self.provider_reload()
+    await load_guild(event.message.guild.id, db.Guild.update_config, key)
+    await self.provider_update(key)
 
-  @command(regex='providers?\s+reload')
+  @command(regex='providers?\s+reload', cost=1)
   async def provider_reload(self, guild=None):
-    with orm.db_session:
-      guild = get_guild(guild.id if guild else None)
-      guild.init_providers(logger, providers, force=True)
+    guild = get_guild(guild.id if guild else None)
+    replaced = guild.init_providers(logger, providers, force=True)
+    for other in guilds.values():
+      other.replace_providers(replaced)
+
+  async def provider_update(self, key):
+    guild = get_guild()
+    for provider in guild.update_providers(logger, providers, key):
+      logger.info('Re-instantiated provider "{}" for guild {}'.format(provider.name, guild.id))
 
   @command(regex='providers?\s+status')
   async def provider_status(self):
     guild = get_guild()
     if not guild.providers:
       await event.reply('No providers installed.')
+      return
+    lines = []
     for provider in guild.providers:
-      message = provider.error or 'Ok'
-      await event.reply('**{}**: {}'.format(provider.provider.name, message))
+      message = provider.status()
+      lines.append('**{}**: {}'.format(provider.provider.name, message))
+    await event.reply('\n'.join(lines))
 
   @command(regex='providers?\s+help')
   async def provider_help(self):
+    blocks = []
     for provider in providers:
       lines = ['- ' + x for x in provider.get_option_names()]
-      await event.reply('**{}**\n```\n{}\n```'.format(provider.name, '\n'.join(lines)))
+      blocks.append('**{}**\n```\n{}\n```'.format(provider.name, '\n'.join(lines)))
+    await event.reply('\n'.join(blocks))
 
-  @command(regex='search\s+(?:(\w+):\s*)?(.*)')
+  @command(regex='search\s+(?:(\w+):\s*)?(.*)', cost=1)
   async def search(self, provider_name, term):
-    with orm.db_session:
-      guild = get_guild()
+    guild = get_guild()
+    if provider_name and provider_name.lower() == 'local':
+      if not db.track_index.available:
+        await event.reply('The local index is not available.')
+        return
+      await self.send_search_results(term, await db.track_index.search(term, 10))
+      return
     if provider_name:
       provider_name = provider_name.lower()
       for provider in providers:
@@ -208,120 +540,689 @@ class QuelBehavior(EventMultiplexer):
         await event.reply('No providers available.')
         return
 
+    # Answer from the local index first, the providers take a while.
+    results = []
+    if not provider_name:
+      results = [x for x in await db.track_index.search(term, 5) if guild.find_provider(x[0])]
+      if results:
+        await self.send_search_results(term, results, title='Played before', immediate=True)
+
     provider_names = ['**{}**'.format(x.name) for x in search_providers]
     await event.reply('Searching "{}" in {}'.format(term, ', '.join(provider_names)))
 
-    embed = discord.Embed(title='Results for "{}"'.format(term))
+    found = []
+    errors = []
     for provider in search_providers:
-      async for song in provider.search(term, 5):
-        embed.add_field(name=song.title, value=song.url)
-    await event.reply(embed=embed)
+      try:
+        async for song in provider.search(term, 5):
+          found.append((provider.id, song))
+      except ResolveError as exc:
+        errors.append('**{}**: {}'.format(provider.name, exc))
+    if errors:
+      await event.reply('\n'.join(errors))
+    await self.send_search_results(term, found, previous=results)
+
+  async def send_search_results(self, term, results, previous=(), title=None, immediate=False):
+    """
+    Replies with an embed of the search *results*, a list of `(provider_id,
+    song)` tuples, and remembers them for "play <number>". The results are
+    numbered after the *previous* results of the same search.
+    """
+
+    results = list(previous) + list(results)
+    embed = discord.Embed(title=title or 'Results for "{}"'.format(term))
+    for index, (provider_id, song) in enumerate(results[len(previous):], len(previous) + 1):
+      embed.add_field(name='{}. {}'.format(index, song.title), value=song.url)
+    if results:
+      embed.set_footer(text='Use "play <number>" to play a result.')
+    self.search_results.set(event.message.channel.id, results)
+    await event.reply(embed=embed, immediate=immediate)
+
+  @command(regex='queue(?:\s+page\s+(\d+))?\s*$')
+  async def queue(self, page=None):
+    guild = get_guild()
+    page, pages, text, embed = self.queue_message(guild, int(page or 1) - 1)
+    try:
+      message = await event.reply(embed=embed, immediate=True)
+      use_embed = True
+    except discord.Forbidden:
+      message = await event.reply(text, immediate=True)
+      use_embed = False
+    if pages > 1:
+      self.queue_views.set(message.id, (guild.id, page, use_embed))
+      try:
+        for emoji in self.queue_reactions:
+          await message.add_reaction(emoji)
+      except discord.Forbidden:
+        pass
 
-  @command(regex='(queue|play)\s+(.*)', flags=re.S)
+  @on('reaction_add', 'reaction_remove')
+  async def turn_queue_page(self):
+    """
+    Turns the page of a queue message when an arrow is added or removed.
+    Removing an arrow turns the page as well, so the bot does not need the
+    permission to remove the reactions of other users.
+    """
+
+    emoji = str(event.reaction.emoji)
+    view = self.queue_views.get(event.message.id)
+    if view is None or emoji not in self.queue_reactions:
+      return False
+    guild_id, page, use_embed = view
+    guild = guilds.get(guild_id)
+    if guild is None:
+      return False
+    page += 1 if emoji == self.queue_reactions[1] else -1
+    page, pages, text, embed = self.queue_message(guild, page)
+    self.queue_views.set(event.message.id, (guild_id, page, use_embed))
+    stats.incr('queue.page_turns')
+    if use_embed:
+      await event.message.edit(embed=embed)
+    else:
+      await event.message.edit(content=text)
+
+  def queue_message(self, guild, page):
+    """
+    Renders the 0-based *page* of the guild's queue. Returns the page,
+    clamped to the pages that exist, the number of pages, the text of the
+    message for channels without embeds and the embed.
+
+    The songs on the page are rendered once per version of the queue (see
+    #PageCache), the current song and the totals every time.
+    """
+
+    queue = guild.queue
+    page_size = max(1, self.option('queuePageSize', self.queue_page_size))
+    pages = page_count(len(queue), page_size)
+    page = min(max(page, 0), pages - 1)
+    body = self.queue_pages.get(guild.id, (id(queue), queue.version, page_size), page,
+      lambda page: self.render_queue_page(queue, page * page_size, page_size))
+    body = body or 'The queue is empty.'
+    song = guild.current_song
+    remaining = queue.total_duration
+    if song:
+      remaining += max(0, queue.duration_of(song) - guild.position)
+    footer = 'Page {}/{} · {} songs · {} remaining'.format(
+      page + 1, pages, len(queue), format_duration(remaining))
+    if pages > 1:
+      footer += '\nUse the arrows or "queue page <number>" to turn the page.'
+
+    embed = discord.Embed(title='Queued songs', description=body)
+    lines = ['**Queue**']
+    if song:
+      now_playing = '**{}** - {}'.format(shorten(song.title, 80), shorten(song.artist, 40))
+      embed.add_field(name='Now playing', value=now_playing, inline=False)
+      lines.append('Now playing: ' + now_playing)
+    embed.set_footer(text=footer)
+    lines += [body, '*{}*'.format(footer.replace('\n', ' · '))]
+    return page, pages, '\n'.join(lines), embed
+
+  def render_queue_page(self, queue, start, count):
+    """
+    Renders *count* songs of *queue* from the index *start*, one line per
+    song. Only these songs are read from the queue.
+    """
+
+    lines = []
+    for index, song in enumerate(queue[start:start + count], start + 1):
+      duration = queue.duration_of(song)
+      lines.append('{}. **{}** - {}{} (queued by <@{}>)'.format(
+        index, shorten(song.title, 80), shorten(song.artist, 40),
+        ' `{}`'.format(format_duration(duration)) if duration else '', song.user_id))
+    return '\n'.join(lines)
+
+  @command(regex='(queue|play)\s+(.*)', flags=re.S, cost=lambda command, arg: count_urls(arg))
   async def play(self, command, arg):
     guild = get_guild()
     errors = []
-    songs = []
     for url in map(str.strip, arg.split(';')):
       if not url: continue
       if url.startswith('<') and url.endswith('>'):
         url = url[1:-1]
-      urlinfo = urlparse(url)
-      if not urlinfo.netloc or not urlinfo.scheme:
-        errors.append('Invalid URL `{}`'.format(url))
+      if url.isdigit():
+        results = self.search_results.get(event.message.channel.id) or []
+        if not 0 < int(url) <= len(results):
+          errors.append('There is no search result number {}'.format(url))
+          continue
+        provider_id, song = results[int(url) - 1]
+        song = db.QueuedSong(
+          user_id=event.message.author.id,
+          provider_id=provider_id,
+          **song.asdict())
       else:
-        song = None
-        for provider in guild.providers:
-          matches, match_data = provider.match_url(url, urlinfo)
-          if not provider.error and matches:
-            try:
-              song = await provider.resolve_url(url, match_data)
-            except ResolveError as exc:
-              errors.append('`{}`: {}'.format(url, exc))
-              break
-            song = db.QueuedSong(
-              user_id=event.message.author.id,
-              provider_id=provider.id,
-              **song.asdict())
-            break
-        else:
+        urlinfo = urlparse(url)
+        if not urlinfo.netloc or not urlinfo.scheme:
+          errors.append('Invalid URL `{}`'.format(url))
+          continue
+        provider, match_data = await self.find_provider(guild, url, urlinfo)
+        if not provider:
           errors.append('No provider for URL `{}`'.format(url))
           continue
-        if not song:
+        if provider.match_playlist(url, match_data):
+          count = await self.import_playlist(guild, provider, url, match_data, command == 'play')
+          if count and command == 'play':
+            command = None
           continue
-        async with guild.lock:
-          guild.queue_song(song)
-          await event.reply('Queued **{}** - {} (by {})'.format(song.title, song.artist, event.message.author.mention))
-        if command == 'play':
-          await self.resume()
-          command = None   # Don't call resume() for the next songs
+        try:
+          song = await provider.resolve_url(url, match_data)
+        except ResolveError as exc:
+          errors.append('`{}`: {}'.format(url, exc))
+          continue
+        song = db.QueuedSong(
+          user_id=event.message.author.id,
+          provider_id=provider.id,
+          **song.asdict())
+      if not guild.queue_song(song):
+        errors.append('**{}** is already queued'.format(song.title))
+        continue
+      await event.reply('Queued **{}** - {} (by {})'.format(song.title, song.artist, event.message.author.mention))
+      if command == 'play':
+        await self.resume()
+        command = None   # Don't call resume() for the next songs
 
     if errors:
       await event.reply('\n'.join(errors))
 
+  async def find_provider(self, guild, url, urlinfo):
+    """
+    Returns the provider that accepts *url* and its match data. If no
+    provider accepts it by the URL alone, the providers are asked to probe
+    it (see #ProviderInstance.probe_url()).
+    """
+
+    available = [x for x in guild.providers if not x.error]
+    for provider in available:
+      matches, match_data = provider.match_url(url, urlinfo)
+      if matches:
+        return provider, match_data
+    for provider in available:
+      matches, match_data = await provider.probe_url(url, urlinfo)
+      if matches:
+        return provider, match_data
+    return None, None
+
+  async def import_playlist(self, guild, provider, url, match_data, play=False):
+    """
+    Queues the songs of a playlist while the provider discovers them. The
+    songs are usually partial and are completed shortly before they are
+    played (see #prefetch()). Progress is reported by editing a single
+    message. Returns the number of songs that were queued.
+    """
+
+    limit = self.option('maxPlaylistEntries', self.max_playlist_entries)
+    mention = event.message.author.mention
+    message = await event.reply('Importing playlist <{}> ...'.format(url), immediate=True)
+    last_update = time.monotonic()
+    entries = 0
+    queued = 0
+    rejection = None
+    try:
+      async for song in provider.iter_playlist(url, match_data):
+        if entries % self.playlist_charge_batch == 0:
+          rejection = await self.charge_playlist_entries(self.playlist_charge_batch)
+          if rejection:
+            break
+        entries += 1
+        song = db.QueuedSong(
+          user_id=event.message.author.id,
+          provider_id=provider.id,
+          **song.asdict())
+        if guild.queue_song(song):
+          queued += 1
+        if play and queued == 1:
+          await self.resume()
+          play = False
+        if entries >= limit:
+          break
+        if time.monotonic() - last_update >= self.progress_interval:
+          await message.edit(content='Importing playlist <{}> ... {} songs queued'.format(url, queued))
+          last_update = time.monotonic()
+    except ResolveError as exc:
+      await message.edit(content='Importing playlist <{}> failed after {} songs: {}'.format(url, queued, exc))
+      return queued
+
+    status = 'Queued {} songs from playlist <{}> (by {})'.format(queued, url, mention)
+    if rejection:
+      status += ', stopped because too much is being imported right now'
+    elif entries >= limit:
+      status += ', stopped at the limit of {} entries'.format(limit)
+    await message.edit(content=status)
+    return queued
+
+  async def charge_playlist_entries(self, count):
+    """
+    Takes the cost of *count* playlist entries from the budgets of the user
+    and guild (see #Admission.charge()), waiting up to #max_playlist_wait
+    seconds for them to refill. Returns the #Rejection if the import has to
+    stop, otherwise `None`.
+    """
+
+    guild_id = event.message.guild.id if event.message.guild else None
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + self.max_playlist_wait
+    while True:
+      try:
+        self.admission.charge('playlist_entry', count, event.message.author.id, guild_id)
+        return None
+      except Rejection as exc:
+        if exc.retry_after is None or loop.time() + exc.retry_after > deadline:
+          return exc
+        await asyncio.sleep(exc.retry_after)
+
+  def prefetch(self, guild):
+    """
+    Prepares the next song in the queue in the background, so that it is
+    ready when playback reaches it: partial songs are completed and the
+    loudness of the song is analyzed.
+    """
+
+    if not guild.queue:
+      return
+    song = guild.queue[0]
+    if not song.partial and (song.gain is not None or not db.loudness.enabled):
+      return
+    async def prepare():
+      await guild.complete_song(song)
+      provider = guild.find_provider(song.provider_id)
+      if song.gain is None and db.loudness.enabled and provider:
+        song.gain = await db.loudness.analyze(song.url, await provider.get_stream_url(song))
+    def done(task):
+      if not task.cancelled() and task.exception():
+        logger.warning('Unable to prefetch {}: {}'.format(song.url, task.exception()))
+    asyncio.ensure_future(prepare()).add_done_callback(done)
+
   @command(regex='resume')
-  async def resume(self, force=False):
+  async def resume(self):
     guild = get_guild()
-    async with guild.lock:
-      if not force and guild.voice_client and guild.voice_client.source:
-        guild.voice_client.resume()
-        return
+    if guild.state == PlaybackState.paused:
+      guild.voice_client.resume()
+      guild.state = PlaybackState.playing
+    elif guild.state == PlaybackState.idle:
+      self.next_song(guild)
+
+  async def play_next(self):
+    """
+    Starts playing the next song in the queue, or leaves the voice connection
+    idle if the queue is empty. Must only be called from the guild's
+    transition worker (see #next_song()).
+
+    The guild goes through the connecting and resolving states to the
+    playing state. Between these steps, the guild is not locked, so other
+    commands never wait for the network. If the playback is stopped in the
+    meantime, the song is put back to the front of the queue. If starting
+    the song fails, it is put back as well and the guild goes back to the
+    idle state.
+    """
 
-      if not guild.queue:
-        if guild.voice_client:
-          await guild.voice_client.disconnect()
-          guild.voice_client = None
+    guild = get_guild()
+    guild.current_song = None
+    if not guild.queue:
+      await self.stop_playback(guild, disconnect=False)
+      return
+
+    reused = self.idle_voice.take(guild.id)
+    if guild.voice_client and not guild.voice_client.is_connected():
+      guild.voice_client = None
+    song = guild.queue.popleft()
+    generation = guild.transition_to(PlaybackState.resolving if guild.voice_client else PlaybackState.connecting)
+    try:
+      await self.start_song(guild, song, generation, reused)
+    except Exception as exc:
+      logger.exception('Unable to play {}'.format(song.url))
+      if guild.current_song is song:
+        return  # The song is playing, something after it started failed.
+      guild.queue.appendleft(song)
+      if guild.generation != generation:
         return
+      await self.stop_playback(guild, disconnect=False)
+      await event.reply('Unable to play **{}**: {}. Type `resume` to try again.'.format(
+        song.title, str(exc) or type(exc).__name__))
+
+  async def start_song(self, guild, song, generation, reused=None):
+    """
+    Connects to the voice channel if necessary and starts playing *song* as
+    the transition *generation* (see #play_next()). *reused* is the idle
+    voice client that was taken for the guild, if any.
+    """
+
+    if reused is not None:
+      stats.incr('voice.reused')
+      voice_state = event.message.author.voice
+      if voice_state and voice_state.channel and voice_state.channel != reused.channel:
+        await reused.move_to(voice_state.channel)
+
+    def superseded():
+      if guild.generation == generation:
+        return False
+      guild.queue.appendleft(song)
+      return True
 
-      song = guild.queue.pop(0)
-      provider = guild.find_provider(song.provider_id)
-      if not provider:
-        logger.error('Provider for queued Song no longer exists: {}'.format(song.provider_id))
-        return
+    provider = guild.find_provider(song.provider_id)
+    if not provider:
+      logger.error('Provider for queued Song no longer exists: {}'.format(song.provider_id))
+      guild.state = PlaybackState.idle
+      self.next_song(guild)
+      return
 
-      if not guild.voice_client:
+    if guild.state == PlaybackState.connecting:
+      voice_channel = self.resume_channels.pop(guild.id, None)
+      if not voice_channel:
         voice_state = event.message.author.voice
         voice_channel = voice_state.channel if voice_state else None
-        if not voice_channel:
-          await event.reply('Join a voice channel and type `resume` to start playing music!')
-          return
-        guild.voice_client = await voice_channel.connect()
-        # We wait for a second as otherwise we get speed up music right after
-        # the bot joined.
-        await asyncio.sleep(1)
+      if not voice_channel:
+        guild.queue.appendleft(song)
+        guild.state = PlaybackState.idle
+        await event.reply('Join a voice channel and type `resume` to start playing music!')
+        return
+      voice_client = await voice_channel.connect()
+      ready = await wait_ready(voice_client, self.voice_ready_timeout,
+        self.option('voiceSettleDelay', self.voice_settle_delay))
+      if guild.generation != generation or not ready:
+        await voice_client.disconnect()
+        if not superseded():
+          guild.state = PlaybackState.idle
+          await event.reply('Unable to connect to the voice channel, type `resume` to try again.')
+        return
+      stats.incr('voice.connects')
+      guild.voice_client = voice_client
+      guild.state = PlaybackState.resolving
 
+    try:
+      if song.partial:
+        await guild.complete_song(song)
       stream_url = await provider.get_stream_url(song)
+    except ResolveError as exc:
+      if superseded():
+        return
+      await event.reply('Unable to play **{}**: {}'.format(song.title, exc))
+      guild.state = PlaybackState.idle
+      self.next_song(guild)
+      return
+    if song.gain is None:
+      song.gain = await db.loudness.cached_gain(song.url)
+    if superseded():
+      return
+
+    # Call stream_finished() after the song is complete. We need to
+    # maintain the event state. Note that the lambda sees the *source*
+    # that is assigned below.
+    on_finished = propagate_event(self.stream_finished)
+    loop = asyncio.get_running_loop()
+    after = lambda error: asyncio.run_coroutine_threadsafe(
+      on_finished(guild, song, source, error, generation), loop)
+
+    source = await guild.start_stream(stream_url, after, position=song.position, gain=song.gain or 1.0)
+    guild.state = PlaybackState.playing
+    guild.current_song = song
+    guild.last_event = get_event()
+    stats.incr('streams.started')
+    db.track_index.add(song, song.provider_id)
+    self.prefetch(guild)
+    if not self.has_listeners(guild):
+      self.listeners_left(guild)
+
+    if not song.position:
+      await event.reply('Now playing! **{}** - {} (queued by <@{}>)'.format(song.title, song.artist, song.user_id))
+
+  async def stop_playback(self, guild, disconnect=True):
+    """
+    Stops the playback in *guild* and disconnects from the voice channel.
+    Transitions that are in progress are abandoned. If *disconnect* is
+    `False`, the connection is kept idle instead (see #IdleConnections).
+    """
+
+    guild.transition_to(PlaybackState.idle)
+    guild.current_song = None
+    self.idle_voice.discard(guild.id)
+    self._forget_auto_pause(guild)
+    self.resume_channels.pop(guild.id, None)
+    voice_client = guild.voice_client
+    if not voice_client:
+      return
+    voice_client.stop()
+    if not disconnect and voice_client.is_connected():
+      self.idle_voice.park(guild.id, voice_client)
+      return
+    guild.voice_client = None
+    await voice_client.disconnect()
+
+  async def release_voice(self, guild_id, voice_client):
+    """
+    Disconnects an idle voice connection that expired or was evicted. A
+    suspended playback (see #suspend_playback()) still continues when a
+    listener joins the channel again.
+    """
+
+    guild = guilds.get(guild_id)
+    if guild and guild.voice_client is voice_client:
+      if guild.state != PlaybackState.idle:
+        return
+      guild.voice_client = None
+    await voice_client.disconnect()
+
+  def voice_channel(self, guild):
+    """
+    Returns the voice channel of *guild*, or the channel of a suspended
+    playback whose connection was closed.
+    """
+
+    if guild.voice_client:
+      return guild.voice_client.channel
+    entry = self.auto_paused.get(guild.id)
+    return entry[2] if entry else None
+
+  def has_listeners(self, guild):
+    """
+    Returns `True` if anyone but bots is in the voice channel of *guild*.
+    """
+
+    channel = self.voice_channel(guild)
+    return bool(channel) and any(not member.bot for member in channel.members)
+
+  @on('voice_state_update')
+  async def voice_state_update(self):
+    guild = guilds.get(event.member.guild.id)
+    channel = self.voice_channel(guild) if guild else None
+    if not channel or channel not in (event.before.channel, event.after.channel):
+      return
+    if self.has_listeners(guild):
+      self.listeners_returned(guild)
+    else:
+      self.listeners_left(guild)
+
+  def _forget_auto_pause(self, guild):
+    entry = self.auto_paused.pop(guild.id, None)
+    if entry and entry[1]:
+      entry[1].cancel()
+    return entry
+
+  def listeners_left(self, guild):
+    """
+    Pauses the playback in *guild* because nobody is listening anymore. The
+    stream is closed with #suspend_playback() if nobody comes back within
+    "emptyChannelTimeout" seconds.
+    """
+
+    if guild.state != PlaybackState.playing:
+      return
+    self._forget_auto_pause(guild)
+    guild.voice_client.pause()
+    guild.state = PlaybackState.paused
+    stats.incr('playback.auto_paused')
+    generation = guild.generation
+    timeout = self.option('emptyChannelTimeout', self.empty_channel_timeout)
+    handle = asyncio.get_event_loop().call_later(timeout,
+      lambda: asyncio.ensure_future(self.suspend_playback(guild, generation)))
+    self.auto_paused[guild.id] = (generation, handle, guild.voice_client.channel)
+
+  async def suspend_playback(self, guild, generation):
+    """
+    Closes the stream of a playback that was paused by #listeners_left().
+    The current song is put back to the front of the queue with its
+    position and the voice connection is kept idle.
+    """
+
+    entry = self.auto_paused.get(guild.id)
+    if not entry or entry[0] != generation or guild.generation != generation \
+        or guild.state != PlaybackState.paused:
+      return
+    song, position = guild.current_song, guild.position
+    await self.stop_playback(guild, disconnect=False)
+    if song:
+      song.position = position
+      guild.queue.appendleft(song)
+    self.auto_paused[guild.id] = (guild.generation, None, entry[2])
+    stats.incr('playback.suspended')
+    logger.info('Closed the stream in guild {}, nobody is listening.'.format(guild.id))
+
+  def listeners_returned(self, guild):
+    """
+    Continues a playback that was paused or suspended because nobody was
+    listening.
+    """
+
+    entry = self._forget_auto_pause(guild)
+    if not entry or entry[0] != guild.generation:
+      return
+    if guild.state == PlaybackState.paused and entry[1]:
+      guild.voice_client.resume()
+      guild.state = PlaybackState.playing
+      stats.incr('playback.auto_resumed')
+    elif guild.state == PlaybackState.idle and not entry[1] and guild.last_event:
+      stats.incr('playback.auto_resumed')
+      if not guild.voice_client:
+        self.resume_channels[guild.id] = entry[2]
+      with set_event(guild.last_event):
+        self.next_song(guild)
+
+  async def stream_finished(self, guild, song, source, error, generation):
+    """
+    Called when the stream of *song* ended. If the stream broke off before
+    the end of the song, the song is put back to the front of the queue to
+    continue at the position where it stopped. Songs are marked partial for
+    that so that providers re-resolve expired stream URLs.
+    """
+
+    if guild.generation != generation:
+      return  # The playback was stopped.
+
+    broken = error is not None
+    if not broken and source.eof and song.duration:
+      broken = source.position < int(song.duration) - self.stream_end_tolerance
+
+    if not broken:
+      if song.retries:
+        stats.incr('streams.recovered')
+    elif song.retries >= self.option('streamRetries', self.max_stream_retries):
+      stats.incr('streams.failed')
+      logger.error('Stream of {} failed after {} retries: {}'.format(song.url, song.retries, error))
+      await event.reply('Lost the stream of **{}** - {}, continuing with the next song.'.format(song.title, song.artist))
+    else:
+      stats.incr('streams.retries')
+      logger.warning('Stream of {} broke off at {:.1f}s, reconnecting: {}'.format(song.url, source.position, error))
+      song.retries += 1
+      song.position = source.position
+      song.partial = True
+      await asyncio.sleep(song.retries)
+      if guild.generation != generation:
+        return
+      guild.queue.appendleft(song)
 
-      # Call skip() after the song is complete. We need to maintain the
-      # event state.
-      do_skip = propagate_event(lambda: self.song_resumer.put(guild))
-      loop = asyncio.get_running_loop()
-      after = lambda _: asyncio.run_coroutine_threadsafe(do_skip(), loop)
+    self.next_song(guild)
 
-      await guild.start_stream(stream_url, after)
+  def next_song(self, guild):
+    """
+    Schedules the transition to the next song in the guild's worker.
+    """
 
-    user = await self.client.get_user_info(song.user_id)
-    await event.reply('Now playing! **{}** - {} (queued by {})'.format(song.title, song.artist, user.mention))
+    self.transitions.put(guild.id, get_event())
+
+  async def transition(self, guild_id, ev):
+    if not self.active:
+      return
+    with set_event(ev):
+      await self.play_next()
+
+  @command(regex='stats')
+  async def show_stats(self):
+    # The database and admission lines are always there, only the counters
+    # can be missing.
+    lines = ['{}: {}'.format(name, value) for name, value in stats.items()] or ['No counters yet.']
+    lines.append('db.operations: {} in {} transactions'.format(db.worker.operations, db.worker.batches))
+    lines.append('db.latency: p50 {:.1f}ms, p95 {:.1f}ms, p99 {:.1f}ms'.format(*db.worker.latencies()))
+    lines.append('admission.pending: {}'.format(self.admission.pending))
+    await event.reply('```\n{}\n```'.format('\n'.join(lines)))
 
   @command(regex='pause')
   async def pause(self):
     guild = get_guild()
-    async with guild.lock:
-      if guild.voice_client and guild.voice_client.is_playing():
-        guild.voice_client.pause()
+    if guild.state == PlaybackState.playing:
+      guild.voice_client.pause()
+      guild.state = PlaybackState.paused
 
   @command(regex='(skip)')
   async def skip(self, as_command=None):
     guild = get_guild()
-    async with guild.lock:
-      if guild.voice_client and guild.voice_client.is_playing():
-        guild.voice_client.stop()
+    if guild.state in (PlaybackState.playing, PlaybackState.paused):
+      # The next song is started by stream_finished().
+      guild.voice_client.stop()
 
   @command(regex='clear\s+queue')
   async def clear_queue(self):
     guild = get_guild()
-    async with guild.lock:
-      guild.queue = []
+    guild.queue.clear()
+
+  def _queue_index(self, guild, position):
+    """
+    Converts a 1-based queue *position* from a command to an index into the
+    guild's queue. Returns `None` if the position is out of range.
+    """
+
+    index = int(position) - 1
+    if 0 <= index < len(guild.queue):
+      return index
+    return None
+
+  @command(regex='remove\s+(\d+)')
+  async def remove(self, position):
+    guild = get_guild()
+    index = self._queue_index(guild, position)
+    if index is None:
+      await event.reply('There is no song at position {} in the queue.'.format(position))
+      return
+    song = guild.queue.remove(index)
+    await event.reply('Removed **{}** - {} from the queue.'.format(song.title, song.artist))
+
+  @command(regex='move\s+(\d+)\s+(?:to\s+)?(\d+)')
+  async def move(self, src, dst):
+    guild = get_guild()
+    src_index = self._queue_index(guild, src)
+    dst_index = self._queue_index(guild, dst)
+    if src_index is None or dst_index is None:
+      await event.reply('Positions must be between 1 and {}.'.format(len(guild.queue)))
+      return
+    song = guild.queue.move(src_index, dst_index)
+    await event.reply('Moved **{}** - {} to position {}.'.format(song.title, song.artist, dst_index + 1))
+
+  @command(regex='shuffle')
+  async def shuffle(self):
+    guild = get_guild()
+    guild.queue.shuffle()
+    await event.reply('Shuffled {} songs.'.format(len(guild.queue)))
+
+  @command(regex='jump\s+(\d+)')
+  async def jump(self, position):
+    guild = get_guild()
+    index = self._queue_index(guild, position)
+    if index is None:
+      await event.reply('There is no song at position {} in the queue.'.format(position))
+      return
+    guild.queue.skip(index)
+    if guild.state in (PlaybackState.playing, PlaybackState.paused):
+      # The next song is started by stream_finished().
+      guild.voice_client.stop()
+    elif guild.state == PlaybackState.idle:
+      self.next_song(guild)
 
   @command(regex='stop(\s*)(!+)?')
   async def stop(self, ws=None, exclam=None):
@@ -329,13 +1230,9 @@ class QuelBehavior(EventMultiplexer):
     exclam = exclam or ''
 
     guild = get_guild()
-    async with guild.lock:
-      if guild.voice_client:
-        guild.voice_client.stop()
-        await guild.voice_client.disconnect()
-        guild.voice_client = None
-      else:
-        return
+    if guild.state == PlaybackState.idle and not guild.voice_client:
+      return
+    await self.stop_playback(guild)
     if len(exclam) > 0:
       response = 'Ok'
       if len(exclam) >= 3:
@@ -344,38 +1241,38 @@ class QuelBehavior(EventMultiplexer):
         response += ws + exclam*2
       await event.reply(response)
 
-  @command(regex='queue')
-  async def queue(self):
-    with orm.db_session:
-      guild = get_guild()
-
-    lines = ['**Queue**']
-    embed = discord.Embed(title='Queued songs')
-    async with guild.lock:
-      for song in guild.queue:
-        user = await self.client.get_user_info(song.user_id)
-        embed.add_field(name=song.title, value='{} (queued by {})'.format(song.artist, user.mention), inline=False)
-        lines.append('{} - {} (queued by {})'.format(song.title, song.artist, user.mention))
-    try:
-      await event.reply(embed=embed)
-    except discord.Forbidden:
-      await event.reply('\n'.join(lines))
-
   @command(regex='volume(?:\s+(\d+))?')
   async def volume(self, value):
-    with orm.db_session:
-      guild = get_guild()
-      if value is None:
-        await event.reply('Current volume is **{}**'.format(int(round(guild.volume * 100))))
-      else:
-        guild.set_volume(int(value) / 100)
+    guild = get_guild()
+    if value is None:
+      await event.reply('Current volume is **{}**'.format(int(round(guild.volume * 100))))
+    else:
+      guild = await load_guild(guild.id, db.Guild.set_volume, int(value) / 100)
+      guild.apply_volume()
 
   @command(regex='reload')
   async def reload(self):
-    if reloader.is_inner():
+    if not reloader.is_inner():
+      await event.reply('Reloading not enabled.')
+    elif not reloader.blue_green:
       reloader.send_reload()
     else:
-      await event.reply('Reloading not enabled.')
+      await event.reply('Starting a new instance ...')
+      channel = await run_in_executor(None, reloader.request_handoff)
+      if channel is None:
+        await event.reply('Reload failed, keeping the current instance.')
+        return
+      self.active = False
+      if self.cluster:
+        # The new process takes over the guilds with their leases.
+        await self.cluster.release(self)
+        state = {'guilds': []}
+      else:
+        state = self.export_state()
+      for guild in list(guilds.values()):
+        await self.stop_playback(guild)
+      await run_in_executor(None, reloader.send_state, channel, state)
+      await self.client.logout()
 
   @command(regex='.*')
   async def fallback(self):
@@ -400,12 +1297,20 @@ def main():
   parser.add_argument('-c', '--config', default='config.json')
   parser.add_argument('-v', '--verbose', action='store_true')
   parser.add_argument('-r', '--reload', action='store_true')
+  parser.add_argument('--blue-green', action='store_true',
+    help='Start a standby process on reload that takes over the state of the running one.')
   parser.add_argument('--prod', '--production', dest='production', action='store_true')
+  parser.add_argument('--cluster', action='store_true',
+    help='Share the guilds with the other nodes that use the same database.')
+  parser.add_argument('--node-id', help='The name of this node in the cluster. '
+    'Defaults to the hostname and the process ID.')
   args = parser.parse_args()
 
   with open(args.config) as fp:
     config = json.load(fp)
 
+  reloader.blue_green = args.blue_green
+
   loglevel = logging.INFO if args.verbose else logging.WARNING
   logformat = config.get('logging', {}).get('format')
   if not logformat:
@@ -416,13 +1321,23 @@ def main():
     logger.info('Starting reloader ...')
     return reloader.run_forever([sys.executable, '-m', 'quel.main'] + sys.argv[1:])
 
+  bot_config = config['botConfig']
+
   logger.info('Binding database ...')
-  if 'filename' in config['dbConfig']:
-    config['dbConfig']['filename'] = os.path.abspath(config['dbConfig']['filename'])
-  db.db.bind(**config['dbConfig'])
+  db_config = dict(config['dbConfig'])
+  pragmas = db_config.pop('pragmas', None)
+  if 'filename' in db_config:
+    db_config['filename'] = os.path.abspath(db_config['filename'])
+  if db_config.get('provider') == 'sqlite':
+    db.configure_sqlite(db.db, pragmas)
+  db.db.bind(**db_config)
   db.db.generate_mapping(create_tables=True)
+  db.track_index.max_tracks = bot_config.get('maxIndexedTracks', db.track_index.max_tracks)
+  db.track_index.setup()
+  db.loudness.enabled = bot_config.get('normalizeLoudness', True)
+  db.loudness.target = bot_config.get('loudnessTarget', db.loudness.target)
+  RawFileProvider.allow_private_hosts = bot_config.get('allowPrivateHosts', False)
 
-  bot_config = config['botConfig']
   if 'token' in bot_config:
     token = bot_config['token']
   elif args.production:
@@ -432,9 +1347,19 @@ def main():
 
   logger.info('Starting ...')
 
+  cluster = None
+  if args.cluster:
+    cluster = db.Cluster(db.worker, args.node_id,
+      lease_ttl=bot_config.get('clusterLeaseTtl', 30.0),
+      heartbeat_interval=bot_config.get('clusterHeartbeatInterval', 10.0),
+      max_guilds=bot_config.get('clusterMaxGuilds'))
+
   client = Client()
-  client.add_handler(QuelBehavior(config))
+  client.add_handler(QuelBehavior(config, cluster))
   client.run(token)
+  if cluster:
+    cluster.close()
+  db.worker.stop()
 
   logger.info('Bye bye.')
 
@@ -1,12 +1,68 @@
 
 from nr.types.named import Named
+from quel.core.breaker import BreakerState, CircuitBreaker, CircuitOpen
+from quel.core.stats import stats
+from quel.core.utils import SingleFlight, TTLCache
 from typing import *
 
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+
 
 class Provider:
 
   id = None
   name = None
+  _flights = None
+  _breakers = None
+  _executor = None
+
+  # The number of threads that the blocking calls of this provider can use
+  # at the same time (see #executor).
+  max_workers = 8
+
+  # The number of consecutive failures after which calls to the provider
+  # fail fast, and the number of seconds after which a call is let through
+  # again to probe it (see #CircuitBreaker).
+  failure_threshold = 5
+  reset_timeout = 30.0
+
+  @property
+  def flights(self):
+    """
+    The #SingleFlight group shared by all instances of this provider.
+    """
+
+    if self._flights is None:
+      self._flights = SingleFlight()
+    return self._flights
+
+  @property
+  def executor(self):
+    """
+    The executor for blocking calls of this provider's instances. Calls
+    that hang only use up the threads of their own provider.
+    """
+
+    if self._executor is None:
+      self._executor = concurrent.futures.ThreadPoolExecutor(
+        self.max_workers, thread_name_prefix='quel-{}'.format(self.id))
+    return self._executor
+
+  def breaker(self, key=None):
+    """
+    Returns the #CircuitBreaker for the instances of this provider with the
+    flight *key* (see #ProviderInstance.flight_key()).
+    """
+
+    if self._breakers is None:
+      self._breakers = {}
+    breaker = self._breakers.get(key)
+    if breaker is None:
+      breaker = self._breakers[key] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+    return breaker
 
   def get_option_names(self):
     return []
@@ -19,6 +75,14 @@ class ProviderInstance:
 
   error = None
 
+  # The number of seconds after which the methods decorated with #guarded()
+  # and #guarded_iter() give up.
+  deadlines = {
+    'resolve_url': 30.0,
+    'get_stream_url': 20.0,
+    'search': 15.0,
+  }
+
   def __init__(self, provider):
     self.provider = provider
 
@@ -30,6 +94,45 @@ class ProviderInstance:
   def name(self):
     return self.provider.name
 
+  def flight_key(self):
+    """
+    Returns a hashable value that distinguishes instances of the same
+    provider whose calls can give different results, eg. because they use
+    different credentials. Calls are only shared between instances with the
+    same key (see #single_flight()).
+    """
+
+    return None
+
+  @property
+  def breaker(self):
+    return self.provider.breaker(self.flight_key())
+
+  def is_failure(self, exc):
+    """
+    Returns `True` if the exception *exc* raised by a guarded method means
+    that the provider is not working. A #ResolveError means that it works,
+    but can not handle the request.
+    """
+
+    return not isinstance(exc, ResolveError)
+
+  def status(self):
+    """
+    Returns a description of the state of the provider for the "providers
+    status" command.
+    """
+
+    if self.error:
+      return self.error
+    breaker = self.breaker
+    if breaker.state == BreakerState.open:
+      return 'Degraded, {} failures in a row, trying again in {:.0f}s'.format(
+        breaker.failures, max(1, breaker.retry_after()))
+    if breaker.state == BreakerState.half_open:
+      return 'Degraded, {} failures in a row, trying again now'.format(breaker.failures)
+    return 'Ok'
+
   def supports_search(self):
     return False
 
@@ -42,10 +145,176 @@ class ProviderInstance:
   async def resolve_url(self, url, match_data):
     raise NotImplementedError
 
+  async def probe_url(self, url, urlinfo) -> Tuple[bool, Any]:
+    """
+    Called for URLs that no provider accepted in #match_url(). Unlike
+    #match_url(), this may inspect the resource behind the URL, eg. its
+    content type. Returns the same as #match_url().
+    """
+
+    return False, None
+
+  def match_playlist(self, url, match_data) -> bool:
+    """
+    Called for URLs accepted by #match_url(). Returns `True` if the URL should
+    be imported with #iter_playlist() instead of #resolve_url().
+    """
+
+    return False
+
+  async def iter_playlist(self, url, match_data):
+    """
+    Yields the songs of a playlist as they are discovered. The songs may be
+    partial (see #Song.partial), in which case they are completed with
+    #complete_song() shortly before they are played.
+    """
+
+    return; yield
+
+  async def complete_song(self, song):
+    """
+    Returns a fully resolved version of a partial *song*.
+    """
+
+    return song
+
   async def get_stream_url(self, song):
     raise NotImplementedError
 
 
+def single_flight(key_func):
+  """
+  Decorator for coroutine methods of a #ProviderInstance. Concurrent calls
+  with the same key share one call, across all instances of the provider
+  that have the same #ProviderInstance.flight_key(). *key_func* is called
+  with the arguments of the method and must return a hashable key.
+  """
+
+  def decorator(func):
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+      key = (func.__name__, self.flight_key(), key_func(*args, **kwargs))
+      return await self.provider.flights.do(key, func, self, *args, **kwargs)
+    return wrapper
+  return decorator
+
+
+_guarding = contextvars.ContextVar('quel.providers._guarding', default=None)
+
+
+async def _guard(instance, operation, func):
+  breaker = instance.breaker
+  if _guarding.get() is breaker:
+    return await func()  # Nested in a guarded call of the same provider.
+  try:
+    probe = breaker.acquire()
+  except CircuitOpen as exc:
+    stats.incr('providers.{}.rejected'.format(instance.id))
+    raise ResolveError('{} is not available right now, try again in {:.0f} seconds.'.format(
+      instance.name, max(1, exc.retry_after)))
+  timeout = instance.deadlines.get(operation)
+  token = _guarding.set(breaker)
+  try:
+    result = await asyncio.wait_for(func(), timeout)
+  except asyncio.TimeoutError:
+    breaker.failure(probe)
+    stats.incr('providers.{}.timeouts'.format(instance.id))
+    raise ResolveError('{} did not answer within {:g} seconds.'.format(instance.name, timeout))
+  except asyncio.CancelledError:
+    breaker.abort(probe)
+    raise
+  except Exception as exc:
+    if instance.is_failure(exc):
+      breaker.failure(probe)
+      stats.incr('providers.{}.failures'.format(instance.id))
+    else:
+      breaker.success(probe)
+    raise
+  finally:
+    _guarding.reset(token)
+  breaker.success(probe)
+  return result
+
+
+def guarded(func):
+  """
+  Decorator for coroutine methods of a #ProviderInstance. The call is
+  cancelled after the deadline for the method in
+  #ProviderInstance.deadlines and counts towards the provider's
+  #CircuitBreaker. Timeouts and rejected calls raise a #ResolveError. Work
+  that is shared with #single_flight() continues for the other callers.
+  """
+
+  @functools.wraps(func)
+  async def wrapper(self, *args, **kwargs):
+    return await _guard(self, func.__name__, lambda: func(self, *args, **kwargs))
+  return wrapper
+
+
+def guarded_iter(func):
+  """
+  Like #guarded(), but for asynchronous generator methods. The items are
+  collected before they are yielded.
+  """
+
+  @functools.wraps(func)
+  async def wrapper(self, *args, **kwargs):
+    async def collect():
+      return [item async for item in func(self, *args, **kwargs)]
+    for item in await _guard(self, func.__name__, collect):
+      yield item
+  return wrapper
+
+
+def single_flight_iter(key_func):
+  """
+  Like #single_flight(), but for asynchronous generator methods. The items
+  of the shared call are collected before they are yielded to the callers.
+  """
+
+  def decorator(func):
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+      async def collect():
+        return [item async for item in func(self, *args, **kwargs)]
+      key = (func.__name__, self.flight_key(), key_func(*args, **kwargs))
+      for item in await self.provider.flights.do(key, collect):
+        yield item
+    return wrapper
+  return decorator
+
+
+def cached_iter(key_func, ttl=600, maxsize=1024):
+  """
+  Decorator for asynchronous generator methods of a #ProviderInstance that
+  caches the items for *ttl* seconds. Like #single_flight(), the cache is
+  shared by all instances of the provider with the same flight key.
+  """
+
+  def decorator(func):
+    cache = TTLCache(ttl, maxsize)
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+      key = (self.id, self.flight_key(), key_func(*args, **kwargs))
+      items = cache.get(key)
+      if items is None:
+        items = [item async for item in func(self, *args, **kwargs)]
+        cache.set(key, items)
+      for item in items:
+        yield item
+    wrapper.cache = cache
+    return wrapper
+  return decorator
+
+
+def normalize_term(term):
+  """
+  Normalizes a search term for use in cache keys.
+  """
+
+  return ' '.join(term.lower().split())
+
+
 class ErrorProviderInstance(ProviderInstance):
 
   def __init__(self, provider, error):
@@ -63,6 +332,10 @@ class Song(Named):
   image_url: Optional[str] = ''
   duration: Optional[int] = ''
   purchase_url: Optional[str] = ''
+  #: A partial song only has the information that was available when it was
+  #: listed in a playlist and must be passed to
+  #: #ProviderInstance.complete_song() before it can be played.
+  partial: Optional[bool] = False
 
 
 class ResolveError(Exception):
@@ -0,0 +1,77 @@
+
+import json
+
+
+class ProviderPool:
+  """
+  Shares provider instances between guilds. Instances are keyed by the
+  provider and a fingerprint of the options that they were created with, so
+  all guilds with the same options for a provider use the same instance.
+  Instances are reference counted and dropped from the pool when the last
+  guild released them.
+  """
+
+  def __init__(self):
+    self._entries = {}
+    self._keys = {}
+
+  def __len__(self):
+    return len(self._entries)
+
+  @staticmethod
+  def fingerprint(options):
+    return json.dumps(options, sort_keys=True, default=str)
+
+  def acquire(self, provider, options):
+    """
+    Returns the shared instance of *provider* for *options*, creating it if
+    necessary. Exceptions raised by #Provider.instantiate() are propagated
+    and nothing is added to the pool in that case.
+    """
+
+    key = (provider.id, self.fingerprint(options))
+    entry = self._entries.get(key)
+    if entry is None:
+      instance = provider.instantiate(options)
+      entry = self._entries[key] = [instance, 0]
+      self._keys[id(instance)] = key
+    entry[1] += 1
+    return entry[0]
+
+  def rebuild(self, provider, options):
+    """
+    Replaces the shared instance of *provider* for *options* with a new one
+    and returns `(old, new)`. The references to the old instance are moved
+    to the new one, so the guilds that hold the old instance must switch to
+    the new one (see #Guild.replace_providers()). If there is no shared
+    instance yet, it is created like with #acquire() and `(None, new)` is
+    returned. If #Provider.instantiate() fails, the pool is unchanged.
+    """
+
+    key = (provider.id, self.fingerprint(options))
+    entry = self._entries.get(key)
+    if entry is None:
+      return None, self.acquire(provider, options)
+    old, instance = entry[0], provider.instantiate(options)
+    del self._keys[id(old)]
+    self._keys[id(instance)] = key
+    entry[0] = instance
+    return old, instance
+
+  def release(self, instance):
+    """
+    Releases a reference to an *instance* returned by #acquire(). Instances
+    that did not come from the pool are ignored.
+    """
+
+    key = self._keys.get(id(instance))
+    if key is None:
+      return
+    entry = self._entries[key]
+    entry[1] -= 1
+    if entry[1] <= 0:
+      del self._entries[key]
+      del self._keys[id(instance)]
+
+
+pool = ProviderPool()
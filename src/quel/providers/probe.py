@@ -0,0 +1,549 @@
+
+"""
+Reads the format, tags and duration of remote audio files from as few bytes
+as possible, using HTTP range requests. Supports MP3 (ID3v2), WAV, FLAC,
+Ogg Vorbis/Opus and MP4/M4A.
+"""
+
+from nr.types.named import Named
+from quel import async_requests
+from quel.core.utils import run_in_executor
+from typing import *
+from urllib.parse import urljoin, urlparse
+
+import asyncio
+import ipaddress
+import logging
+import re
+import socket
+import struct
+
+logger = logging.getLogger(__name__)
+
+content_types = {
+  'audio/mpeg': 'mp3',
+  'audio/mp3': 'mp3',
+  'audio/wav': 'wav',
+  'audio/wave': 'wav',
+  'audio/x-wav': 'wav',
+  'audio/flac': 'flac',
+  'audio/x-flac': 'flac',
+  'audio/ogg': 'ogg',
+  'audio/opus': 'ogg',
+  'application/ogg': 'ogg',
+  'audio/mp4': 'mp4',
+  'audio/x-m4a': 'mp4',
+  'audio/aac': 'mp4',
+}
+
+
+class ProbeError(Exception):
+  """
+  Raised if a file can not be probed. *status* is the HTTP status code if
+  the server returned an error.
+  """
+
+  def __init__(self, message, status=None):
+    super().__init__(message)
+    self.status = status
+
+
+class ForbiddenHost(ProbeError):
+  """
+  Raised if the host of a URL is not public (see #check_host()).
+  """
+
+
+class MalformedFile(ProbeError):
+  """
+  Raised by the parsers if the data of a file is truncated or invalid.
+  """
+
+
+async def check_host(url):
+  """
+  Raises a #ForbiddenHost error unless *url* is an HTTP(S) URL whose host
+  only resolves to public addresses. Users can pass any URL to the bot, it
+  must not make requests to itself, the local network or cloud metadata
+  services on their behalf.
+  """
+
+  urlinfo = urlparse(url)
+  if urlinfo.scheme not in ('http', 'https') or not urlinfo.hostname:
+    raise ForbiddenHost('Not an HTTP URL')
+  try:
+    port = urlinfo.port or (443 if urlinfo.scheme == 'https' else 80)
+    addresses = await asyncio.get_event_loop().getaddrinfo(
+      urlinfo.hostname, port, type=socket.SOCK_STREAM)
+  except (ValueError, socket.gaierror) as exc:
+    raise ForbiddenHost('Unable to resolve {} ({})'.format(urlinfo.hostname, exc))
+  for family, type, proto, canonname, sockaddr in addresses:
+    address = ipaddress.ip_address(sockaddr[0].partition('%')[0])
+    if address.version == 6 and address.ipv4_mapped:
+      address = address.ipv4_mapped
+    if not address.is_global or address.is_multicast:
+      raise ForbiddenHost('{} is not a public host'.format(urlinfo.hostname))
+
+
+class MediaInfo(Named):
+  format: str
+  content_type: Optional[str] = ''
+  size: Optional[int] = None
+  title: Optional[str] = ''
+  artist: Optional[str] = ''
+  album: Optional[str] = ''
+  genre: Optional[str] = ''
+  duration: Optional[float] = None
+
+
+class RangeReader:
+  """
+  Reads byte ranges of a remote file. The first *head_size* bytes are read
+  with #open() and served from memory, other ranges need a server that
+  supports range requests. At most *max_requests* requests are made.
+
+  Unless *allow_private* is `True`, the host of the URL and of every
+  redirect must be public (see #check_host()).
+  """
+
+  def __init__(self, url, head_size=65536, timeout=10, max_requests=4,
+               max_redirects=3, allow_private=False):
+    self.url = url
+    self.head_size = head_size
+    self.timeout = timeout
+    self.max_requests = max_requests
+    self.max_redirects = max_redirects
+    self.allow_private = allow_private
+    self.requests = 0
+    self.head = b''
+    self.size = None
+    self.content_type = ''
+
+  async def _get(self, range_header, length):
+    if self.requests >= self.max_requests:
+      return None, b''
+    self.requests += 1
+    for _ in range(self.max_redirects + 1):
+      if not self.allow_private:
+        await check_host(self.url)
+      response = await async_requests.get(self.url, headers={'Range': range_header},
+        stream=True, timeout=self.timeout, allow_redirects=False)
+      if not response.is_redirect:
+        break
+      response.close()
+      self.url = urljoin(self.url, response.headers['Location'])
+    else:
+      raise ProbeError('Too many redirects')
+    try:
+      if response.status_code >= 400:
+        raise ProbeError('HTTP {}'.format(response.status_code), response.status_code)
+      data = await run_in_executor(None, response.raw.read, length, decode_content=True)
+      return response, data
+    finally:
+      response.close()
+
+  async def open(self):
+    response, self.head = await self._get('bytes=0-{}'.format(self.head_size - 1), self.head_size)
+    self.content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    content_range = response.headers.get('Content-Range', '')
+    if response.status_code == 206 and '/' in content_range:
+      total = content_range.rpartition('/')[2]
+      self.size = int(total) if total.isdigit() else None
+    elif response.status_code == 200 and response.headers.get('Content-Length', '').isdigit():
+      self.size = int(response.headers['Content-Length'])
+
+  async def read(self, offset, length):
+    """
+    Returns up to *length* bytes at *offset*. A negative *offset* is
+    relative to the end of the file. Returns an empty string if the range
+    can not be read.
+    """
+
+    if offset < 0 and self.size is not None:
+      offset = max(0, self.size + offset)
+    if offset >= 0 and offset + length <= len(self.head):
+      return self.head[offset:offset + length]
+    if offset >= 0 and self.size is not None and offset + length > self.size:
+      length = self.size - offset
+    if length <= 0:
+      return b''
+    if offset < 0:
+      range_header = 'bytes={}'.format(offset)
+    else:
+      range_header = 'bytes={}-{}'.format(offset, offset + length - 1)
+    response, data = await self._get(range_header, length)
+    if response is None or response.status_code != 206:
+      return b''
+    return data
+
+
+def detect_format(data, content_type=''):
+  if data[:3] == b'ID3' or (len(data) > 1 and data[0] == 0xFF and data[1] & 0xE0 == 0xE0):
+    return 'mp3'
+  if data[:4] == b'RIFF' and data[8:12] == b'WAVE':
+    return 'wav'
+  if data[:4] == b'fLaC':
+    return 'flac'
+  if data[:4] == b'OggS':
+    return 'ogg'
+  if data[4:8] == b'ftyp':
+    return 'mp4'
+  return content_types.get(content_type)
+
+
+def _clean(value):
+  return value.split('\0')[0].strip()
+
+
+def _unpack(fmt, data, offset=0):
+  try:
+    return struct.unpack_from(fmt, data, offset)
+  except struct.error:
+    raise MalformedFile('Unexpected end of data')
+
+
+# MP3
+
+_id3_frames = {
+  'TIT2': 'title', 'TPE1': 'artist', 'TALB': 'album', 'TCON': 'genre', 'TLEN': 'length',
+  'TT2': 'title', 'TP1': 'artist', 'TAL': 'album', 'TCO': 'genre', 'TLE': 'length',
+}
+
+_id3_encodings = ['latin-1', 'utf-16', 'utf-16-be', 'utf-8']
+
+
+def _syncsafe(data):
+  return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def parse_id3(data):
+  """
+  Returns the text frames of the ID3v2 tag at the start of *data* and the
+  size of the tag.
+  """
+
+  if data[:3] != b'ID3' or len(data) < 10:
+    return {}, 0
+  major, flags = data[3], data[5]
+  end = 10 + _syncsafe(data[6:10]) + (10 if flags & 0x10 else 0)
+  pos = 10
+  if flags & 0x40 and len(data) >= 14:
+    pos += _syncsafe(data[10:14]) if major == 4 else struct.unpack('>I', data[10:14])[0] + 4
+  header_size = 6 if major == 2 else 10
+  tags = {}
+  while pos + header_size <= min(end, len(data)):
+    if major == 2:
+      frame_id = data[pos:pos + 3]
+      frame_size = int.from_bytes(data[pos + 3:pos + 6], 'big')
+    else:
+      frame_id = data[pos:pos + 4]
+      frame_size = _syncsafe(data[pos + 4:pos + 8]) if major == 4 else struct.unpack('>I', data[pos + 4:pos + 8])[0]
+    if not frame_id.strip(b'\0'):
+      break  # Padding
+    body = data[pos + header_size:pos + header_size + frame_size]
+    if len(body) < frame_size:
+      break  # The rest of the tag was not read.
+    key = _id3_frames.get(frame_id.decode('latin-1'))
+    if key and body and body[0] < len(_id3_encodings):
+      tags[key] = _clean(body[1:].decode(_id3_encodings[body[0]], 'replace'))
+    pos += header_size + frame_size
+  if 'genre' in tags:
+    tags['genre'] = re.sub(r'^\(\d+\)', '', tags['genre']) or tags['genre']
+  return tags, end
+
+
+_mp3_bitrates = {
+  1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+  2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_mp3_sample_rates = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def parse_mpeg_frame(data, size=None, offset=0):
+  """
+  Finds the first MPEG layer III frame in *data* and returns the duration of
+  the stream from its Xing/Info/VBRI header, or estimated from the bitrate
+  and the file *size*. *offset* is the position of *data* in the file.
+  """
+
+  for pos in range(max(0, len(data) - 4)):
+    if data[pos] != 0xFF or data[pos + 1] & 0xE0 != 0xE0:
+      continue
+    version = (data[pos + 1] >> 3) & 3
+    layer = (data[pos + 1] >> 1) & 3
+    bitrate_index = data[pos + 2] >> 4
+    rate_index = (data[pos + 2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+      continue
+    mono = data[pos + 3] >> 6 == 3
+    sample_rate = _mp3_sample_rates[version][rate_index]
+    samples = 1152 if version == 3 else 576
+    bitrate = _mp3_bitrates[1 if version == 3 else 2][bitrate_index] * 1000
+    side_info = (17 if mono else 32) if version == 3 else (9 if mono else 17)
+    xing = pos + 4 + side_info
+    if data[xing:xing + 4] in (b'Xing', b'Info') and len(data) >= xing + 12:
+      flags = struct.unpack('>I', data[xing + 4:xing + 8])[0]
+      if flags & 1:
+        frames = struct.unpack('>I', data[xing + 8:xing + 12])[0]
+        return frames * samples / sample_rate
+    vbri = pos + 36
+    if data[vbri:vbri + 4] == b'VBRI' and len(data) >= vbri + 18:
+      frames = struct.unpack('>I', data[vbri + 14:vbri + 18])[0]
+      return frames * samples / sample_rate
+    if size:
+      return (size - offset - pos) * 8 / bitrate
+    return None
+  return None
+
+
+async def probe_mp3(reader, info):
+  tags, audio_start = parse_id3(reader.head)
+  if audio_start > len(reader.head):
+    # The tag is larger than the head, often because of cover art.
+    data = await reader.read(audio_start, 4096)
+  else:
+    data, audio_start = reader.head[audio_start:], audio_start
+  info.duration = parse_mpeg_frame(data, reader.size, audio_start)
+  length = tags.pop('length', '')
+  if length.isdigit() and not info.duration:
+    info.duration = int(length) / 1000
+  return tags
+
+
+# WAV
+
+async def probe_wav(reader, info):
+  data = reader.head
+  pos = 12
+  byte_rate = None
+  tags = {}
+  while pos + 8 <= len(data):
+    chunk_id = data[pos:pos + 4]
+    chunk_size = struct.unpack('<I', data[pos + 4:pos + 8])[0]
+    body = data[pos + 8:pos + 8 + chunk_size]
+    if chunk_id == b'fmt ' and len(body) >= 12:
+      byte_rate = struct.unpack('<I', body[8:12])[0]
+    elif chunk_id == b'LIST' and body[:4] == b'INFO':
+      names = {b'INAM': 'title', b'IART': 'artist', b'IPRD': 'album', b'IGNR': 'genre'}
+      sub = 4
+      while sub + 8 <= len(body):
+        sub_id = body[sub:sub + 4]
+        sub_size = struct.unpack('<I', body[sub + 4:sub + 8])[0]
+        if sub_id in names:
+          tags[names[sub_id]] = _clean(body[sub + 8:sub + 8 + sub_size].decode('latin-1'))
+        sub += 8 + sub_size + (sub_size & 1)
+    elif chunk_id == b'data':
+      if byte_rate:
+        if chunk_size in (0, 0xFFFFFFFF) and reader.size:
+          chunk_size = reader.size - pos - 8
+        info.duration = chunk_size / byte_rate
+      break
+    pos += 8 + chunk_size + (chunk_size & 1)
+  return tags
+
+
+# FLAC and Ogg
+
+_vorbis_fields = {'TITLE': 'title', 'ARTIST': 'artist', 'ALBUM': 'album', 'GENRE': 'genre'}
+
+
+def parse_vorbis_comment(data):
+  """
+  Parses a Vorbis comment block. A truncated block yields the comments that
+  were read completely.
+  """
+
+  tags = {}
+  if len(data) < 8:
+    return tags
+  pos = 4 + struct.unpack('<I', data[:4])[0]
+  if pos + 4 > len(data):
+    return tags
+  count = struct.unpack('<I', data[pos:pos + 4])[0]
+  pos += 4
+  for _ in range(count):
+    if pos + 4 > len(data):
+      break
+    length = struct.unpack('<I', data[pos:pos + 4])[0]
+    comment = data[pos + 4:pos + 4 + length]
+    if len(comment) < length:
+      break
+    key, _, value = comment.decode('utf8', 'replace').partition('=')
+    key = _vorbis_fields.get(key.upper())
+    if key and key not in tags:
+      tags[key] = value.strip()
+    pos += 4 + length
+  return tags
+
+
+async def probe_flac(reader, info):
+  pos = 4
+  tags = {}
+  while True:
+    header = await reader.read(pos, 4)
+    if len(header) < 4:
+      break
+    block_type = header[0] & 0x7F
+    length = int.from_bytes(header[1:4], 'big')
+    if block_type in (0, 4):
+      body = await reader.read(pos + 4, length)
+      if block_type == 0 and len(body) >= 18:
+        value = int.from_bytes(body[10:18], 'big')
+        sample_rate, total_samples = value >> 44, value & ((1 << 36) - 1)
+        if sample_rate and total_samples:
+          info.duration = total_samples / sample_rate
+      elif block_type == 4:
+        tags = parse_vorbis_comment(body)
+    if header[0] & 0x80 or (block_type == 4 and info.duration is not None):
+      break
+    pos += 4 + length
+  return tags
+
+
+def iter_ogg_packets(data):
+  """
+  Yields the packets of the first logical stream in *data*. The last packet
+  may be incomplete.
+  """
+
+  pos = 0
+  packet = b''
+  serial = None
+  while data[pos:pos + 4] == b'OggS' and pos + 27 <= len(data):
+    page_serial = struct.unpack('<I', data[pos + 14:pos + 18])[0]
+    count = data[pos + 26]
+    lacing = data[pos + 27:pos + 27 + count]
+    body = pos + 27 + count
+    if serial is None:
+      serial = page_serial
+    if page_serial == serial:
+      for value in lacing:
+        packet += data[body:body + value]
+        body += value
+        if value < 255:
+          yield packet
+          packet = b''
+    pos = pos + 27 + count + sum(lacing)
+  if packet:
+    yield packet
+
+
+async def probe_ogg(reader, info):
+  packets = iter_ogg_packets(reader.head)
+  ident = next(packets, b'')
+  comment = next(packets, b'')
+  if ident[:8] == b'OpusHead':
+    sample_rate, pre_skip = 48000, _unpack('<H', ident, 10)[0]
+    tags = parse_vorbis_comment(comment[8:]) if comment[:8] == b'OpusTags' else {}
+  elif ident[:7] == b'\x01vorbis':
+    sample_rate, pre_skip = _unpack('<I', ident, 12)[0], 0
+    tags = parse_vorbis_comment(comment[7:]) if comment[:7] == b'\x03vorbis' else {}
+  else:
+    return {}
+
+  # The granule position of the last page is the number of samples.
+  tail = await reader.read(-65536, 65536)
+  pos = tail.rfind(b'OggS')
+  if pos >= 0 and pos + 14 <= len(tail) and sample_rate:
+    granule = struct.unpack('<q', tail[pos + 6:pos + 14])[0]
+    if granule > 0:
+      info.duration = (granule - pre_skip) / sample_rate
+  return tags
+
+
+# MP4
+
+_mp4_fields = {b'\xa9nam': 'title', b'\xa9ART': 'artist', b'\xa9alb': 'album', b'\xa9gen': 'genre'}
+
+
+def iter_atoms(data, pos=0, end=None):
+  """
+  Yields `(type, body_start, atom_end)` for the atoms in *data*. The end of
+  the last atom may lie beyond *data*.
+  """
+
+  end = len(data) if end is None else end
+  while pos + 8 <= min(end, len(data)):
+    size, kind = struct.unpack('>I4s', data[pos:pos + 8])
+    header = 8
+    if size == 1 and pos + 16 <= len(data):
+      size, header = struct.unpack('>Q', data[pos + 8:pos + 16])[0], 16
+    elif size == 0:
+      size = end - pos
+    if size < header:
+      break
+    yield kind, pos + header, pos + size
+    pos += size
+
+
+def parse_moov(data):
+  info = {}
+  for kind, start, end in iter_atoms(data):
+    if kind == b'mvhd':
+      if data[start:start + 1] == b'\1':
+        timescale, duration = _unpack('>IQ', data, start + 20)
+      else:
+        timescale, duration = _unpack('>II', data, start + 12)
+      if timescale:
+        info['duration'] = duration / timescale
+    elif kind == b'udta':
+      for meta, meta_start, meta_end in iter_atoms(data, start, end):
+        if meta != b'meta':
+          continue
+        for ilst, ilst_start, ilst_end in iter_atoms(data, meta_start + 4, meta_end):
+          if ilst != b'ilst':
+            continue
+          for item, item_start, item_end in iter_atoms(data, ilst_start, ilst_end):
+            if item not in _mp4_fields:
+              continue
+            for value, value_start, value_end in iter_atoms(data, item_start, item_end):
+              if value == b'data':
+                info[_mp4_fields[item]] = data[value_start + 8:value_end].decode('utf8', 'replace').strip()
+  return info
+
+
+async def probe_mp4(reader, info, max_moov_size=4 * 1024 * 1024):
+  # The moov atom is at the end of files that are not optimized for
+  # streaming, so the top-level atoms are walked with range requests.
+  pos = 0
+  while reader.size is None or pos + 8 <= reader.size:
+    header = await reader.read(pos, 16)
+    atoms = list(iter_atoms(header))
+    if not atoms or header[:4] == b'\0\0\0\0':
+      break  # Unreadable, or the last atom extends to the end of the file.
+    kind, start, end = atoms[0]
+    if kind == b'moov':
+      moov = await reader.read(pos + start, min(end - start, max_moov_size))
+      tags = parse_moov(moov)
+      info.duration = tags.pop('duration', None)
+      return tags
+    pos += end
+  return {}
+
+
+_probes = {'mp3': probe_mp3, 'wav': probe_wav, 'flac': probe_flac, 'ogg': probe_ogg, 'mp4': probe_mp4}
+
+
+async def probe(url, **kwargs):
+  """
+  Returns the #MediaInfo for the audio file at *url*. Raises a #ProbeError
+  if the server returns an error or the file is not a supported audio file,
+  and a #ForbiddenHost error if the host is not public. The *kwargs* are
+  passed to the #RangeReader.
+  """
+
+  reader = RangeReader(url, **kwargs)
+  await reader.open()
+  fmt = detect_format(reader.head, reader.content_type)
+  if not fmt:
+    raise ProbeError('Not a supported audio file ({})'.format(reader.content_type or 'unknown type'))
+  info = MediaInfo(fmt, content_type=reader.content_type, size=reader.size)
+  try:
+    tags = await _probes[fmt](reader, info)
+  except MalformedFile as exc:
+    logger.warning('Unable to parse {} file {}: {}'.format(fmt, url, exc))
+    tags = {}
+  for key, value in tags.items():
+    if value:
+      setattr(info, key, value)
+  return info
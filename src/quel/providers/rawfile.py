@@ -1,15 +1,35 @@
 
-from . import Provider, ProviderInstance, Song
+from . import Provider, ProviderInstance, ResolveError, Song, single_flight
+from .probe import ForbiddenHost, ProbeError, probe
+from quel.core.utils import TTLCache
 from urllib.parse import urlparse
 
+import logging
 import posixpath
+import requests
+
+logger = logging.getLogger(__name__)
 
 
 class RawFileProvider(Provider, ProviderInstance):
+  """
+  Plays audio files from arbitrary URLs. The title, artist and duration are
+  read from the tags of the file with a few range requests (see
+  #probe.probe()), the results are cached for *probe_ttl* seconds. URLs
+  without a known extension are accepted in #probe_url() if the server
+  reports an audio content type.
+
+  URLs whose host is not public are rejected before any request is made,
+  unless #allow_private_hosts is enabled (see #probe.check_host()).
+  """
 
   id = 'rawfile'
   name = 'File/URL'
   error = None
+  extensions = ('mp3', 'wav', 'ogg', 'oga', 'opus', 'flac', 'm4a', 'mp4', 'aac')
+  probe_ttl = 3600
+  allow_private_hosts = False
+  _cache = TTLCache(probe_ttl, maxsize=4096)
 
   def __init__(self):
     pass
@@ -22,12 +42,50 @@ class RawFileProvider(Provider, ProviderInstance):
     return self
 
   def match_url(self, url, urlinfo):
-    ext = urlinfo.path.rpartition('.')[-1]
-    return ext in ('mp3', 'wav'), None
+    ext = urlinfo.path.rpartition('.')[-1].lower()
+    return ext in self.extensions, None
+
+  async def probe_url(self, url, urlinfo):
+    if urlinfo.scheme not in ('http', 'https'):
+      return False, None
+    try:
+      await self.probe(url)
+    except (ProbeError, requests.RequestException):
+      return False, None
+    return True, None
+
+  @single_flight(lambda url: url)
+  async def probe(self, url):
+    """
+    Returns the cached #probe.MediaInfo for *url*, probing the file if it
+    is not cached. Raises a #ProbeError if the file can not be read or is
+    not a supported audio file.
+    """
+
+    info = self._cache.get(url)
+    if info is None:
+      info = await probe(url, allow_private=self.allow_private_hosts)
+      self._cache.set(url, info)
+    return info
 
+  @single_flight(lambda url, match_data: url)
   async def resolve_url(self, url, match_data):
     title = posixpath.basename(urlparse(url).path)
-    return Song(url, title=title, artist='Unknown')
+    try:
+      info = await self.probe(url)
+    except requests.RequestException as exc:
+      raise ResolveError('Unable to read file ({})'.format(exc))
+    except ForbiddenHost as exc:
+      raise ResolveError(str(exc))
+    except ProbeError as exc:
+      if exc.status is not None:
+        raise ResolveError('Unable to read file ({})'.format(exc))
+      # The URL has a known extension, leave it to FFmpeg.
+      logger.info('Unable to probe {}: {}'.format(url, exc))
+      return Song(url, title=title, artist='Unknown')
+    return Song(url, title=info.title or title, artist=info.artist or 'Unknown',
+      album=info.album, genre=info.genre,
+      duration=int(info.duration) if info.duration else '')
 
   async def get_stream_url(self, song):
     return song.url
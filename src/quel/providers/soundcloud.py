@@ -1,8 +1,9 @@
 
-from . import Provider, ProviderInstance, Song
+from . import Provider, ProviderInstance, ResolveError, Song, cached_iter, guarded, guarded_iter, normalize_term, single_flight, single_flight_iter
 from quel.core.utils import run_in_executor
 
 import logging
+import requests
 import soundcloud
 
 logger = logging.getLogger(__name__)
@@ -24,6 +25,7 @@ class SoundCloudInstance(ProviderInstance):
 
   def __init__(self, provider, client_id):
     super().__init__(provider)
+    self.client_id = client_id
     if not client_id:
       self.error = 'Missing client ID.'
       self.client = None
@@ -32,7 +34,15 @@ class SoundCloudInstance(ProviderInstance):
 
   async def _get(self, endpoint, *args, **kwargs):
     logger.info('Getting endpoint {} with args: {} kwargs: {}'.format(endpoint, args, kwargs))
-    return await run_in_executor(None, lambda: self._client.get(endpoint, *args, **kwargs))
+    try:
+      return await run_in_executor(self.provider.executor,
+        lambda: self._client.get(endpoint, *args, **kwargs))
+    except requests.HTTPError as exc:
+      # Client errors are about the request, not an outage of SoundCloud.
+      status = exc.response.status_code if exc.response is not None else None
+      if status is not None and status < 500 and status != 429:
+        raise ResolveError('SoundCloud answered with HTTP {}'.format(status))
+      raise
 
   def _convert_resource(self, resource: soundcloud.resource.Resource) -> 'Song':
     """
@@ -53,7 +63,7 @@ class SoundCloudInstance(ProviderInstance):
 
     return Song(
       url = resource.permalink_url,
-      duration = resource.duration,
+      duration = resource.duration // 1000 if resource.duration else '',
       title = resource.title,
       artist = resource.user['username'],
       genre = resource.genre,
@@ -62,9 +72,15 @@ class SoundCloudInstance(ProviderInstance):
       purchase_url = resource.purchase_url,
     )
 
+  def flight_key(self):
+    return self.client_id
+
   def supports_search(self):
     return True
 
+  @cached_iter(lambda term, max_results: (normalize_term(term), max_results))
+  @guarded_iter
+  @single_flight_iter(lambda term, max_results: (normalize_term(term), max_results))
   async def search(self, term, max_results):
     songs_yielded = 0
     offset = 0
@@ -86,10 +102,20 @@ class SoundCloudInstance(ProviderInstance):
     # TODO: More sophisticated checking if the URL points to a song.
     return urlinfo.netloc == 'soundcloud.com', None
 
+  @guarded
+  @single_flight(lambda url, match_data: url)
   async def resolve_url(self, url, match_data):
     info = await self._get('/resolve', url=url)
     return self._convert_resource(info)
 
+  async def complete_song(self, song):
+    # Songs that were queued without a stream URL are resolved again.
+    if song.stream_url:
+      return song
+    return await self.resolve_url(song.url, None)
+
+  @guarded
+  @single_flight(lambda song: song.stream_url)
   async def get_stream_url(self, song):
     assert song.stream_url
     data = await self._get(song.stream_url, allow_redirects=False)
@@ -1,11 +1,15 @@
 
-from . import Provider, ProviderInstance, ResolveError, Song
-from quel.core.utils import run_in_executor
-from youtube_dl import DownloadError, YoutubeDL
+from . import Provider, ProviderInstance, ResolveError, Song, cached_iter, guarded, guarded_iter, normalize_term, single_flight, single_flight_iter
+from quel.core.utils import run_in_executor, run_iterator_in_executor
+from urllib.parse import urlparse
+from youtube_dl import YoutubeDL
 from youtube_dl.extractor import list_extractors
 from youtube_dl.extractor.generic import GenericIE
+from youtube_dl.utils import DownloadError, ExtractorError
 
 import logging
+import re
+import urllib.error
 logger = logging.getLogger(__name__)
 
 
@@ -33,11 +37,20 @@ class YoutubeDlProviderInstance(ProviderInstance):
   }
   search_keys.pop(None, None)
 
+  # Matches the names of extractors that produce a list of entries, eg.
+  # "youtube:playlist", "soundcloud:set" or "bandcamp:album".
+  playlist_ie_names = re.compile(r'(playlist|album|set|channel|user|tab)s?$', re.I)
+
+  # The timeout of the network requests of youtube-dl in seconds.
+  socket_timeout = 15
+
   def __init__(self, provider):
     super().__init__(provider)
-    self.yt = YoutubeDL()
+    self.yt = YoutubeDL({'socket_timeout': self.socket_timeout})
 
   def _convert_response(self, data) -> Song:
+    if 'formats' not in data:
+      raise ResolveError('URL does not point to a single track')
     tracks = data['formats']
     if not self.provider.allow_video_stream:
       tracks = [x for x in tracks if 'width' not in x]
@@ -57,19 +70,29 @@ class YoutubeDlProviderInstance(ProviderInstance):
       duration = data['duration']
     )
 
+  def is_failure(self, exc):
+    # youtube-dl wraps network errors in a DownloadError, too.
+    exc_info = getattr(exc.__cause__, 'exc_info', None) if isinstance(exc, ResolveError) else None
+    if exc_info and isinstance(exc_info[1], OSError):
+      return not isinstance(exc_info[1], urllib.error.HTTPError) or exc_info[1].code >= 500
+    return super().is_failure(exc)
+
   def supports_search(self):
     return True
 
+  @cached_iter(lambda term, max_results: (normalize_term(term), max_results))
+  @guarded_iter
+  @single_flight_iter(lambda term, max_results: (normalize_term(term), max_results))
   async def search(self, term, max_results):
     for search_key in self.provider.search_whitelist:
       if search_key in self.search_keys:
         ie_key = self.search_keys[search_key]
         query = '{}{}:{}'.format(search_key, int(max_results), term)
         try:
-          data = await run_in_executor(None,
+          data = await run_in_executor(self.provider.executor,
             lambda: self.yt.extract_info(query, download=False, ie_key=ie_key))
         except DownloadError as exc:
-          return; yield
+          raise ResolveError('Search on "{}" failed'.format(search_key)) from exc
         for entry in data['entries']:
           try:
             yield self._convert_response(entry)
@@ -82,13 +105,79 @@ class YoutubeDlProviderInstance(ProviderInstance):
         return True, ie
     return False, None
 
+  @guarded
+  @single_flight(lambda url, ie: url)
   async def resolve_url(self, url, ie):
     try:
-      data = await run_in_executor(None,
+      data = await run_in_executor(self.provider.executor,
         lambda: self.yt.extract_info(url, download=False, ie_key=ie.ie_key()))
-    except DownloadError:
-      raise ResolveError('Unable to extract information from URL')
+    except DownloadError as exc:
+      raise ResolveError('Unable to extract information from URL') from exc
     return self._convert_response(data)
 
+  def match_playlist(self, url, ie):
+    return bool(self.playlist_ie_names.search(ie.IE_NAME))
+
+  def _entry_url(self, entry):
+    url = entry.get('webpage_url') or entry.get('url')
+    if url and not urlparse(url).scheme and entry.get('ie_key') == 'Youtube':
+      url = 'https://www.youtube.com/watch?v=' + url
+    return url
+
+  async def iter_playlist(self, url, ie):
+    """
+    Extracts the playlist in flat mode, ie. without resolving the entries.
+    Many extractors produce the entries lazily page by page, so songs are
+    yielded while the rest of the playlist is still being fetched.
+    """
+
+    # The extractors raise ExtractorError, youtube-dl itself DownloadError.
+    extractor = self.yt.get_info_extractor(ie.ie_key())
+    try:
+      data = await run_in_executor(self.provider.executor, extractor.extract, url)
+    except (DownloadError, ExtractorError) as exc:
+      raise ResolveError('Unable to extract information from URL') from exc
+    if data.get('_type') not in ('playlist', 'multi_video'):
+      yield await self.resolve_url(url, ie)
+      return
+
+    # The entries are fetched page by page while iterating.
+    try:
+      async for entry in run_iterator_in_executor(self.provider.executor, data['entries']):
+        if not entry:
+          continue
+        if entry.get('formats'):
+          try:
+            yield self._convert_response(entry)
+          except ResolveError as exc:
+            logger.warning('ResolveError when converting playlist entry: {}'.format(exc))
+          continue
+        entry_url = self._entry_url(entry)
+        if not entry_url:
+          continue
+        yield Song(
+          entry_url,
+          title = entry.get('title') or entry_url,
+          artist = entry.get('uploader') or '',
+          duration = entry.get('duration') or '',
+          partial = True
+        )
+    except (DownloadError, ExtractorError) as exc:
+      raise ResolveError('Unable to fetch the playlist entries') from exc
+
+  async def _resolve_song(self, song):
+    matches, ie = self.match_url(song.url, urlparse(song.url))
+    if not matches:
+      raise ResolveError('Unsupported URL `{}`'.format(song.url))
+    return await self.resolve_url(song.url, ie)
+
+  async def complete_song(self, song):
+    if not song.partial:
+      return song
+    return await self._resolve_song(song)
+
+  @guarded
   async def get_stream_url(self, song):
+    if song.partial or not song.stream_url:
+      song = await self._resolve_song(song)
     return song.stream_url
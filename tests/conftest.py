@@ -0,0 +1,16 @@
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def database(tmp_path_factory):
+  """
+  Binds the database to an SQLite file for the tests that need it. Pony
+  can bind the database only once per process.
+  """
+
+  from quel import db
+  db.db.bind(provider='sqlite', filename=str(tmp_path_factory.mktemp('db') / 'db.sqlite'), create_db=True)
+  db.db.generate_mapping(create_tables=True)
+  yield db
+  db.worker.stop()
@@ -0,0 +1,68 @@
+
+"""
+Tests for the admission control of expensive commands.
+"""
+
+import pytest
+
+pytest.importorskip('discord')
+
+from quel.core.admission import Admission, Rejection
+from quel.core.client import prepare_message, set_event
+from quel.loadtest.fakes import FakeClient, FakeGuild, FakeMessage, FakeUser
+from quel.loadtest.harness import Metrics
+from quel.main import QuelBehavior, load_guild
+from quel.providers import Provider, ProviderInstance, Song
+
+import asyncio
+
+
+def test_charge_takes_tokens_without_pending():
+  admission = Admission({'entry': 0.5}, user_budget=(0, 10), max_pending=1)
+  with admission.admit('play', 1, user_id=1, guild_id=2):
+    admission.charge('entry', 10, user_id=1, guild_id=2)
+    assert admission.pending == 1
+    with pytest.raises(Rejection) as excinfo:
+      admission.charge('entry', 10, user_id=1, guild_id=2)
+    assert excinfo.value.reason == 'user'
+  assert admission.pending == 0
+
+
+class PlaylistProvider(Provider, ProviderInstance):
+
+  id = 'playlist'
+  name = 'Playlist'
+
+  def __init__(self, count):
+    self.count = count
+
+  @property
+  def provider(self):
+    return self
+
+  async def iter_playlist(self, url, match_data):
+    for i in range(self.count):
+      yield Song('https://example.com/{}'.format(i), title=str(i), partial=True)
+
+
+@pytest.mark.usefixtures('database')
+def test_playlist_import_is_charged_per_entry():
+  async def test():
+    metrics = Metrics(connect_latency=0)
+    bot = FakeUser('Quel', bot=True)
+    discord_guild = FakeGuild('Guild', bot, metrics)
+    client = FakeClient(bot, [discord_guild])
+    # Enough budget for 50 entries, which is less than the playlist.
+    quel = QuelBehavior({'botConfig': {'userCommandBudget': [0, 5],
+      'commandCosts': {'playlist_entry': 0.1}}})
+    quel.max_playlist_wait = 0
+    client.add_handler(quel)
+    guild = await load_guild(discord_guild.id)
+    user = FakeUser('User')
+    message = FakeMessage(discord_guild.text_channel, user, 'queue <playlist>', metrics)
+    with set_event(prepare_message(client, message)):
+      queued = await quel.import_playlist(guild, PlaylistProvider(200), 'playlist', None)
+    assert queued == 2 * quel.playlist_charge_batch
+    assert len(guild.queue) == queued
+    assert 'stopped' in discord_guild.text_channel.messages[-1].content
+  asyncio.run(test())
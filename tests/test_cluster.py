@@ -0,0 +1,81 @@
+
+"""
+Tests for the guild leases of #quel.db.Cluster.
+"""
+
+from quel.db import Cluster, Lease
+from pony import orm
+
+import asyncio
+import pytest
+
+pytestmark = pytest.mark.usefixtures('database')
+
+
+class Handler:
+
+  def __init__(self, guild_ids, states=None):
+    self.guild_ids = guild_ids
+    self.states = states or {}
+    self.acquired = {}
+    self.lost = []
+
+  def cluster_guild_ids(self):
+    return self.guild_ids
+
+  def cluster_snapshot(self, guild_id):
+    return self.states.get(guild_id)
+
+  async def guild_acquired(self, guild_id, state):
+    self.acquired[guild_id] = state
+
+  async def guild_lost(self, guild_id):
+    self.lost.append(guild_id)
+
+
+def leases(guild_ids):
+  with orm.db_session:
+    return {x.guild_id: (x.node_id, x.expires, x.state) for x in Lease.select()
+            if x.guild_id in guild_ids}
+
+
+def test_heartbeats_renew_leases_of_idle_guilds(database):
+  async def test():
+    cluster = Cluster(database.worker, 'node-a', lease_ttl=30.0, heartbeat_interval=10.0)
+    handler = Handler([101, 102], states={102: {'queue': []}})
+    await cluster.heartbeat(handler)
+    assert cluster.owned == {101, 102}
+    expires = leases({101})[101][1]
+    await asyncio.sleep(0.01)
+    await cluster.heartbeat(handler)
+    await cluster.heartbeat(handler)
+    assert cluster.owned == {101, 102}
+    assert not handler.lost
+    stored = leases({101, 102})
+    assert stored[101][1] > expires
+    assert stored[101][2] is None
+    assert stored[102][2] == {'queue': []}
+
+    await cluster.release(handler)
+    assert all(x[1] == 0.0 for x in leases({101, 102}).values())
+
+    # Another node takes over the released guilds with their state.
+    other = Cluster(database.worker, 'node-b', lease_ttl=30.0, heartbeat_interval=10.0)
+    handler = Handler([101, 102])
+    await other.heartbeat(handler)
+    assert handler.acquired == {101: None, 102: {'queue': []}}
+    await other.release(handler)
+  asyncio.run(test())
+
+
+def test_heartbeat_handles_many_guilds(database):
+  async def test():
+    guild_ids = list(range(10000, 12500))
+    cluster = Cluster(database.worker, 'node-c', lease_ttl=30.0,
+      heartbeat_interval=10.0, acquire_batch=len(guild_ids))
+    handler = Handler(guild_ids)
+    await cluster.heartbeat(handler)
+    await cluster.heartbeat(handler)
+    assert cluster.owned == set(guild_ids)
+    await cluster.release(handler)
+  asyncio.run(test())
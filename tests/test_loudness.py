@@ -0,0 +1,52 @@
+
+"""
+Tests for the loudness measurement with a fake FFmpeg executable.
+"""
+
+from quel.db.loudness import LoudnessAnalyzer
+
+import asyncio
+import pytest
+import sys
+
+
+FAKE_FFMPEG = '''#!{python}
+import sys
+assert 'ebur128' in sys.argv
+for i in range(1, {frames} + 1):
+  sys.stderr.write('[Parsed_ebur128_0 @ 0x1] t: {{:.1f}} TARGET:-23 LUFS M: -20.0 '
+    'S: -20.0 I: -{{:.1f}} LUFS LRA: 0.0 LU\\n'.format(i / 10, 30 - i / 1000))
+sys.stderr.write('[Parsed_ebur128_0 @ 0x1] Summary:\\n\\n  Integrated loudness:\\n'
+  '    I:         {summary} LUFS\\n    Threshold: -30.0 LUFS\\n')
+sys.exit({code})
+'''
+
+
+def fake_ffmpeg(tmp_path, frames=0, summary='-14.5', code=0):
+  path = tmp_path / 'ffmpeg'
+  path.write_text(FAKE_FFMPEG.format(python=sys.executable, frames=frames, summary=summary, code=code))
+  path.chmod(0o755)
+  return str(path)
+
+
+def measure(ffmpeg):
+  return asyncio.run(LoudnessAnalyzer(None, ffmpeg=ffmpeg).measure('/tmp/a.mp3'))
+
+
+def test_measure_reads_summary_of_long_output(tmp_path):
+  # Ten minutes of audio are logged in 6000 frame lines.
+  assert measure(fake_ffmpeg(tmp_path, frames=6000)) == -14.5
+
+
+def test_measure_fails_without_summary(tmp_path):
+  with pytest.raises(RuntimeError):
+    measure(fake_ffmpeg(tmp_path, summary='nan'))
+  with pytest.raises(RuntimeError):
+    measure(fake_ffmpeg(tmp_path, code=1))
+
+
+def test_measure_without_ffmpeg(tmp_path):
+  analyzer = LoudnessAnalyzer(None, ffmpeg=str(tmp_path / 'missing'))
+  with pytest.raises(RuntimeError):
+    asyncio.run(analyzer.measure('/tmp/a.mp3'))
+  assert not analyzer.available
@@ -0,0 +1,170 @@
+
+"""
+Tests for the playback state machine of #QuelBehavior, against the fake
+Discord objects of the load test.
+"""
+
+import pytest
+
+pytest.importorskip('discord')
+
+from quel import db
+from quel.core.client import prepare_message, prepare_voice_state_update, set_event
+from quel.db import PlaybackState
+from quel.loadtest.fakes import FakeClient, FakeGuild, FakeMember, FakeMessage, FakeUser, FakeVoiceState
+from quel.loadtest.harness import Metrics
+from quel.main import QuelBehavior, load_guild
+from quel.providers import Provider, ProviderInstance, ResolveError
+
+import asyncio
+
+pytestmark = pytest.mark.usefixtures('database')
+
+
+class BrokenProvider(Provider):
+
+  id = 'broken'
+  name = 'Broken'
+
+
+class BrokenInstance(ProviderInstance):
+
+  def __init__(self, error):
+    super().__init__(BrokenProvider())
+    self.raise_error = error
+
+  async def get_stream_url(self, song):
+    raise self.raise_error
+
+
+class Setup:
+
+  def __init__(self, error, connected=False, connect_error=None):
+    self.error = error
+    self.connected = connected
+    self.connect_error = connect_error
+
+  async def __aenter__(self):
+    metrics = Metrics(connect_latency=0)
+    bot = FakeUser('Quel', bot=True)
+    self.discord_guild = FakeGuild('Guild', bot, metrics)
+    self.client = FakeClient(bot, [self.discord_guild])
+    self.quel = QuelBehavior({'botConfig': {'voiceSettleDelay': 0}})
+    self.client.add_handler(self.quel)
+
+    self.listener = listener = FakeUser('Listener')
+    listener.voice = FakeVoiceState(self.discord_guild.voice_channel)
+    self.discord_guild.voice_channel.members.append(listener)
+    message = FakeMessage(self.discord_guild.text_channel, listener, 'resume', metrics)
+    self.event = prepare_message(self.client, message)
+
+    self.guild = await load_guild(self.discord_guild.id)
+    self.guild.providers = [BrokenInstance(self.error)]
+    self.song = db.QueuedSong('https://example.com/a', 'A', user_id=listener.id, provider_id='broken')
+    self.guild.queue_song(self.song)
+    if self.connected:
+      self.guild.voice_client = await self.discord_guild.voice_channel.connect()
+    if self.connect_error:
+      async def connect():
+        raise self.connect_error
+      self.discord_guild.voice_channel.connect = connect
+    return self
+
+  async def __aexit__(self, *exc_info):
+    await self.quel.stop_playback(self.guild)
+
+  async def play_next(self):
+    with set_event(self.event):
+      await self.quel.play_next()
+      await self.client.get_replies(self.discord_guild.text_channel).flush()
+
+  @property
+  def replies(self):
+    return [x.content for x in self.discord_guild.text_channel.messages]
+
+
+@pytest.mark.parametrize('error', [ConnectionError('connection reset'), RuntimeError('boom')])
+def test_play_next_requeues_song_if_stream_url_fails(error):
+  async def test():
+    async with Setup(error, connected=True) as setup:
+      voice_client = setup.guild.voice_client
+      await setup.play_next()
+      assert setup.guild.state == PlaybackState.idle
+      assert list(setup.guild.queue) == [setup.song]
+      assert setup.guild.current_song is None
+      assert str(error) in setup.replies[-1]
+      # The connection is kept for the next attempt.
+      assert setup.quel.idle_voice.take(setup.guild.id) is voice_client
+  asyncio.run(test())
+
+
+def test_play_next_requeues_song_if_connect_fails():
+  async def test():
+    async with Setup(ResolveError('unused'), connect_error=asyncio.TimeoutError()) as setup:
+      await setup.play_next()
+      assert setup.guild.state == PlaybackState.idle
+      assert list(setup.guild.queue) == [setup.song]
+      assert 'TimeoutError' in setup.replies[-1]
+  asyncio.run(test())
+
+
+def test_play_next_skips_song_on_resolve_error():
+  async def test():
+    async with Setup(ResolveError('not found'), connected=True) as setup:
+      setup.quel.next_song = lambda guild: None
+      await setup.play_next()
+      assert setup.guild.state == PlaybackState.idle
+      assert not setup.guild.queue
+      assert 'not found' in setup.replies[-1]
+  asyncio.run(test())
+
+
+def test_resume_after_failure():
+  async def test():
+    async with Setup(RuntimeError('boom'), connected=True) as setup:
+      await setup.play_next()
+      scheduled = []
+      setup.quel.next_song = scheduled.append
+      with set_event(setup.event):
+        await setup.quel.resume()
+      assert scheduled == [setup.guild]
+  asyncio.run(test())
+
+
+def test_suspended_playback_resumes_after_connection_was_closed():
+  async def test():
+    async with Setup(RuntimeError('boom'), connected=True) as setup:
+      guild, quel = setup.guild, setup.quel
+      voice_channel = setup.discord_guild.voice_channel
+      guild.queue.popleft()
+      guild.current_song = setup.song
+      guild.state = PlaybackState.playing
+      guild.last_event = setup.event
+
+      # Everyone leaves, the stream is closed and later the idle connection.
+      voice_channel.members.remove(setup.listener)
+      setup.listener.voice = None
+      quel.listeners_left(guild)
+      assert guild.state == PlaybackState.paused
+      await quel.suspend_playback(guild, guild.generation)
+      assert guild.state == PlaybackState.idle
+      assert list(guild.queue) == [setup.song]
+      voice_client = quel.idle_voice.discard(guild.id)
+      await quel.release_voice(guild.id, voice_client)
+      assert guild.voice_client is None
+
+      # A listener comes back to the channel.
+      scheduled = []
+      quel.next_song = scheduled.append
+      member = FakeMember(FakeUser('Other'), setup.discord_guild)
+      voice_channel.members.append(member)
+      with set_event(prepare_voice_state_update(setup.client, member,
+          FakeVoiceState(None), FakeVoiceState(voice_channel))):
+        await quel.voice_state_update()
+      assert scheduled == [guild]
+
+      # The bot connects to that channel although the user who queued the
+      # song is not in a voice channel.
+      await setup.play_next()
+      assert quel.idle_voice.take(guild.id).channel is voice_channel
+  asyncio.run(test())
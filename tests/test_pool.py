@@ -0,0 +1,122 @@
+
+"""
+Tests for the sharing of provider instances between guilds.
+"""
+
+from quel.providers import ErrorProviderInstance, Provider, ProviderInstance
+from quel.providers.pool import ProviderPool, pool
+
+import asyncio
+import logging
+import pytest
+
+
+class CountingProvider(Provider):
+
+  id = 'counting'
+  name = 'Counting'
+
+  def __init__(self):
+    self.created = 0
+    self.fail = False
+
+  def get_option_names(self):
+    return ['key']
+
+  def instantiate(self, options):
+    if self.fail:
+      raise RuntimeError('broken')
+    self.created += 1
+    return ProviderInstance(self)
+
+
+def test_acquire_and_release_count_references():
+  pool = ProviderPool()
+  provider = CountingProvider()
+  a = pool.acquire(provider, {'key': 1})
+  assert pool.acquire(provider, {'key': 1}) is a
+  b = pool.acquire(provider, {'key': 2})
+  assert b is not a
+  assert provider.created == 2
+  pool.release(a)
+  assert len(pool) == 2
+  pool.release(a)
+  pool.release(b)
+  assert len(pool) == 0
+  pool.release(ProviderInstance(provider))  # Not from the pool.
+  assert pool.acquire(provider, {'key': 1}) is not a
+
+
+def test_rebuild_moves_references():
+  pool = ProviderPool()
+  provider = CountingProvider()
+  old = pool.acquire(provider, {'key': 1})
+  pool.acquire(provider, {'key': 1})
+  replaced, new = pool.rebuild(provider, {'key': 1})
+  assert replaced is old and new is not old
+  assert pool.acquire(provider, {'key': 1}) is new
+  pool.release(old)  # Ignored, the references moved to the new instance.
+  for _ in range(3):
+    assert len(pool) == 1
+    pool.release(new)
+  assert len(pool) == 0
+
+
+def test_failed_rebuild_keeps_instance():
+  pool = ProviderPool()
+  provider = CountingProvider()
+  old = pool.acquire(provider, {'key': 1})
+  provider.fail = True
+  with pytest.raises(RuntimeError):
+    pool.rebuild(provider, {'key': 1})
+  provider.fail = False
+  assert pool.acquire(provider, {'key': 1}) is old
+
+
+def test_rebuild_without_instance_acquires():
+  pool = ProviderPool()
+  replaced, new = pool.rebuild(CountingProvider(), {})
+  assert replaced is None
+  pool.release(new)
+  assert len(pool) == 0
+
+
+@pytest.mark.usefixtures('database')
+def test_forced_reload_rebuilds_for_all_guilds():
+  pytest.importorskip('discord')
+  from quel import db
+  from quel.main import load_guild
+
+  logger = logging.getLogger(__name__)
+  providers = [CountingProvider()]
+  async def load():
+    return [await load_guild(901), await load_guild(902),
+            await load_guild(903, db.Guild.update_config, 'counting.key', 'other')]
+  first, second, third = asyncio.run(load())
+  for guild in (first, second, third):
+    guild.init_providers(logger, providers)
+  old = first.providers[0]
+  assert second.providers[0] is old
+  assert third.providers[0] is not old
+
+  replaced = first.init_providers(logger, providers, force=True)
+  for guild in (first, second, third):
+    guild.replace_providers(replaced)
+  new = first.providers[0]
+  assert new is not old
+  assert second.providers[0] is new
+  assert third.providers[0] is not new
+
+  # A guild whose instance failed before gets the rebuilt instance, too.
+  second.providers = [ErrorProviderInstance(providers[0], 'broken')]
+  pool.release(new)
+  replaced = second.init_providers(logger, providers, force=True)
+  assert second.providers[0] is replaced[new]
+  first.replace_providers(replaced)
+  assert first.providers[0] is second.providers[0]
+
+  size = len(pool)
+  for guild in (first, second):
+    pool.release(guild.providers[0])
+  assert len(pool) == size - 1
+  pool.release(third.providers[0])
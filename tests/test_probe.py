@@ -0,0 +1,74 @@
+
+"""
+Tests for the host checks of #quel.providers.probe, which keep users from
+making the bot request internal services.
+"""
+
+from quel.providers import probe, ResolveError
+from quel.providers.rawfile import RawFileProvider
+from urllib.parse import urlparse
+
+import asyncio
+import http.server
+import pytest
+import threading
+
+
+@pytest.mark.parametrize('url', [
+  'http://localhost/a.mp3',
+  'http://127.0.0.1:8080/a',
+  'http://10.1.2.3/a.mp3',
+  'http://192.168.0.1/a.mp3',
+  'http://169.254.169.254/latest/meta-data/',
+  'http://[::1]/a.mp3',
+  'http://[::ffff:127.0.0.1]/a.mp3',
+  'http://[fe80::1]/a.mp3',
+  'http://0.0.0.0/a.mp3',
+  'file:///etc/passwd',
+])
+def test_check_host_rejects_internal_hosts(url):
+  with pytest.raises(probe.ForbiddenHost):
+    asyncio.run(probe.check_host(url))
+
+
+def test_check_host_accepts_public_address():
+  asyncio.run(probe.check_host('http://93.184.216.34/a.mp3'))
+
+
+@pytest.mark.parametrize('url', ['http://127.0.0.1/a', 'http://169.254.169.254/a'])
+def test_rawfile_does_not_probe_internal_hosts(url):
+  provider = RawFileProvider()
+  assert asyncio.run(provider.probe_url(url, urlparse(url))) == (False, None)
+
+
+def test_rawfile_rejects_internal_hosts_with_extension():
+  provider = RawFileProvider()
+  with pytest.raises(ResolveError):
+    asyncio.run(provider.resolve_url('http://10.0.0.1/a.mp3', None))
+
+
+class RedirectHandler(http.server.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    self.send_response(302)
+    self.send_header('Location', 'http://169.254.169.254/latest/meta-data/')
+    self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+
+def test_redirects_to_internal_hosts_are_rejected(monkeypatch):
+  server = http.server.HTTPServer(('127.0.0.1', 0), RedirectHandler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  check_host = probe.check_host
+  async def allow_test_server(url):
+    if urlparse(url).hostname != '127.0.0.1':
+      await check_host(url)
+  monkeypatch.setattr(probe, 'check_host', allow_test_server)
+  try:
+    url = 'http://127.0.0.1:{}/a.mp3'.format(server.server_port)
+    with pytest.raises(probe.ForbiddenHost):
+      asyncio.run(probe.probe(url))
+  finally:
+    server.shutdown()
@@ -0,0 +1,315 @@
+
+"""
+Tests for the parsers of #quel.providers.probe with fixture bytes of each
+format. The parsers read untrusted bytes, so truncated and malformed input
+must either parse or raise a #ProbeError.
+"""
+
+from quel.providers import probe
+from quel.providers.probe import MediaInfo, ProbeError
+
+import asyncio
+import pytest
+import random
+import struct
+
+
+class BytesReader:
+  """
+  Serves a file from memory like a #probe.RangeReader.
+  """
+
+  def __init__(self, data, head_size=65536):
+    self.data = data
+    self.head = data[:head_size]
+    self.size = len(data)
+    self.content_type = ''
+
+  async def read(self, offset, length):
+    if offset < 0:
+      offset = max(0, len(self.data) + offset)
+    return self.data[offset:offset + length]
+
+
+def run_probe(fmt, data, head_size=65536):
+  async def run():
+    info = MediaInfo(fmt)
+    tags = await probe._probes[fmt](BytesReader(data, head_size), info)
+    return info, tags
+  return asyncio.run(run())
+
+
+# Fixtures
+
+def syncsafe(value):
+  return bytes((value >> shift) & 0x7F for shift in (21, 14, 7, 0))
+
+
+def id3_tag(frames, major=4):
+  body = b''
+  for frame_id, text in frames:
+    data = b'\x03' + text.encode('utf8')
+    if major == 2:
+      body += frame_id + len(data).to_bytes(3, 'big') + data
+    else:
+      size = syncsafe(len(data)) if major == 4 else struct.pack('>I', len(data))
+      body += frame_id + size + b'\0\0' + data
+  body += b'\0' * 16  # Padding
+  return b'ID3' + bytes([major, 0, 0]) + syncsafe(len(body)) + body
+
+
+# MPEG 1 layer III, 128 kbit/s, 44100 Hz, stereo. The Xing and VBRI headers
+# follow the 32 bytes of side information.
+MPEG_HEADER = b'\xff\xfb\x90\x00'
+
+
+def mpeg_frame(extra=b''):
+  frame = MPEG_HEADER + b'\0' * 32 + extra
+  return frame + b'\0' * (417 - len(frame))
+
+
+def xing_frame(frames):
+  return mpeg_frame(b'Xing' + struct.pack('>II', 1, frames))
+
+
+def vbri_frame(frames):
+  return mpeg_frame(b'VBRI' + struct.pack('>HHHI', 1, 0, 75, 0) + struct.pack('>I', frames))
+
+
+def mp3_file():
+  tag = id3_tag([(b'TIT2', 'Title'), (b'TPE1', 'Artist'), (b'TCON', '(17)Rock')])
+  return tag + xing_frame(1000) + mpeg_frame() * 4
+
+
+def riff_chunk(chunk_id, body):
+  return chunk_id + struct.pack('<I', len(body)) + body + b'\0' * (len(body) & 1)
+
+
+def wav_file(seconds=2):
+  fmt = struct.pack('<HHIIHH', 1, 2, 44100, 176400, 4, 16)
+  info = b'INFO' + riff_chunk(b'INAM', b'Title\0') + riff_chunk(b'IART', b'Artist\0')
+  body = b'WAVE' + riff_chunk(b'fmt ', fmt) + riff_chunk(b'LIST', info)
+  body += riff_chunk(b'data', b'\0' * 176400 * seconds)
+  return b'RIFF' + struct.pack('<I', len(body)) + body
+
+
+def vorbis_comment(comments, vendor=b'quel'):
+  data = struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', len(comments))
+  for comment in comments:
+    data += struct.pack('<I', len(comment)) + comment
+  return data
+
+
+def flac_block(block_type, body, last=False):
+  return bytes([block_type | (0x80 if last else 0)]) + len(body).to_bytes(3, 'big') + body
+
+
+def flac_file(sample_rate=44100, total_samples=441000):
+  value = (sample_rate << 44) | (1 << 41) | (15 << 36) | total_samples
+  streaminfo = b'\0' * 10 + value.to_bytes(8, 'big') + b'\0' * 16
+  comment = vorbis_comment([b'TITLE=Title', b'artist=Artist', b'TITLE=Other'])
+  return (b'fLaC' + flac_block(0, streaminfo) + flac_block(4, comment, last=True)
+          + b'\xff\xf8' + b'\0' * 64)
+
+
+def ogg_page(packets, granule=0, serial=1, sequence=0):
+  lacing, body = b'', b''
+  for packet in packets:
+    lacing += b'\xff' * (len(packet) // 255) + bytes([len(packet) % 255])
+    body += packet
+  return (b'OggS' + struct.pack('<BBqIII', 0, 0, granule, serial, sequence, 0)
+          + bytes([len(lacing)]) + lacing + body)
+
+
+def opus_file(seconds=3, pre_skip=312):
+  head = b'OpusHead' + struct.pack('<BBHIhB', 1, 2, pre_skip, 48000, 0, 0)
+  tags = b'OpusTags' + vorbis_comment([b'TITLE=Title', b'ALBUM=Album'])
+  return (ogg_page([head]) + ogg_page([b'\0' * 300], serial=2)
+          + ogg_page([tags], sequence=1) + ogg_page([b'\0' * 600], granule=123, sequence=2)
+          + ogg_page([b'\0' * 100], granule=48000 * seconds + pre_skip, sequence=3))
+
+
+def vorbis_file(seconds=4):
+  ident = b'\x01vorbis' + struct.pack('<IBIiiiBB', 0, 2, 44100, 0, 0, 0, 0xB8, 1)
+  comment = b'\x03vorbis' + vorbis_comment([b'GENRE=Jazz'])
+  return (ogg_page([ident]) + ogg_page([comment], sequence=1)
+          + ogg_page([b'\0' * 100], granule=44100 * seconds, sequence=2))
+
+
+def atom(kind, body):
+  return struct.pack('>I', 8 + len(body)) + kind + body
+
+
+def mp4_moov(timescale=1000, duration=5500, version=0):
+  if version == 1:
+    mvhd = b'\1\0\0\0' + struct.pack('>QQIQ', 0, 0, timescale, duration)
+  else:
+    mvhd = b'\0\0\0\0' + struct.pack('>IIII', 0, 0, timescale, duration)
+  items = atom(b'\xa9nam', atom(b'data', b'\0\0\0\1\0\0\0\0' + b'Title'))
+  items += atom(b'\xa9ART', atom(b'data', b'\0\0\0\1\0\0\0\0' + b'Artist'))
+  udta = atom(b'udta', atom(b'meta', b'\0\0\0\0' + atom(b'ilst', items)))
+  return atom(b'moov', atom(b'mvhd', mvhd + b'\0' * 80) + udta)
+
+
+def mp4_file(version=0, mdat_size=100000):
+  # The moov atom after the media data, like in files that are not
+  # optimized for streaming.
+  return atom(b'ftyp', b'M4A \0\0\0\0') + atom(b'mdat', b'\0' * mdat_size) + mp4_moov(version=version)
+
+
+# Valid files
+
+def test_detect_format():
+  assert probe.detect_format(mp3_file()) == 'mp3'
+  assert probe.detect_format(MPEG_HEADER) == 'mp3'
+  assert probe.detect_format(wav_file(0)) == 'wav'
+  assert probe.detect_format(flac_file()) == 'flac'
+  assert probe.detect_format(opus_file()) == 'ogg'
+  assert probe.detect_format(mp4_file()) == 'mp4'
+  assert probe.detect_format(b'', 'audio/x-m4a') == 'mp4'
+  assert probe.detect_format(b'<html>', 'text/html') is None
+
+
+@pytest.mark.parametrize('major', [2, 3, 4])
+def test_parse_id3(major):
+  frames = [(b'TT2', 'Title'), (b'TP1', 'Artist')] if major == 2 else \
+    [(b'TIT2', 'Title'), (b'TPE1', 'Artist'), (b'TCON', '(17)Rock')]
+  tag = id3_tag(frames, major)
+  tags, size = probe.parse_id3(tag + b'\xff\xfb')
+  assert size == len(tag)
+  assert tags['title'] == 'Title' and tags['artist'] == 'Artist'
+  if major != 2:
+    assert tags['genre'] == 'Rock'
+
+
+def test_parse_id3_without_tag():
+  assert probe.parse_id3(MPEG_HEADER) == ({}, 0)
+
+
+def test_parse_mpeg_frame():
+  assert probe.parse_mpeg_frame(b'junk' + xing_frame(1000)) == pytest.approx(1000 * 1152 / 44100)
+  assert probe.parse_mpeg_frame(vbri_frame(2000)) == pytest.approx(2000 * 1152 / 44100)
+  # Without a VBR header, the duration is estimated from the bitrate.
+  assert probe.parse_mpeg_frame(mpeg_frame(), size=160000 + 100, offset=100) == pytest.approx(10)
+  assert probe.parse_mpeg_frame(mpeg_frame()) is None
+  assert probe.parse_mpeg_frame(b'\0' * 100) is None
+
+
+def test_probe_mp3():
+  info, tags = run_probe('mp3', mp3_file())
+  assert tags == {'title': 'Title', 'artist': 'Artist', 'genre': 'Rock'}
+  assert info.duration == pytest.approx(1000 * 1152 / 44100)
+
+
+def test_probe_mp3_with_tag_larger_than_head():
+  data = id3_tag([(b'TIT2', 'x' * 5000)]) + xing_frame(500)
+  info, tags = run_probe('mp3', data, head_size=1024)
+  assert info.duration == pytest.approx(500 * 1152 / 44100)
+
+
+def test_probe_wav():
+  info, tags = run_probe('wav', wav_file(2))
+  assert tags == {'title': 'Title', 'artist': 'Artist'}
+  assert info.duration == pytest.approx(2)
+
+
+def test_parse_vorbis_comment():
+  data = vorbis_comment([b'TITLE=Title', b'Artist=Artist', b'TITLE=Other', b'invalid'])
+  assert probe.parse_vorbis_comment(data) == {'title': 'Title', 'artist': 'Artist'}
+  assert probe.parse_vorbis_comment(data[:-10]) == {'title': 'Title', 'artist': 'Artist'}
+
+
+def test_probe_flac():
+  info, tags = run_probe('flac', flac_file())
+  assert tags == {'title': 'Title', 'artist': 'Artist'}
+  assert info.duration == pytest.approx(10)
+
+
+def test_iter_ogg_packets():
+  data = ogg_page([b'a' * 10, b'b' * 600]) + ogg_page([b'x'], serial=2) + ogg_page([b'c'])
+  assert list(probe.iter_ogg_packets(data)) == [b'a' * 10, b'b' * 600, b'c']
+
+
+def test_probe_opus():
+  info, tags = run_probe('ogg', opus_file(3))
+  assert tags == {'title': 'Title', 'album': 'Album'}
+  assert info.duration == pytest.approx(3)
+
+
+def test_probe_vorbis():
+  info, tags = run_probe('ogg', vorbis_file(4))
+  assert tags == {'genre': 'Jazz'}
+  assert info.duration == pytest.approx(4)
+
+
+def test_iter_atoms():
+  data = atom(b'ftyp', b'M4A ') + struct.pack('>I4sQ', 1, b'mdat', 24) + b'\0' * 8
+  assert list(probe.iter_atoms(data)) == [(b'ftyp', 8, 12), (b'mdat', 28, 36)]
+  assert list(probe.iter_atoms(b'\0\0\0\0free')) == [(b'free', 8, 8)]
+
+
+@pytest.mark.parametrize('version', [0, 1])
+def test_probe_mp4(version):
+  info, tags = run_probe('mp4', mp4_file(version=version))
+  assert tags == {'title': 'Title', 'artist': 'Artist'}
+  assert info.duration == pytest.approx(5.5)
+
+
+# Malformed files
+
+fixtures = {
+  'mp3': mp3_file(),
+  'wav': wav_file(0) + b'\0' * 64,
+  'flac': flac_file(),
+  'ogg': opus_file(),
+  'ogg-vorbis': vorbis_file(),
+  'mp4': mp4_file(mdat_size=16),
+}
+
+
+def malformed(data, count=300, seed=0):
+  """
+  Yields all truncations of *data* and copies with random bytes replaced.
+  """
+
+  for size in range(len(data)):
+    yield data[:size]
+  rand = random.Random(seed)
+  for _ in range(count):
+    copy = bytearray(data)
+    for _ in range(rand.randint(1, 4)):
+      copy[rand.randrange(len(copy))] = rand.choice([0, 1, 0x7F, 0x80, 0xFF, rand.randrange(256)])
+    yield bytes(copy)
+
+
+def check_parse(func, *args):
+  try:
+    func(*args)
+  except ProbeError:
+    pass
+
+
+@pytest.mark.parametrize('name', sorted(fixtures))
+def test_malformed_files_raise_probe_error(name):
+  fmt = name.partition('-')[0]
+  async def run():
+    for data in malformed(fixtures[name]):
+      try:
+        await probe._probes[fmt](BytesReader(data), MediaInfo(fmt))
+      except ProbeError:
+        pass
+  asyncio.run(run())
+
+
+@pytest.mark.parametrize('func, data', [
+  (probe.parse_id3, mp3_file()),
+  (probe.parse_id3, id3_tag([(b'TT2', 'Title')], major=2)),
+  (probe.parse_mpeg_frame, vbri_frame(10)),
+  (probe.parse_vorbis_comment, vorbis_comment([b'TITLE=Title'])),
+  (lambda data: list(probe.iter_ogg_packets(data)), opus_file()),
+  (lambda data: list(probe.iter_atoms(data)), fixtures['mp4']),
+  (probe.parse_moov, mp4_moov()[8:]),
+], ids=['id3', 'id3v2.2', 'mpeg', 'vorbis-comment', 'ogg', 'atoms', 'moov'])
+def test_malformed_data_raises_probe_error(func, data):
+  for copy in malformed(data):
+    check_parse(func, copy)
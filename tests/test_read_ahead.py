@@ -0,0 +1,77 @@
+
+"""
+Tests for #quel.async_requests.ReadAhead, in particular that the reader
+thread is released when the consumer stops early.
+"""
+
+from quel.async_requests import ReadAhead
+
+import asyncio
+import gc
+import threading
+
+
+class EndlessResponse:
+
+  def __init__(self):
+    self.closed = threading.Event()
+
+  def iter_content(self, chunk_size):
+    while not self.closed.is_set():
+      yield b'x' * chunk_size
+
+  def close(self):
+    self.closed.set()
+
+
+def reader_threads():
+  return [x for x in threading.enumerate() if x.name == 'quel-read-ahead']
+
+
+def wait_for_threads():
+  for thread in reader_threads():
+    thread.join(5)
+  return reader_threads()
+
+
+def test_reads_whole_body():
+  class Response(EndlessResponse):
+    def iter_content(self, chunk_size):
+      return iter([b'abcd', b'ef'])
+  async def test():
+    it = ReadAhead(Response(), chunk_size=2, read_size=2)
+    return [bytes(x) async for x in it]
+  assert asyncio.run(test()) == [b'ab', b'cd', b'ef']
+
+
+def test_context_manager_releases_thread():
+  response = EndlessResponse()
+  async def test():
+    async with ReadAhead(response, chunk_size=4, buffer_size=16, read_size=4) as it:
+      async for chunk in it:
+        break
+  asyncio.run(test())
+  assert response.closed.is_set()
+  assert not wait_for_threads()
+
+
+def test_abandoned_iteration_releases_thread():
+  response = EndlessResponse()
+  async def test():
+    async for chunk in ReadAhead(response, chunk_size=4, buffer_size=16, read_size=4):
+      break
+  asyncio.run(test())
+  gc.collect()
+  assert response.closed.is_set()
+  assert not wait_for_threads()
+
+
+def test_abandoned_batches_release_thread():
+  response = EndlessResponse()
+  async def test():
+    async for batch in ReadAhead(response, chunk_size=4, buffer_size=16, read_size=4).batches():
+      break
+  asyncio.run(test())
+  gc.collect()
+  assert response.closed.is_set()
+  assert not wait_for_threads()
@@ -0,0 +1,110 @@
+
+"""
+Tests for the error handling of the youtube-dl provider.
+"""
+
+import pytest
+
+youtube_dl = pytest.importorskip('youtube_dl')
+
+from youtube_dl.utils import ExtractorError
+
+from quel.providers import ResolveError
+from quel.providers.youtube_dl import YoutubeDlProvider, YoutubeDlProviderInstance
+
+import asyncio
+import sys
+import urllib.error
+
+
+class FailingYoutubeDL:
+
+  def __init__(self, error):
+    self.error = error
+    self.calls = 0
+
+  def extract_info(self, *args, **kwargs):
+    self.calls += 1
+    try:
+      raise self.error
+    except Exception:
+      raise youtube_dl.DownloadError('ERROR: {}'.format(self.error), sys.exc_info())
+
+
+def search(instance, term):
+  async def collect():
+    return [song async for song in instance.search(term, 5)]
+  return asyncio.run(collect())
+
+
+def make_instance(error):
+  instance = YoutubeDlProviderInstance(YoutubeDlProvider())
+  instance.search_keys = {'ytsearch': 'Youtube'}
+  instance.yt = FailingYoutubeDL(error)
+  return instance
+
+
+def test_failed_search_counts_as_failure_and_is_not_cached():
+  instance = make_instance(urllib.error.URLError('connection refused'))
+  for _ in range(2):
+    with pytest.raises(ResolveError) as excinfo:
+      search(instance, 'network outage')
+    assert isinstance(excinfo.value.__cause__, youtube_dl.DownloadError)
+    assert instance.is_failure(excinfo.value)
+  assert instance.yt.calls == 2
+  assert instance.breaker.failures == 2
+
+
+def test_client_errors_do_not_count_as_failure():
+  error = urllib.error.HTTPError('https://youtube.com', 404, 'Not Found', {}, None)
+  instance = make_instance(error)
+  with pytest.raises(ResolveError) as excinfo:
+    search(instance, 'not found')
+  assert not instance.is_failure(excinfo.value)
+  assert instance.breaker.failures == 0
+
+
+
+class FailingExtractor:
+
+  def __init__(self, pages=None):
+    self.pages = pages
+
+  def ie_key(self):
+    return 'YoutubePlaylist'
+
+  def extract(self, url):
+    if self.pages is None:
+      raise ExtractorError('This playlist does not exist.', expected=True)
+    return {'_type': 'playlist', 'entries': self.entries()}
+
+  def entries(self):
+    for i in range(self.pages):
+      yield {'url': 'video{}'.format(i), 'ie_key': 'Youtube', 'title': str(i)}
+    raise ExtractorError('Unable to download the next page')
+
+
+def iter_playlist(extractor, songs):
+  instance = YoutubeDlProviderInstance(YoutubeDlProvider())
+  instance.yt.get_info_extractor = lambda ie_key: extractor
+  async def collect():
+    async for song in instance.iter_playlist('https://youtube.com/playlist?list=x', extractor):
+      songs.append(song)
+  asyncio.run(collect())
+
+
+def test_failing_playlist_extractor_raises_resolve_error():
+  songs = []
+  with pytest.raises(ResolveError) as excinfo:
+    iter_playlist(FailingExtractor(), songs)
+  assert isinstance(excinfo.value.__cause__, ExtractorError)
+  assert not songs
+
+
+def test_failing_playlist_page_raises_resolve_error():
+  songs = []
+  with pytest.raises(ResolveError) as excinfo:
+    iter_playlist(FailingExtractor(pages=2), songs)
+  assert isinstance(excinfo.value.__cause__, ExtractorError)
+  assert [x.url for x in songs] == [
+    'https://www.youtube.com/watch?v=video0', 'https://www.youtube.com/watch?v=video1']